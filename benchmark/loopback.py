@@ -0,0 +1,113 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Helpers shared by benchmark scripts: starting rrpi-server.py on loopback with
+# simulated device modules, pointing client libraries at it and running SPI load
+# from many client processes.
+
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, "raspberrypi", "rrpi-server.py")
+SIMULATED = os.path.join(ROOT, "raspberrypi", "simulated")
+CLIENT_LIBRARIES = os.path.join(ROOT, "client", "libraries")
+
+
+def startServer(engine, port, extraEnv=None, extraArgs=None, simulated=SIMULATED):
+    # simulated is directory (or os.pathsep separated directories) with spidev, nRF2401, ...
+    # modules server is to use instead of real ones
+    env = dict(os.environ)
+    env["PYTHONPATH"] = simulated
+    if extraEnv is not None:
+        env.update(extraEnv)
+
+    args = [sys.executable, SERVER, "-a", "127.0.0.1", "-p", str(port), "-e", engine, "-v", "0"]
+    if extraArgs is not None:
+        args.extend(extraArgs)
+
+    process = subprocess.Popen(args, env=env)
+
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+
+    process.kill()
+    raise IOError("Server did not start on port " + str(port))
+
+
+def stopServer(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def useServer(port):
+    # Makes client libraries, imported after this call, talk to server on loopback port
+    os.environ["RASPBERRY_IP"] = "127.0.0.1"
+    os.environ["RASPBERRY_PORT"] = str(port)
+    if CLIENT_LIBRARIES not in sys.path:
+        sys.path.insert(0, CLIENT_LIBRARIES)
+
+
+def percentile(sortedValues, p):
+    if len(sortedValues) == 0:
+        return 0.0
+    return sortedValues[min(len(sortedValues) - 1, int(len(sortedValues) * p / 100.0))]
+
+
+def spiClient(port, size, duration, bus=0):
+    useServer(port)
+    import spidev
+
+    spi = spidev.SpiDev()
+    spi.open(bus, 0)
+    data = [0x55] * size
+
+    latencies = []
+    end = time.perf_counter() + duration
+    now = time.perf_counter()
+    while now < end:
+        spi.xfer(data)
+        last = now
+        now = time.perf_counter()
+        latencies.append(now - last)
+
+    spi.close()
+    return latencies
+
+
+def runClients(port, clients, size, duration, buses=1):
+    # Client i uses SPI bus i % buses. Spawned, not forked, as caller may already have
+    # client connections and their threads
+    with multiprocessing.get_context("spawn").Pool(clients) as pool:
+        results = pool.starmap(spiClient, [(port, size, duration, i % buses) for i in range(clients)])
+
+    latencies = sorted(l for result in results for l in result)
+    return {
+        "clients": clients,
+        "buses": buses,
+        "ops": len(latencies),
+        "opsPerSecond": len(latencies) / duration,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99)
+    }
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Replays capture file, recorded by rrpi-server.py --capture or by client with
+# RASPBERRY_CAPTURE set, against rrpi-server.py started on loopback with simulated
+# modules (or against given server). Request frames are sent with recorded timing,
+# on as many connections as were recorded, and reply latencies are compared, per
+# command, with recorded ones. With --verify replies' payloads must match recorded,
+# except those of STATUS_ONLY commands, of which only the status is compared.
+#
+# usage: replay.py capture [-s speed] [--verify] [--ignore cmd,...] [--server host:port] [--json]
+
+import argparse
+import collections
+import json
+import socket
+import sys
+import threading
+import time
+
+from loopback import CLIENT_LIBRARIES, percentile, startServer, stopServer
+
+sys.path.insert(0, CLIENT_LIBRARIES)
+import rrpi
+
+REPLY_TIMEOUT = 10
+
+# Replies to these differ from run to run (random session token, counters, UDP port)
+STATUS_ONLY = (rrpi.RRPI_SESSION_OPEN, rrpi.RRPI_STATS, rrpi.RRPI_DATAGRAM_OPEN)
+
+COMMAND_NAMES = {value: name for name, value in vars(rrpi).items()
+                 if isinstance(value, int) and name.split("_")[0] in ("SPI", "I2C", "GPIO", "NRF", "CAMERA", "RRPI")
+                 and not name.endswith("_COMMAND")}
+
+
+def commandName(cmd):
+    return COMMAND_NAMES.get(cmd, "0x{0:02x}".format(cmd))
+
+
+def readCapture(path):
+    records = []
+    with open(path, "rb") as f:
+        if f.read(len(rrpi.CAPTURE_MAGIC)) != rrpi.CAPTURE_MAGIC:
+            raise IOError(path + " is not a capture file")
+
+        while True:
+            header = f.read(rrpi.CAPTURE_RECORD.size)
+            if len(header) < rrpi.CAPTURE_RECORD.size:
+                break
+            timestamp, connection, direction, cmd, flags, channel, tag, length = rrpi.CAPTURE_RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            records.append((timestamp, connection, direction, cmd, flags, channel, tag, payload))
+
+    return records
+
+
+def pairReplies(records):
+    # Returns list, per connection, of (offset, cmd, flags, channel, tag, payload, reply) where
+    # reply is (status, payload, latency) recorded for the request, or None if it did not expect one
+    start = records[0][0] if len(records) > 0 else 0
+    connections = collections.OrderedDict()
+    waiting = collections.defaultdict(collections.deque)
+    pushes = collections.Counter()
+
+    for timestamp, connection, direction, cmd, flags, channel, tag, payload in records:
+        if direction == rrpi.CAPTURE_REQUEST:
+            request = [timestamp - start, cmd, flags, channel, tag, payload, None]
+            connections.setdefault(connection, []).append(request)
+            if flags & rrpi.FLAG_REPLY:
+                waiting[(connection, channel, tag)].append((timestamp, request))
+        elif flags == rrpi.STATUS_PUSH:
+            pushes[cmd] += 1
+        elif len(waiting[(connection, channel, tag)]) > 0:
+            sent, request = waiting[(connection, channel, tag)].popleft()
+            request[6] = (flags, payload, timestamp - sent)
+
+    return list(connections.values()), pushes
+
+
+class Replayer:
+    # Replays requests of one recorded connection and collects replies
+
+    def __init__(self, address, requests, start, speed, results):
+        self._socket = socket.create_connection(address)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._requests = requests
+        self._start = start
+        self._speed = speed
+        self._results = results
+        self._lock = threading.Lock()
+        self._waiting = collections.defaultdict(collections.deque)
+        self._outstanding = 0
+        self._done = threading.Condition(self._lock)
+        self._reader = threading.Thread(target=self._readReplies)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def run(self):
+        for offset, cmd, flags, channel, tag, payload, reply in self._requests:
+            if self._speed > 0:
+                delay = self._start + offset / self._speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if flags & rrpi.FLAG_REPLY:
+                with self._lock:
+                    self._waiting[(channel, tag)].append((time.perf_counter(), cmd, reply))
+                    self._outstanding += 1
+
+            self._socket.sendall(rrpi.REQUEST_HEADER.pack(cmd, flags, channel, tag, len(payload)) + payload)
+
+        with self._lock:
+            deadline = time.time() + REPLY_TIMEOUT
+            while self._outstanding > 0 and time.time() < deadline:
+                self._done.wait(deadline - time.time())
+            lost = self._outstanding
+
+        self._socket.close()
+        return lost
+
+    def _recv(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if len(chunk) == 0:
+                raise ConnectionResetError("Connection closed")
+            data += chunk
+        return data
+
+    def _readReplies(self):
+        try:
+            while True:
+                cmd, status, channel, tag, length = rrpi.REPLY_HEADER.unpack(self._recv(rrpi.REPLY_HEADER.size))
+                payload = self._recv(length)
+                now = time.perf_counter()
+                if status == rrpi.STATUS_PUSH:
+                    self._results.push(cmd)
+                    continue
+
+                with self._lock:
+                    sent, requestCmd, recorded = self._waiting[(channel, tag)].popleft()
+                    self._outstanding -= 1
+                    self._done.notify()
+                self._results.reply(requestCmd, now - sent, status, payload, recorded)
+        except (OSError, IndexError):
+            pass
+
+
+class Results:
+    def __init__(self, verify, ignore):
+        self._verify = verify
+        self._ignore = ignore
+        self._lock = threading.Lock()
+        self.recorded = collections.defaultdict(list)
+        self.replayed = collections.defaultdict(list)
+        self.mismatches = collections.Counter()
+        self.pushes = collections.Counter()
+
+    def push(self, cmd):
+        with self._lock:
+            self.pushes[cmd] += 1
+
+    def reply(self, cmd, latency, status, payload, recorded):
+        with self._lock:
+            self.replayed[cmd].append(latency)
+            if recorded is None:
+                return
+            self.recorded[cmd].append(recorded[2])
+            if self._verify and cmd not in self._ignore and (status != recorded[0] or cmd not in STATUS_ONLY and payload != recorded[1]):
+                self.mismatches[cmd] += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay rrpi capture file against simulated devices")
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("-s", "--speed", type=float, default=1.0, help="replay speed; 0 sends requests without recorded pauses. Default 1")
+    parser.add_argument("--verify", action="store_true", help="replies must match recorded ones")
+    parser.add_argument("--ignore", default="", help="comma separated commands (numbers) not to verify")
+    parser.add_argument("--server", help="host:port of running server instead of simulated one")
+    parser.add_argument("-e", "--engine", choices=["threaded", "asyncio"], default="threaded", help="engine of simulated server")
+    parser.add_argument("-p", "--port", type=int, default=8791, help="loopback port for simulated server")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    connections, recordedPushes = pairReplies(readCapture(args.capture))
+    results = Results(args.verify, set(int(c, 0) for c in args.ignore.split(",") if c != ""))
+
+    process = None
+    if args.server is not None:
+        host, port = args.server.rsplit(":", 1)
+        address = (host, int(port))
+    else:
+        address = ("127.0.0.1", args.port)
+        # UDP is on, at the same port number, so recorded RRPI_DATAGRAM_OPEN succeeds
+        process = startServer(args.engine, args.port, extraArgs=["-u", str(args.port)])
+
+    try:
+        start = time.perf_counter()
+        replayers = [Replayer(address, requests, start, args.speed, results) for requests in connections]
+        lost = [0] * len(replayers)
+
+        def runReplayer(i):
+            lost[i] = replayers[i].run()
+
+        threads = [threading.Thread(target=runReplayer, args=(i,)) for i in range(len(replayers))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        duration = time.perf_counter() - start
+    finally:
+        if process is not None:
+            stopServer(process)
+
+    commands = []
+    for cmd in sorted(set(results.replayed) | set(recordedPushes) | set(results.pushes)):
+        recorded = sorted(results.recorded[cmd])
+        replayed = sorted(results.replayed[cmd])
+        commands.append({
+            "command": commandName(cmd),
+            "replies": len(replayed),
+            "recordedP50": percentile(recorded, 50),
+            "recordedP99": percentile(recorded, 99),
+            "replayedP50": percentile(replayed, 50),
+            "replayedP99": percentile(replayed, 99),
+            "mismatches": results.mismatches[cmd],
+            "recordedPushes": recordedPushes[cmd],
+            "replayedPushes": results.pushes[cmd]
+        })
+
+    summary = {"connections": len(connections), "duration": duration, "lost": sum(lost), "commands": commands}
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print("{0:<24} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10} {6:>8} {7:>12}".format(
+            "command", "replies", "rec p50", "rec p99", "p50 ms", "p99 ms", "mismatch", "pushes"))
+        for c in commands:
+            print("{0:<24} {1:>7} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.3f} {6:>8} {7:>5}/{8:<6}".format(
+                c["command"], c["replies"], c["recordedP50"] * 1000, c["recordedP99"] * 1000,
+                c["replayedP50"] * 1000, c["replayedP99"] * 1000, c["mismatches"], c["replayedPushes"], c["recordedPushes"]))
+        print("{0} connections in {1:.2f}s, {2} replies lost".format(len(connections), duration, sum(lost)))
+
+    if sum(results.mismatches.values()) > 0 or sum(lost) > 0:
+        sys.exit(1)
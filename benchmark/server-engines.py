@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Compares rrpi-server.py engines (threaded vs asyncio) with growing number of
+# concurrent clients. Server is started on loopback with simulated spidev/nRF2401
+# modules and each client process runs SpiDev.xfer in a loop for given time.
+#
+# usage: server-engines.py [-c 1,4,16,32] [-d seconds] [-s size] [--spi-hz hz]
+
+import argparse
+
+from loopback import runClients, startServer, stopServer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark rrpi-server.py engines")
+    parser.add_argument("-c", "--clients", default="1,4,16,32", help="comma separated list of concurrent clients")
+    parser.add_argument("-d", "--duration", type=float, default=3.0, help="seconds per measurement")
+    parser.add_argument("-s", "--size", type=int, default=32, help="SPI transfer size")
+    parser.add_argument("-p", "--port", type=int, default=8790, help="loopback port to use")
+    parser.add_argument("--spi-hz", type=int, default=0, help="simulated SPI clock; 0 for instant transfers")
+    args = parser.parse_args()
+
+    clientCounts = [int(c) for c in args.clients.split(",")]
+
+    print("engine    clients      ops/s    p50 ms    p99 ms")
+    for engine in ["threaded", "asyncio"]:
+        server = startServer(engine, args.port, {"SIMULATED_SPI_HZ": str(args.spi_hz)})
+        try:
+            for clients in clientCounts:
+                res = runClients(args.port, clients, args.size, args.duration)
+                print("{:9} {:7d} {:10.0f} {:9.3f} {:9.3f}".format(engine, clients, res["opsPerSecond"], res["p50"] * 1000, res["p99"] * 1000))
+        finally:
+            stopServer(server)
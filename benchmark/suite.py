@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Benchmark suite. Starts rrpi-server.py on loopback with simulated device modules
+# (raspberrypi/simulated, or other directory given with --simulated) and measures,
+# through client libraries:
+#
+#   latency  - round trip p50/p99 of individual commands
+#   spi      - SPI throughput, lock-step and pipelined, across transfer sizes
+#   nrf      - nRF packets sent per second and streamed receive rate
+#   scaling  - SPI operations per second with growing number of client processes
+#   buses    - SPI operations per second of clients spread over one or more buses, with
+#              simulated bus clock (--spi-hz) so transfers take as long as on real bus
+#
+# Server's own per command split of time (queue, driver, network), fetched with
+# RRPI_STATS at the end, is included with the results.
+#
+# Results are printed as tables or, with --json/--output, as JSON so they can be
+# kept and compared between releases.
+#
+# usage: suite.py [--only latency,spi,nrf,scaling,buses] [-e engine] [-m processes] [-o results.json] [--json]
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+from loopback import ROOT, SIMULATED, percentile, runClients, startServer, stopServer, useServer
+
+PIPELINE_DEPTH = 8
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def latencyOperations():
+    import nRF2401
+    import smbus
+    import spidev
+    import RPi.GPIO as GPIO
+
+    spi = spidev.SpiDev()
+    spi.open(0, 0)
+    bus = smbus.SMBus(1)
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(17, GPIO.IN)
+    nRF2401.initNRF(0, 1, 32, [1, 2, 3, 4, 5], 1)
+
+    data = [0x55] * 32
+    return [
+        ("SPI_XFER", lambda: spi.xfer(data)),
+        ("SPI_XFER_BATCH", lambda: spi.xfer_batch([data] * 8)),
+        ("I2C_READ_BYTE_DATA", lambda: bus.read_byte_data(0x20, 0)),
+        ("I2C_READ_WORD_DATA", lambda: bus.read_word_data(0x20, 0)),
+        ("I2C_READ_MANY", lambda: bus.read_many([(0x20, r, 2) for r in range(8)])),
+        ("GPIO_INPUT", lambda: GPIO.input(17)),
+        ("GPIO_READ_BANK", GPIO.input_bank),
+        ("NRF_SEND", lambda: nRF2401.sendData(data)),
+        ("NRF_POOL_DATA", lambda: nRF2401.poolData(0))
+    ]
+
+
+def measureLatency(iterations, warmup):
+    results = {}
+    for name, operation in latencyOperations():
+        for i in range(warmup):
+            operation()
+
+        latencies = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            operation()
+            latencies.append(time.perf_counter() - start)
+
+        latencies.sort()
+        results[name] = {
+            "ops": iterations,
+            "mean": sum(latencies) / iterations,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99)
+        }
+
+    return results
+
+
+def pipelined(submit, duration):
+    # Keeps PIPELINE_DEPTH requests in flight for given time; returns completed count
+    futures = []
+    count = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        futures.append(submit())
+        if len(futures) >= PIPELINE_DEPTH:
+            futures.pop(0).result()
+            count += 1
+
+    for future in futures:
+        future.result()
+    return count + len(futures)
+
+
+def measureSpi(sizes, duration):
+    import spidev
+
+    spi = spidev.SpiDev()
+    spi.open(0, 0)
+
+    results = []
+    for size in sizes:
+        data = [0x55] * size
+
+        count = 0
+        end = time.perf_counter() + duration
+        while time.perf_counter() < end:
+            spi.xfer(data)
+            count += 1
+        lockStep = count / duration
+
+        pipelinedOps = pipelined(lambda: spi.xfer_async(data), duration) / duration
+
+        results.append({
+            "size": size,
+            "opsPerSecond": lockStep,
+            "bytesPerSecond": lockStep * size,
+            "pipelinedOpsPerSecond": pipelinedOps,
+            "pipelinedBytesPerSecond": pipelinedOps * size
+        })
+
+    spi.close()
+    return results
+
+
+def measureNrfSend(duration):
+    import nRF2401
+
+    nRF2401.initNRF(0, 1, 32, [1, 2, 3, 4, 5], 1)
+    data = [0xAA] * 32
+
+    count = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        nRF2401.sendData(data)
+        count += 1
+
+    return {
+        "sendPerSecond": count / duration,
+        "pipelinedSendPerSecond": pipelined(lambda: nRF2401.sendDataAsync(data), duration) / duration
+    }
+
+
+def measureNrfReceive(duration, rate):
+    import nRF2401
+
+    nRF2401.initNRF(0, 1, 32, [1, 2, 3, 4, 5], 1)
+    nRF2401.startReceiving(32, capacity=1024, batchSize=16, maxLatency=0.005)
+    nRF2401.startListening()
+
+    count = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        if nRF2401.nextPacket(0.1) is not None:
+            count += 1
+
+    nRF2401.stopListening()
+    stats = nRF2401.getReceiveStats()
+    nRF2401.stopReceiving()
+
+    return {
+        "offeredPerSecond": rate,
+        "receivedPerSecond": count / duration,
+        "overflows": stats["overflows"],
+        "dropped": stats["dropped"] + stats["localOverflows"]
+    }
+
+
+def serverTimes():
+    import rrpi
+
+    times = {}
+    for name, command in rrpi.connection().stats()["commands"].items():
+        if command["frames"] > 0:
+            times[name] = {
+                "frames": command["frames"],
+                "queue": command["queueTime"] / command["frames"],
+                "driver": command["driverTime"] / command["frames"],
+                "network": command["networkTime"] / command["frames"]
+            }
+    return times
+
+
+def printResults(results):
+    if "latency" in results:
+        print("command                   ops    mean ms   p50 ms   p99 ms")
+        for name, r in results["latency"].items():
+            print("{:22} {:6d} {:10.3f} {:8.3f} {:8.3f}".format(name, r["ops"], r["mean"] * 1000, r["p50"] * 1000, r["p99"] * 1000))
+        print()
+
+    if "spi" in results:
+        print("SPI size     ops/s       MB/s  pipelined ops/s  pipelined MB/s")
+        for r in results["spi"]:
+            print("{:8d} {:9.0f} {:10.2f} {:16.0f} {:15.2f}".format(
+                r["size"], r["opsPerSecond"], r["bytesPerSecond"] / 1e6, r["pipelinedOpsPerSecond"], r["pipelinedBytesPerSecond"] / 1e6))
+        print()
+
+    if "nrf" in results:
+        r = results["nrf"]
+        print("nRF send {:.0f} packets/s, pipelined {:.0f} packets/s".format(r["sendPerSecond"], r["pipelinedSendPerSecond"]))
+        print("nRF receive {:.0f} of {:.0f} packets/s offered, {} overflows, {} dropped".format(
+            r["receivedPerSecond"], r["offeredPerSecond"], r["overflows"], r["dropped"]))
+        print()
+
+    if "scaling" in results:
+        print("clients      ops/s    p50 ms    p99 ms")
+        for r in results["scaling"]:
+            print("{:7d} {:10.0f} {:9.3f} {:9.3f}".format(r["clients"], r["opsPerSecond"], r["p50"] * 1000, r["p99"] * 1000))
+        print()
+
+    if "buses" in results:
+        print("clients  buses      ops/s    p50 ms    p99 ms")
+        for r in results["buses"]:
+            print("{:7d} {:6d} {:10.0f} {:9.3f} {:9.3f}".format(r["clients"], r["buses"], r["opsPerSecond"], r["p50"] * 1000, r["p99"] * 1000))
+        print()
+
+    print("server                  frames   queue us  driver us  network us")
+    for name, r in sorted(results["server"].items()):
+        print("{:22} {:7d} {:10.1f} {:10.1f} {:11.1f}".format(name, r["frames"], r["queue"] * 1e6, r["driver"] * 1e6, r["network"] * 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="rrpi benchmark suite against simulated devices")
+    parser.add_argument("--only", default="latency,spi,nrf,scaling,buses", help="comma separated list of benchmarks to run")
+    parser.add_argument("-e", "--engine", choices=["threaded", "asyncio"], default="threaded", help="server engine. Default threaded")
+    parser.add_argument("-m", "--processes", help="server's worker processes (its --processes option). Default none")
+    parser.add_argument("-d", "--duration", type=float, default=2.0, help="seconds per throughput measurement")
+    parser.add_argument("-n", "--iterations", type=int, default=2000, help="round trips per command in latency benchmark")
+    parser.add_argument("--sizes", default="16,256,4096,16384,65536", help="comma separated SPI transfer sizes")
+    parser.add_argument("--clients", default="1,4,16", help="comma separated client counts for scaling benchmark")
+    parser.add_argument("--bus-clients", type=int, default=4, help="client processes in buses benchmark")
+    parser.add_argument("--bus-size", type=int, default=4096, help="SPI transfer size in buses benchmark")
+    parser.add_argument("--spi-hz", type=int, default=8000000, help="simulated SPI clock in buses benchmark")
+    parser.add_argument("--nrf-rx-rate", type=float, default=5000, help="packets per second simulated radio receives")
+    parser.add_argument("--simulated", default=SIMULATED, help="directory with simulated device modules")
+    parser.add_argument("-p", "--port", type=int, default=8792, help="loopback port to use (and next two)")
+    parser.add_argument("-o", "--output", help="file to write JSON results to")
+    parser.add_argument("--json", action="store_true", help="print JSON results instead of tables")
+    args = parser.parse_args()
+
+    only = args.only.split(",")
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": gitRevision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "engine": args.engine,
+            "processes": args.processes,
+            "simulated": os.path.relpath(args.simulated, ROOT)
+        }
+    }
+
+    serverArgs = ["-m", args.processes] if args.processes is not None else None
+    server = startServer(args.engine, args.port, extraArgs=serverArgs, simulated=args.simulated)
+    try:
+        useServer(args.port)
+        if "latency" in only:
+            results["latency"] = measureLatency(args.iterations, args.iterations // 10)
+        if "spi" in only:
+            results["spi"] = measureSpi([int(s) for s in args.sizes.split(",")], args.duration)
+        if "nrf" in only:
+            results["nrf"] = measureNrfSend(args.duration)
+        if "scaling" in only:
+            results["scaling"] = [runClients(args.port, clients, 32, args.duration) for clients in (int(c) for c in args.clients.split(","))]
+        results["server"] = serverTimes()
+    finally:
+        stopServer(server)
+
+    if "nrf" in only:
+        server = startServer(args.engine, args.port + 1, {"SIMULATED_NRF_RX_RATE": str(args.nrf_rx_rate)}, serverArgs, args.simulated)
+        try:
+            useServer(args.port + 1)
+            results["nrf"].update(measureNrfReceive(args.duration, args.nrf_rx_rate))
+        finally:
+            stopServer(server)
+
+    if "buses" in only:
+        server = startServer(args.engine, args.port + 2, {"SIMULATED_SPI_HZ": str(args.spi_hz)}, serverArgs, args.simulated)
+        try:
+            results["buses"] = [runClients(args.port + 2, args.bus_clients, args.bus_size, args.duration, buses)
+                                for buses in sorted({1, 2, args.bus_clients}) if buses <= args.bus_clients]
+        finally:
+            stopServer(server)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        printResults(results)
@@ -11,6 +11,12 @@
 #################################################################################
 
 
+import os
+import queue
+import rrpi
+import struct
+import threading
+
 BOARD = 10
 BCM = 11
 SERIAL = 40
@@ -26,42 +32,215 @@ BOTH_EDGE = 3
 HIGH = 1
 LOW = 0
 
-PUD_OFF = 0
-PUD_DOWN = 1
-PUD_UP = 2
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+
+
+IN = 1
+OUT = 0
+
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+_SETUP_ARGS = struct.Struct("<BBBb")
+_EVENT_DETECT_ARGS = struct.Struct("<BBH")
+_EVENT_BATCHING_ARGS = struct.Struct("<Hf")
+_EVENT_COUNT = struct.Struct("<H")
+_EVENT = struct.Struct("<BBd")
+_BANK = struct.Struct("<I")
+_BANK_WRITE = struct.Struct("<II")
+_SEQUENCE_STEP = struct.Struct("<II")
+_SEQUENCE_RESULT = struct.Struct("<dd")
+
+_rrpi = None
+_mode = None
 
+# With RASPBERRY_UDP=1 outputs are sent as datagrams: output change which is overtaken
+# by a later one on the way is dropped and not applied late
+_datagrams = os.environ.get("RASPBERRY_UDP", "0") not in ("", "0", "false", "False")
 
-IN = None
-OUT = None
+_callbacks = {}
+_eventDetected = set()
+_lastEvents = {}
+_events = queue.Queue()
+_dispatcher = None
 
-FALLING = None
-RISING = None
-BOTH = None
+
+def _connection():
+    global _rrpi, _dispatcher
+
+    if _rrpi is None:
+        _rrpi = rrpi.openChannel()
+        _rrpi.subscribe(rrpi.GPIO_EVENTS, _receiveEvents)
+        _dispatcher = threading.Thread(target=_dispatchEvents)
+        _dispatcher.daemon = True
+        _dispatcher.start()
+    return _rrpi
+
+
+def _channels(channel):
+    if isinstance(channel, int):
+        return [channel]
+    return channel
 
 
 def setwarnings(b):
-    raise NotImplemented()
+    buf = bytearray()
+    buf.append(1 if b else 0)
+    _connection().send(rrpi.GPIO_SETWARNINGS, buf)
 
 
 def setmode(mode):
-    raise NotImplemented()
+    global _mode
+
+    buf = bytearray()
+    buf.append(mode)
+    _connection().send(rrpi.GPIO_SETMODE, buf)
+    _mode = mode
+
+
+def getmode():
+    return _mode
 
 
 def input(pin):
-    raise NotImplemented()
+    buf = bytearray()
+    buf.append(pin)
+    return _connection().request(rrpi.GPIO_INPUT, buf).result()[0]
 
 
 def output(pin, state):
-    raise NotImplemented()
+    for p in _channels(pin):
+        buf = bytearray()
+        buf.append(p)
+        buf.append(HIGH if state else LOW)
+        _sendOutput(rrpi.GPIO_OUTPUT, buf)
+
+
+def _sendOutput(cmd, buf):
+    if _datagrams:
+        _connection().sendDatagram(cmd, buf)
+    else:
+        _connection().send(cmd, buf)
+
+
+def setup(pin, type, pull_up_down=PUD_OFF, initial=-1):
+    for p in _channels(pin):
+        _connection().send(rrpi.GPIO_SETUP, _SETUP_ARGS.pack(p, type, pull_up_down, initial))
+
+
+def cleanup(pin=None):
+    buf = bytearray()
+    if pin is not None:
+        buf.extend(_channels(pin))
+        for p in _channels(pin):
+            _forget(p)
+    else:
+        for p in list(_callbacks.keys()):
+            _forget(p)
+    _connection().send(rrpi.GPIO_CLEANUP, buf)
+
+
+def add_event_detect(pin, edge, callback=None, bouncetime=None):
+    _callbacks[pin] = []
+    if callback is not None:
+        _callbacks[pin].append((callback, False))
+    _connection().send(rrpi.GPIO_ADD_EVENT_DETECT, _EVENT_DETECT_ARGS.pack(pin, edge, bouncetime if bouncetime is not None else 0))
+
+
+def add_event_callback(pin, callback):
+    if pin not in _callbacks:
+        raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+    _callbacks[pin].append((callback, False))
+
+
+def add_timestamped_event_callback(pin, callback):
+    # callback(pin, level, timestamp) where timestamp is time.time() on the Pi when edge was detected
+    if pin not in _callbacks:
+        raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+    _callbacks[pin].append((callback, True))
+
+
+def remove_event_detect(pin):
+    _forget(pin)
+    buf = bytearray()
+    buf.append(pin)
+    _connection().send(rrpi.GPIO_REMOVE_EVENT_DETECT, buf)
+
+
+def event_detected(pin):
+    if pin in _eventDetected:
+        _eventDetected.discard(pin)
+        return True
+    return False
+
+
+def last_event(pin):
+    # Returns (level, timestamp) of the last edge detected on the pin or None
+    return _lastEvents.get(pin)
+
+
+def set_event_batching(maxEvents, maxLatency):
+    _connection().send(rrpi.GPIO_EVENT_BATCHING, _EVENT_BATCHING_ARGS.pack(maxEvents, maxLatency))
+
+
+# Bank operations work on BCM pins 0-27 as bits of one 32 bit mask, regardless of setmode()
+
+
+def pins_to_mask(pins):
+    mask = 0
+    for pin in pins:
+        mask |= 1 << pin
+    return mask
+
+
+def input_bank():
+    return _connection().request(rrpi.GPIO_READ_BANK, b"", lambda data: _BANK.unpack(data)[0]).result()
+
+
+def output_bank(setMask, clearMask=0):
+    _sendOutput(rrpi.GPIO_WRITE_BANK, _BANK_WRITE.pack(setMask, clearMask))
+
+
+def output_bank_value(mask, value):
+    output_bank(value & mask, ~value & mask & 0x0FFFFFFF)
+
+
+def run_sequence(mask, steps):
+    # Runs list of (value, microseconds) steps on the Pi: pins in mask are set to value
+    # and held for given time before next step. Returns future with (duration, max lateness).
+    buf = bytearray(_BANK.pack(mask))
+    for value, delayUs in steps:
+        buf.extend(_SEQUENCE_STEP.pack(value & 0xFFFFFFFF, delayUs))
+    return _connection().request(rrpi.GPIO_SEQUENCE, buf, _SEQUENCE_RESULT.unpack)
 
 
-def setup(pin, type, pull_up_down=None):
-    raise NotImplemented()
+def _forget(pin):
+    _callbacks.pop(pin, None)
+    _eventDetected.discard(pin)
+    _lastEvents.pop(pin, None)
 
 
-def cleanup():
-    raise NotImplemented()
+def _receiveEvents(data):
+    count = _EVENT_COUNT.unpack_from(data)[0]
+    offset = _EVENT_COUNT.size
+    for i in range(count):
+        _events.put(_EVENT.unpack_from(data, offset))
+        offset += _EVENT.size
 
 
-def add_event_detect(pin, edge, callback=None):
-    raise NotImplemented()
+def _dispatchEvents():
+    while True:
+        pin, level, timestamp = _events.get()
+        _eventDetected.add(pin)
+        _lastEvents[pin] = (level, timestamp)
+        for callback, timestamped in _callbacks.get(pin, []):
+            try:
+                if timestamped:
+                    callback(pin, level, timestamp)
+                else:
+                    callback(pin)
+            except Exception as e:
+                print("GPIO callback for pin " + str(pin) + " failed; " + str(e))
@@ -10,11 +10,23 @@
 #
 #################################################################################
 
+import collections
 import rrpi
 import struct
+import threading
 import time
 
-_rrpi = None
+_SUBSCRIBE_ARGS = struct.Struct("<BHHf")
+_BATCH_HEADER = struct.Struct("<HI")
+_PACKET_HEADER = struct.Struct("<dB")
+_RECEIVE_STATS = struct.Struct("<IIIIIHH")
+_POLL_ENTRY = struct.Struct("<5sfB")
+_POLL_RESULT = struct.Struct("<BIB")
+
+# Status of each node in poll() results
+REPLIED = 0
+NO_REPLY = 1
+FAILED = 2
 
 DEBUG = False
 
@@ -34,182 +46,412 @@ def delay100ms():
     time.sleep(0.1)
 
 
-def setReadPipeAddress(pipeNumber, address):
-    buf = bytearray()
-    buf.append(rrpi.NRF_SET_READ_PIPE_ADR)
-    buf.append(pipeNumber)
+def _stringToBytes(s):
+    return bytearray(s.encode("latin-1"))
 
-    _rrpi.send(rrpi.intArrayToBuffer(address, buf))
 
-    if DEBUG:
-        print(">> sent NRF_SET_READ_PIPE_ADR " + str(pipeNumber) + ", " + str(address))
+def padToSize(buf, size):
+    if len(buf) < size:
+        buf.extend(bytes(size - len(buf)))
 
+    return buf
 
-def setWritePipeAddress(address):
-    buf = bytearray()
-    buf.append(rrpi.NRF_SET_WRITE_PIPE_ADR)
-    _rrpi.send(rrpi.intArrayToBuffer(address, buf))
 
-    if DEBUG:
-        print(">> sent NRF_SET_WRITE_PIPE_ADR " + str(address))
+class Radio:
+    # One nRF2401 radio: on SPI bus spiBus with chip select spiDevice (CE0, CE1) of Raspberry
+    # Pi at ip:port (RASPBERRY_IP/RASPBERRY_PORT if not given). Each radio has its own
+    # channel and received packets, so radios can be used in parallel, from different threads.
+    # Module functions below drive the radio last set up with initNRF.
 
+    def __init__(self, spiBus, spiDevice, packetSize, address, channel, ip=None, port=None):
+        self._rrpi = rrpi.openChannel(ip, port)
+        self._receiveCallback = None
+        self._dispatcher = None
+        self._packets = collections.deque(maxlen=256)
+        self._packetsCondition = threading.Condition()
+        self._serverOverflows = 0
+        self._localOverflows = 0
 
-def getWritePipeAddress():
-    raise NotImplemented()
+        buf = bytearray()
+        buf.append(spiBus)
+        buf.append(spiDevice)
+        buf.append(packetSize)
+        rrpi.intArrayToBuffer(address, buf)
+        buf.append(channel)
+        self._rrpi.send(rrpi.NRF_INIT, buf)
 
+        if DEBUG:
+            print(">> sent NRF_INIT")
 
-def writeFlushTX():
-    _rrpi.sendInt(rrpi.NRF_FLUSH_TX)
+    def __del__(self):
+        if getattr(self, "_rrpi", None) is not None:
+            self._rrpi.close()
 
-    if DEBUG:
-        print(">> sent NRF_FLUSH_TX")
+    def setReadPipeAddress(self, pipeNumber, address):
+        buf = bytearray()
+        buf.append(pipeNumber)
 
+        self._rrpi.send(rrpi.NRF_SET_READ_PIPE_ADR, rrpi.intArrayToBuffer(address, buf))
 
-def writeFlushRX():
-    _rrpi.sendInt(rrpi.NRF_FLUSH_RX)
+        if DEBUG:
+            print(">> sent NRF_SET_READ_PIPE_ADR " + str(pipeNumber) + ", " + str(address))
+
+    def setWritePipeAddress(self, address):
+        self._rrpi.send(rrpi.NRF_SET_WRITE_PIPE_ADR, rrpi.intArrayToBuffer(address, bytearray()))
+
+        if DEBUG:
+            print(">> sent NRF_SET_WRITE_PIPE_ADR " + str(address))
+
+    def getWritePipeAddress(self):
+        raise NotImplemented()
+
+    def writeFlushTX(self):
+        self._rrpi.send(rrpi.NRF_FLUSH_TX)
+
+        if DEBUG:
+            print(">> sent NRF_FLUSH_TX")
+
+    def writeFlushRX(self):
+        self._rrpi.send(rrpi.NRF_FLUSH_RX)
+
+        if DEBUG:
+            print(">> sent NRF_FLUSH_RX")
+
+    def powerUp(self):
+        self._rrpi.send(rrpi.NRF_POWER_UP)
 
-    if DEBUG:
-        print(">> sent NRF_FLUSH_RX")
+        if DEBUG:
+            print(">> sent NRF_POWER_UP")
+
+    def powerDown(self):
+        self._rrpi.send(rrpi.NRF_POWER_DOWN)
+
+        if DEBUG:
+            print(">> sent NRF_POWER_DOWN")
+
+    def swithToTX(self):
+        self._rrpi.send(rrpi.NRF_SWITCH_TX)
+
+        if DEBUG:
+            print(">> sent NRF_SWITCH_TX")
+
+    def swithToRX(self):
+        self._rrpi.send(rrpi.NRF_SWITCH_RX)
+
+        if DEBUG:
+            print(">> sent NRF_SWITCH_RX")
+
+    def reset(self):
+        self._rrpi.send(rrpi.NRF_RESET)
+
+        if DEBUG:
+            print(">> sent NRF_RESET")
+
+    def sendString(self, data):
+        return self.sendData(_stringToBytes(data))
+
+    def sendData(self, data):
+        res = self.sendDataAsync(data).result()
+
+        if DEBUG:
+            print(">> sent NRF_SEND, get " + str(res))
+        return res
+
+    def sendDataAsync(self, data):
+        return self._rrpi.request(rrpi.NRF_SEND, rrpi.toBuffer(data), rrpi.toBool)
+
+    def sendDataDatagram(self, data, ack=False):
+        # Sends packet over UDP (see rrpi.RRPi.sendDatagram): it is not sent at all if a later
+        # one overtakes it. With ack returns future as sendDataAsync does.
+        return self._rrpi.sendDatagram(rrpi.NRF_SEND, rrpi.toBuffer(data), ack, rrpi.toBool)
+
+    def startListening(self):
+        self._rrpi.send(rrpi.NRF_START_LISTENING)
+
+        if DEBUG:
+            print(">> sent NRF_START_LISTENING")
+
+    def stopListening(self):
+        self._rrpi.send(rrpi.NRF_STOP_LISTENING)
+
+        if DEBUG:
+            print(">> sent NRF_STOP_LISTENING")
+
+    def receiveData(self, n, output="list"):
+        buf = bytearray()
+        buf.append(n)
+        data = self._rrpi.request(rrpi.NRF_RECEIVE, buf, rrpi.outputConverter(output)).result()
+
+        if DEBUG:
+            print(">> sent NRF_RECEIVE, got " + str(data))
+        return data
+
+    def poolData(self, timeout):
+        res = self._rrpi.request(rrpi.NRF_POOL_DATA, struct.pack("<f", timeout), rrpi.toBool).result()
+
+        if DEBUG:
+            print(">> sent NRF_POOL_DATA, got " + str(res))
+        return res
+
+    def sendAndReceive(self, data, timeout, output="list"):
+        res = self.sendAndReceiveAsync(data, timeout, output).result()
+
+        if DEBUG:
+            print(">> sent NRF_SEND_AND_RECEIVE; set= " + str(data) + ", " + str(timeout) + ", got= " + str(res))
+        return res
+
+    def sendAndReceiveAsync(self, data, timeout, output="list"):
+        buf = bytearray(struct.pack("<f", timeout))
+        return self._rrpi.request(rrpi.NRF_SEND_AND_RECEIVE, rrpi.intArrayToBuffer(data, buf), rrpi.outputConverter(output))
+
+    def poll(self, nodes, output="list"):
+        res = self.pollAsync(nodes, output).result()
+
+        if DEBUG:
+            print(">> sent NRF_POLL_LIST for " + str(len(nodes)) + " nodes, got " + str(res))
+        return res
+
+    def pollAsync(self, nodes, output="list"):
+        # Sends to each of nodes, list of (address, payload, timeout), its payload and waits up to
+        # timeout seconds for its reply, all on the Pi in one round trip. Result is list of
+        # (status, reply, round trip seconds), one for each node; status is REPLIED, NO_REPLY
+        # or FAILED, with error message as reply. Write pipe address is left at the last node's.
+        buf = bytearray()
+        for address, payload, timeout in nodes:
+            payload = rrpi.toBuffer(payload)
+            buf += _POLL_ENTRY.pack(bytes(address), timeout, len(payload))
+            buf += payload
+
+        def convert(data):
+            results = []
+            offset = 0
+            while offset < len(data):
+                status, roundTrip, size = _POLL_RESULT.unpack_from(data, offset)
+                offset += _POLL_RESULT.size
+                reply = data[offset:offset + size]
+                offset += size
+                if status == FAILED:
+                    reply = bytes(reply).decode("utf-8", "replace")
+                elif status == REPLIED:
+                    reply = rrpi.convertOutput(reply, output)
+                else:
+                    reply = None
+                results.append((status, reply, roundTrip / 1000000.0))
+            return results
+
+        return self._rrpi.request(rrpi.NRF_POLL_LIST, buf, convert)
+
+    def close(self):
+        # Closes the radio on the Pi and releases the channel; the radio can not be used after
+        self._rrpi.send(rrpi.NRF_CLOSE)
+        with self._packetsCondition:
+            self._receiveCallback = None
+            self._packetsCondition.notify_all()
+
+        if DEBUG:
+            print(">> sent NRF_CLOSE")
+
+        self._rrpi.close()
+        self._rrpi = None
+
+    def startReceiving(self, packetSize, callback=None, capacity=256, batchSize=8, maxLatency=0.005):
+        # Received packets are kept for nextPacket() or, with callback, passed to it from
+        # own thread - so callback can use the radio - up to capacity, dropping the oldest.
+        with self._packetsCondition:
+            self._packets = collections.deque(self._packets, maxlen=capacity)
+            self._receiveCallback = callback
+            if callback is not None and self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatchPackets)
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+        self._rrpi.subscribe(rrpi.NRF_SUBSCRIBE, self._receiveBatch)
+        self._rrpi.send(rrpi.NRF_SUBSCRIBE, _SUBSCRIBE_ARGS.pack(packetSize, capacity, batchSize, maxLatency))
+
+        if DEBUG:
+            print(">> sent NRF_SUBSCRIBE")
+
+    def stopReceiving(self):
+        self._rrpi.send(rrpi.NRF_UNSUBSCRIBE)
+        self._rrpi.unsubscribe(rrpi.NRF_SUBSCRIBE)
+        with self._packetsCondition:
+            self._receiveCallback = None
+            self._packetsCondition.notify_all()
+
+        if DEBUG:
+            print(">> sent NRF_UNSUBSCRIBE")
+
+    def nextPacket(self, timeout=None):
+        with self._packetsCondition:
+            if len(self._packets) == 0:
+                self._packetsCondition.wait(timeout)
+            if len(self._packets) == 0:
+                return None
+            return self._packets.popleft()[1]
+
+    def getReceiveStats(self):
+        received, delivered, batches, overflows, dropped, queued, capacity = \
+            self._rrpi.request(rrpi.NRF_GET_RECEIVE_STATS, b"", _RECEIVE_STATS.unpack).result()
+
+        return {
+            "received": received,
+            "delivered": delivered,
+            "batches": batches,
+            "overflows": overflows,
+            "dropped": dropped,
+            "queued": queued,
+            "capacity": capacity,
+            "localOverflows": self._localOverflows
+        }
+
+    def _receiveBatch(self, data):
+        count, self._serverOverflows = _BATCH_HEADER.unpack_from(data)
+        offset = _BATCH_HEADER.size
+        packets = []
+        for i in range(count):
+            timestamp, size = _PACKET_HEADER.unpack_from(data, offset)
+            offset += _PACKET_HEADER.size
+            packets.append((timestamp, rrpi.bytesToIntArray(data[offset:offset + size])))
+            offset += size
+
+        with self._packetsCondition:
+            for packet in packets:
+                if len(self._packets) == self._packets.maxlen:
+                    self._localOverflows += 1
+                self._packets.append(packet)
+            self._packetsCondition.notify_all()
+
+    def _dispatchPackets(self):
+        # Runs callback outside of connection's reader thread; exits when receiving stops
+        while True:
+            with self._packetsCondition:
+                while len(self._packets) == 0 and self._receiveCallback is not None:
+                    self._packetsCondition.wait()
+                callback = self._receiveCallback
+                if callback is None:
+                    self._dispatcher = None
+                    return
+                timestamp, packet = self._packets.popleft()
+            try:
+                callback(timestamp, packet)
+            except Exception as e:
+                print("nRF receive callback failed; " + str(e))
+
+
+_radio = None
 
 
 def initNRF(spiBus, spiDevice, packetSize, address, channel):
-    global _rrpi
+    global _radio
 
-    _rrpi = rrpi.RRPi()
-    buf = bytearray()
-    buf.append(rrpi.NRF_INIT)
-    buf.append(spiBus)
-    buf.append(spiDevice)
-    buf.append(packetSize)
-    rrpi.intArrayToBuffer(address, buf)
-    buf.append(channel)
-    _rrpi.send(buf)
+    if _radio is not None and _radio._rrpi is not None:
+        _radio._rrpi.close()
+    _radio = Radio(spiBus, spiDevice, packetSize, address, channel)
+    return _radio
 
-    if DEBUG:
-        print(">> sent NRF_INIT")
 
+def setReadPipeAddress(pipeNumber, address):
+    _radio.setReadPipeAddress(pipeNumber, address)
 
-def powerUp():
-    _rrpi.sendInt(rrpi.NRF_POWER_UP)
 
-    if DEBUG:
-        print(">> sent NRF_FLUSH_TX")
+def setWritePipeAddress(address):
+    _radio.setWritePipeAddress(address)
 
 
-def powerDown():
-    _rrpi.sendInt(rrpi.NRF_POWER_DOWN)
+def getWritePipeAddress():
+    raise NotImplemented()
 
-    if DEBUG:
-        print(">> sent NRF_POWER_DOWN")
 
+def writeFlushTX():
+    _radio.writeFlushTX()
 
-def swithToTX():
-    _rrpi.sendInt(rrpi.NRF_SWITCH_TX)
 
-    if DEBUG:
-        print(">> sent NRF_SWITCH_TX")
+def writeFlushRX():
+    _radio.writeFlushRX()
 
 
-def swithToRX():
-    _rrpi.sendInt(rrpi.NRF_SWITCH_RX)
+def powerUp():
+    _radio.powerUp()
 
-    if DEBUG:
-        print(">> sent NRF_SWITCH_RX")
 
+def powerDown():
+    _radio.powerDown()
 
-def reset():
-    _rrpi.sendInt(rrpi.NRF_RESET)
 
-    if DEBUG:
-        print(">> sent NRF_RESET")
+def swithToTX():
+    _radio.swithToTX()
 
 
-def sendString(data):
-    sendString(_stringToBytes(data))
+def swithToRX():
+    _radio.swithToRX()
 
 
-def sendData(data):
-    buf = bytearray()
-    buf.append(rrpi.NRF_SEND)
-    buf.append(len(data))
-    _rrpi.send(rrpi.intArrayToBuffer(data, buf))
+def reset():
+    _radio.reset()
+
 
-    res = _rrpi.recvBool()
+def sendString(data):
+    return _radio.sendString(data)
 
-    if DEBUG:
-        print(">> sent NRF_SEND, get " + str(res))
-    return res
 
+def sendData(data):
+    return _radio.sendData(data)
 
-def _stringToBytes(s):
-    b = bytearray()
-    b.extend(map(ord, s))
-    return b
 
+def sendDataAsync(data):
+    return _radio.sendDataAsync(data)
 
-def padToSize(buf, size):
-    while len(buf) < size:
-        buf.append(0)
 
-    return buf
+def sendDataDatagram(data, ack=False):
+    return _radio.sendDataDatagram(data, ack)
 
 
 def startListening():
-    _rrpi.sendInt(rrpi.NRF_START_LISTENING)
-
-    if DEBUG:
-        print(">> sent NRF_START_LISTENING")
+    _radio.startListening()
 
 
 def stopListening():
-    _rrpi.sendInt(rrpi.NRF_STOP_LISTENING)
+    _radio.stopListening()
+
 
-    if DEBUG:
-        print(">> sent NRF_STOP_LISTENING")
+def receiveData(n, output="list"):
+    return _radio.receiveData(n, output)
 
 
-def receiveData(n):
-    buf = bytearray()
-    buf.append(rrpi.NRF_RECEIVE)
-    buf.append(n)
-    _rrpi.send(buf)
-    data = rrpi.bytesToIntArray(_rrpi.recv(n))
+def poolData(timeout):
+    return _radio.poolData(timeout)
 
-    if DEBUG:
-        print(">> sent NRF_RECEIVE, got " + str(data))
-    return data
 
+def sendAndReceive(data, timeout, output="list"):
+    return _radio.sendAndReceive(data, timeout, output)
 
-def poolData(timeout):
-    buf = bytearray()
-    buf.append(rrpi.NRF_POOL_DATA)
-    rrpi.intArrayToBuffer(struct.pack("f", timeout), buf)
-    _rrpi.send(buf)
-    res = _rrpi.recvBool()
 
-    if DEBUG:
-        print(">> sent NRF_POOL_DATA, got " + str(res))
-    return res
+def sendAndReceiveAsync(data, timeout, output="list"):
+    return _radio.sendAndReceiveAsync(data, timeout, output)
 
 
-def sendAndReceive(data, timeout):
-    buf = bytearray()
-    buf.append(rrpi.NRF_SEND_AND_RECEIVE)
-    rrpi.intArrayToBuffer(struct.pack("f", timeout), buf)
-    size = len(data)
-    buf.append(size)
-    _rrpi.send(rrpi.intArrayToBuffer(data, buf))
-    time.sleep(0.001)
-    recieved = _rrpi.recv(size)
-    res = rrpi.bytesToIntArray(recieved)
+def poll(nodes, output="list"):
+    return _radio.poll(nodes, output)
 
-    if DEBUG:
-        print(">> sent NRF_SEND_AND_RECEIVE; set= " + str(data) + ", " + str(timeout) + ", got= " + str(res))
-    return res
+
+def pollAsync(nodes, output="list"):
+    return _radio.pollAsync(nodes, output)
 
 
 def close():
-    _rrpi.sendInt(rrpi.NRF_CLOSE)
+    _radio.close()
+
+
+def startReceiving(packetSize, callback=None, capacity=256, batchSize=8, maxLatency=0.005):
+    _radio.startReceiving(packetSize, callback, capacity, batchSize, maxLatency)
+
+
+def stopReceiving():
+    _radio.stopReceiving()
+
+
+def nextPacket(timeout=None):
+    return _radio.nextPacket(timeout)
+
 
-    if DEBUG:
-        print(">> sent NRF_CLOSE")
+def getReceiveStats():
+    return _radio.getReceiveStats()
@@ -11,13 +11,122 @@
 #################################################################################
 
 
+import collections
+import rrpi
+import struct
+import threading
+
+_STREAM_ARGS = struct.Struct("<HHBBB")
+_CAPTURE_ARGS = struct.Struct("<HH")
+_CHUNK = struct.Struct("<IIId")
+_STATS = struct.Struct("<IIII")
+
+
 class PiCamera:
 
-    def resolution(w, h):
-        raise NotImplemented()
+    _rrpi = None
 
-    def capture(self, camera, type, use_video_port=True):
-        raise NotImplemented()
+    def __init__(self):
+        self._rrpi = rrpi.openChannel()
+        self.resolution = (1280, 720)
+        self.framerate = 30
+        self.dropped = 0
+        self._frames = collections.deque(maxlen=2)
+        self._condition = threading.Condition()
+        self._streaming = False
+        self._frameNumber = None
+        self._frameBuffer = None
+        self._frameView = None
+        self._frameReceived = 0
+
+    def __del__(self):
+        if self._rrpi is not None:
+            self._rrpi.close()
+
+    def close(self):
+        if self._streaming:
+            self.stop_stream()
+        self._rrpi.close()
+        self._rrpi = None
+
+    def start_stream(self, format="mjpeg", queue_depth=2, quality=0):
+        # Starts continuous capture on the Pi. Server keeps at most queue_depth frames
+        # waiting to be sent and drops the oldest when we are not keeping up; same is done
+        # with frames received here but not yet taken with next_frame()/frames().
+        with self._condition:
+            self._frames = collections.deque(maxlen=queue_depth)
+            self._streaming = True
+        self._rrpi.subscribe(rrpi.CAMERA_FRAME, self._receiveChunk)
+
+        width, height = self.resolution
+        buf = bytearray(_STREAM_ARGS.pack(width, height, self.framerate, queue_depth, quality))
+        buf.extend(format.encode("ascii"))
+        self._rrpi.request(rrpi.CAMERA_START_STREAM, buf).result()
+
+    def stop_stream(self):
+        self._rrpi.request(rrpi.CAMERA_STOP_STREAM).result()
+        self._rrpi.unsubscribe(rrpi.CAMERA_FRAME)
+        with self._condition:
+            self._streaming = False
+            self._condition.notify_all()
+
+    def next_frame(self, timeout=None):
+        # Returns (frame number, timestamp on the Pi, memoryview of frame data) or None
+        with self._condition:
+            if len(self._frames) == 0 and self._streaming:
+                self._condition.wait(timeout)
+            if len(self._frames) == 0:
+                return None
+            return self._frames.popleft()
+
+    def frames(self, timeout=None):
+        while True:
+            frame = self.next_frame(timeout)
+            if frame is None:
+                return
+            yield frame
+
+    def stream_stats(self):
+        captured, sent, dropped, queued = self._rrpi.request(rrpi.CAMERA_GET_STATS, b"", _STATS.unpack).result()
+        return {
+            "captured": captured,
+            "sent": sent,
+            "dropped": dropped,
+            "queued": queued,
+            "localDropped": self.dropped
+        }
+
+    def _receiveChunk(self, data):
+        number, size, offset, timestamp = _CHUNK.unpack_from(data)
+        if number != self._frameNumber:
+            self._frameNumber = number
+            self._frameBuffer = bytearray(size)
+            self._frameView = memoryview(self._frameBuffer)
+            self._frameReceived = 0
+
+        chunkSize = len(data) - _CHUNK.size
+        self._frameView[offset:offset + chunkSize] = memoryview(data)[_CHUNK.size:]
+        self._frameReceived += chunkSize
+
+        if self._frameReceived >= size:
+            with self._condition:
+                if len(self._frames) == self._frames.maxlen:
+                    self.dropped += 1
+                self._frames.append((number, timestamp, self._frameView))
+                self._condition.notify()
+            self._frameNumber = None
+
+    def capture(self, output, format="jpeg", use_video_port=True):
+        width, height = self.resolution
+        buf = bytearray(_CAPTURE_ARGS.pack(width, height))
+        buf.extend(format.encode("ascii"))
+        data = self._rrpi.request(rrpi.CAMERA_CAPTURE, buf).result()
+
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                f.write(data)
+        else:
+            output.write(data)
 
     def start_preview(self):
         raise NotImplemented()
@@ -10,19 +10,54 @@
 #
 #################################################################################
 
+import collections
+import json
 import os
 import socket
+import struct
+import threading
+import time
+
+from concurrent.futures import Future
 
 SPI_COMMAND = 0b00100000
 SPI_CLOSE = SPI_COMMAND | 1
 SPI_OPEN = SPI_COMMAND | 2
 SPI_XFER = SPI_COMMAND | 3
+SPI_XFER_BATCH = SPI_COMMAND | 4
+SPI_XFER_DELTA = SPI_COMMAND | 5
 
 I2C_COMMAND = 0b01000000
+I2C_OPEN = I2C_COMMAND | 1
+I2C_CLOSE = I2C_COMMAND | 2
+I2C_WRITE_BYTE = I2C_COMMAND | 3
+I2C_READ_BYTE = I2C_COMMAND | 4
+I2C_WRITE_BYTE_DATA = I2C_COMMAND | 5
+I2C_READ_BYTE_DATA = I2C_COMMAND | 6
+I2C_WRITE_WORD_DATA = I2C_COMMAND | 7
+I2C_READ_WORD_DATA = I2C_COMMAND | 8
+I2C_WRITE_BLOCK_DATA = I2C_COMMAND | 9
+I2C_READ_BLOCK_DATA = I2C_COMMAND | 10
+I2C_WRITE_I2C_BLOCK_DATA = I2C_COMMAND | 11
+I2C_READ_I2C_BLOCK_DATA = I2C_COMMAND | 12
+I2C_READ_MANY = I2C_COMMAND | 13
 
 SERIAL_COMMAND = 0b01100000
 
 GPIO_COMMAND = 0b10000000
+GPIO_SETMODE = GPIO_COMMAND | 1
+GPIO_SETWARNINGS = GPIO_COMMAND | 2
+GPIO_SETUP = GPIO_COMMAND | 3
+GPIO_OUTPUT = GPIO_COMMAND | 4
+GPIO_INPUT = GPIO_COMMAND | 5
+GPIO_CLEANUP = GPIO_COMMAND | 6
+GPIO_ADD_EVENT_DETECT = GPIO_COMMAND | 7
+GPIO_REMOVE_EVENT_DETECT = GPIO_COMMAND | 8
+GPIO_EVENTS = GPIO_COMMAND | 9
+GPIO_EVENT_BATCHING = GPIO_COMMAND | 10
+GPIO_READ_BANK = GPIO_COMMAND | 11
+GPIO_WRITE_BANK = GPIO_COMMAND | 12
+GPIO_SEQUENCE = GPIO_COMMAND | 13
 
 NRF_COMMAND = 0b10100000
 NRF_INIT = NRF_COMMAND | 1
@@ -44,51 +79,912 @@ NRF_START_LISTENING = NRF_COMMAND | 16
 NRF_STOP_LISTENING = NRF_COMMAND | 17
 NRF_POOL_DATA = NRF_COMMAND | 18
 NRF_SEND_AND_RECEIVE = NRF_COMMAND | 19
+NRF_SUBSCRIBE = NRF_COMMAND | 20
+NRF_UNSUBSCRIBE = NRF_COMMAND | 21
+NRF_GET_RECEIVE_STATS = NRF_COMMAND | 22
+NRF_POLL_LIST = NRF_COMMAND | 23
+
+CAMERA_COMMAND = 0b11000000
+CAMERA_START_STREAM = CAMERA_COMMAND | 1
+CAMERA_STOP_STREAM = CAMERA_COMMAND | 2
+CAMERA_FRAME = CAMERA_COMMAND | 3
+CAMERA_CAPTURE = CAMERA_COMMAND | 4
+CAMERA_GET_STATS = CAMERA_COMMAND | 5
+
+RRPI_COMMAND = 0b11100000
+RRPI_CLOSE_CHANNEL = RRPI_COMMAND | 1
+RRPI_STATS = RRPI_COMMAND | 2
+RRPI_DATAGRAM_OPEN = RRPI_COMMAND | 3
+RRPI_SAMPLE_START = RRPI_COMMAND | 4
+RRPI_SAMPLE_STOP = RRPI_COMMAND | 5
+RRPI_SAMPLES = RRPI_COMMAND | 6
+RRPI_SESSION_OPEN = RRPI_COMMAND | 7
+RRPI_SESSION_RESUME = RRPI_COMMAND | 8
+
+# Every command is sent as a frame: fixed header followed by 'length' bytes of payload.
+# Server replies only to commands sent with FLAG_REPLY. Frames carry logical channel so
+# many device objects can share one connection, each with its own state on the server.
+REQUEST_HEADER = struct.Struct("<BBHHI")  # command, flags, channel, tag, length
+REPLY_HEADER = struct.Struct("<BBHHI")  # command, status, channel, tag, length
+
+MAX_CHANNELS = 65536
+
+# When RASPBERRY_IP is this machine, server's Unix socket is used instead of TCP if it
+# exists. RASPBERRY_SOCKET gives other path; set to empty string it turns this off.
+UNIX_SOCKET_PATH = "/tmp/rrpi-{port}.sock"
+LOCAL_ADDRESSES = ("localhost", "127.0.0.1", "::1", "0.0.0.0", "")
+
+# Commands sent without FLAG_REPLY are collected and written together: before any command
+# that expects reply, when COALESCE_LIMIT bytes are collected or at latest COALESCE_DELAY
+# seconds after the first of them.
+COALESCE_DELAY = 0.001
+COALESCE_LIMIT = 64 * 1024
+
+# Capture file starts with CAPTURE_MAGIC followed by records, each CAPTURE_RECORD and frame's payload
+CAPTURE_MAGIC = b"RRPICAP\x01"
+CAPTURE_RECORD = struct.Struct("<dHBBBHHI")  # timestamp, connection, direction, command, flags/status, channel, tag, length
+CAPTURE_REQUEST = 0
+CAPTURE_REPLY = 1
+
+# Commands can also be sent as UDP datagrams (see RRPi.sendDatagram): DATAGRAM_HEADER
+# followed by request frame. Server drops datagram older than the last one it took on
+# the same channel. Acknowledgement (reply) not received in DATAGRAM_ACK_TIMEOUT seconds
+# fails the command; nothing is retransmitted.
+DATAGRAM_HEADER = struct.Struct("<II")  # session token, sequence number within channel
+DATAGRAM_OPEN_REPLY = struct.Struct("<IH")  # session token, UDP port
+DATAGRAM_ACK_TIMEOUT = 0.5
+MAX_DATAGRAM_SIZE = 65507
+
+# Sampling jobs run on the Pi (see Channel.startSampling)
+SAMPLE_ARGS = struct.Struct("<BBBBIHHf")  # job, kind, bus, SPI device, period in us, samples per block, queued blocks, max latency
+SAMPLE_BLOCK = struct.Struct("<BIHI")  # job, number of first sample, sample count, ticks missed so far
+SAMPLE_TIMESTAMP = struct.Struct("<d")
+SAMPLE_STATS = struct.Struct("<IIII")  # samples, ticks missed, blocks sent, blocks dropped
+SAMPLE_SPI = 0
+SAMPLE_I2C = 1
+SAMPLE_QUEUE_BLOCKS = 64
+MAX_SAMPLE_JOBS = 256
+
+# Pipelined connection whose socket breaks connects again, for up to RECONNECT_TIMEOUT
+# seconds, and resumes its session: server keeps channels, with their device state, for a
+# while after disconnect. If the session is gone configuration commands recorded so far
+# (see CONFIG_COMMANDS) are sent again, in one batch. RASPBERRY_RESUME=0 turns it off.
+SESSION_OPEN_REPLY = struct.Struct("<16sf")  # token, grace period in seconds
+RECONNECT_TIMEOUT = 30.0
+RECONNECT_DELAY = 0.05
+RECONNECT_MAX_DELAY = 1.0
+
+# Commands which set device state up: command -> (slot, key length, set). Recorded command
+# replaces earlier one on the same channel with the same slot and the same first 'key length'
+# payload bytes. Command which does not set (close, remove...) forgets recorded ones whose
+# slot starts with its slot and key with its key; key length None means each payload byte
+# is a key, and no payload forgets all of them.
+CONFIG_COMMANDS = {
+    SPI_OPEN: ("spi", 0, True),
+    SPI_CLOSE: ("spi", 0, False),
+    I2C_OPEN: ("i2c", 0, True),
+    I2C_CLOSE: ("i2c", 0, False),
+    GPIO_SETWARNINGS: ("gpio.warnings", 0, True),
+    GPIO_SETMODE: ("gpio.mode", 0, True),
+    GPIO_SETUP: ("gpio.setup", 1, True),
+    GPIO_OUTPUT: ("gpio.output", 1, True),
+    GPIO_ADD_EVENT_DETECT: ("gpio.event", 1, True),
+    GPIO_REMOVE_EVENT_DETECT: ("gpio.event", 1, False),
+    GPIO_EVENT_BATCHING: ("gpio.batching", 0, True),
+    GPIO_CLEANUP: ("gpio.", None, False),
+    NRF_INIT: ("nrf", 0, True),
+    NRF_CLOSE: ("nrf", 0, False),
+    NRF_SET_READ_PIPE_ADR: ("nrf.read", 1, True),
+    NRF_SET_WRITE_PIPE_ADR: ("nrf.write", 0, True),
+    NRF_POWER_UP: ("nrf.power", 0, True),
+    NRF_POWER_DOWN: ("nrf.power", 0, True),
+    NRF_SWITCH_TX: ("nrf.mode", 0, True),
+    NRF_SWITCH_RX: ("nrf.mode", 0, True),
+    NRF_START_LISTENING: ("nrf.listen", 0, True),
+    NRF_STOP_LISTENING: ("nrf.listen", 0, True),
+    NRF_SUBSCRIBE: ("nrf.subscribe", 0, True),
+    NRF_UNSUBSCRIBE: ("nrf.subscribe", 0, False),
+    CAMERA_START_STREAM: ("camera", 0, True),
+    CAMERA_STOP_STREAM: ("camera", 0, False),
+    RRPI_SAMPLE_START: ("sample", 1, True),
+    RRPI_SAMPLE_STOP: ("sample", 1, False)
+}
+
+FLAG_REPLY = 1
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_PUSH = 2
+
+
+class RRPiError(IOError):
+    pass
+
+
+class Recorder:
+    # Writes every frame sent and received, on all connections of the process, to capture
+    # file which can be replayed later against simulated devices (see benchmark/replay.py)
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self._connections = 0
+
+    def forConnection(self):
+        with self._lock:
+            self._connections += 1
+            connection = self._connections
+
+        def record(direction, cmd, flags, channel, tag, data):
+            header = CAPTURE_RECORD.pack(time.time(), connection, direction, cmd, flags, channel, tag, len(data))
+            with self._lock:
+                if self._file.closed:
+                    return
+                self._file.write(header)
+                self._file.write(data)
+                self._file.flush()
+
+        return record
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+_recorder = None
+_recorderLock = threading.Lock()
+
+
+def recorder():
+    # Process wide recorder, when RASPBERRY_CAPTURE names capture file
+    global _recorder
+
+    with _recorderLock:
+        if _recorder is None and os.environ.get("RASPBERRY_CAPTURE", "") != "":
+            _recorder = Recorder(os.environ["RASPBERRY_CAPTURE"])
+        return _recorder
+
+
+def _isLocal(ip):
+    if ip in LOCAL_ADDRESSES or ip.startswith("127."):
+        return True
+    try:
+        return ip == socket.gethostname() or socket.gethostbyname(ip) == socket.gethostbyname(socket.gethostname())
+    except OSError:
+        return False
+
+
+def _connectLocal(ip, port):
+    # Returns socket connected to server's Unix socket, or None if server is not local or
+    # does not listen at one
+    path = os.environ.get("RASPBERRY_SOCKET", UNIX_SOCKET_PATH.format(port=port))
+    if path == "" or not hasattr(socket, "AF_UNIX") or not os.path.exists(path) or not _isLocal(ip):
+        return None
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return s
+    except OSError:
+        s.close()
+        return None
 
 
 class RRPi:
     _socket = None
+    _pipelined = False
+    _closed = False
+    _datagramSocket = None
 
-    def __init__(self):
-        port = 8789
-        ip = os.environ["RASPBERRY_IP"]
-        if "RASPBERRY_PORT" in os.environ:
-            port = int(os.environ["RASPBERRY_PORT"])
+    def __init__(self, pipelined=None, coalesce=None, resume=None, ip=None, port=None):
+        # ip and port of the Raspberry Pi default to RASPBERRY_IP and RASPBERRY_PORT
+        if ip is None:
+            ip = os.environ["RASPBERRY_IP"]
+        if port is None:
+            port = int(os.environ.get("RASPBERRY_PORT", "8789"))
+        self._ip = ip
+        self._port = int(port)
+
+        if pipelined is None:
+            pipelined = os.environ.get("RASPBERRY_PIPELINED", "0") not in ("", "0", "false", "False")
+
+        if coalesce is None:
+            coalesce = os.environ.get("RASPBERRY_COALESCE", "1") not in ("", "0", "false", "False")
+
+        if resume is None:
+            resume = os.environ.get("RASPBERRY_RESUME", "1") not in ("", "0", "false", "False")
+
+        self._socket = self._connect()
+
+        captureRecorder = recorder()
+        self._record = captureRecorder.forConnection() if captureRecorder is not None else None
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.connect((ip, port))
+        self._sendLock = threading.Lock()
+        self._coalesce = coalesce
+        self._outBuffer = bytearray()
+        self._flushCondition = threading.Condition(self._sendLock)
+        self._flusher = None
+        self._requestLock = threading.Lock()
+        self._replyHeader = bytearray(REPLY_HEADER.size)
+        self._replyHeaderView = memoryview(self._replyHeader)
+        self._pushHandlers = {}
+        self._pendingLock = threading.Lock()
+        self._pending = {}
+        self._nextTag = 0
+        self._channels = set()
+        self._nextChannel = 1
+        self._datagramLock = threading.Lock()
+        self._datagramToken = None
+        self._sequences = {}
+        self._datagramPending = {}
+        self._resume = resume and pipelined
+        self._config = collections.OrderedDict()
+        self._sessionToken = None
+        if pipelined:
+            self._startReader()
+        if self._resume:
+            self.request(RRPI_SESSION_OPEN).add_done_callback(self._sessionOpened)
+
+    def _connect(self):
+        s = _connectLocal(self._ip, self._port)
+        if s is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                # Frames are already coalesced here; Nagle would only hold them back waiting for ACK
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                s.connect((self._ip, self._port))
+            except OSError:
+                s.close()
+                raise
+        return s
+
+    def _startReader(self):
+        # Once reader thread is started all replies, and pushed frames, are read by it
+        with self._requestLock:
+            if not self._pipelined:
+                self._pipelined = True
+                self._reader = threading.Thread(target=self._readReplies)
+                self._reader.daemon = True
+                self._reader.start()
 
     def close(self):
+        with self._sendLock:
+            self._closed = True
+            self._flushCondition.notify()
+            try:
+                self._flush()
+            except OSError:
+                pass
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._socket.close()
+        if self._datagramSocket is not None:
+            self._datagramSocket.close()
 
-    def send(self, data):
-        self._socket.send(data)
+    def openChannel(self):
+        # Allocates new logical channel on this connection. Channel 0 is used by
+        # RRPi's own send/request methods and is never handed out.
+        with self._pendingLock:
+            if len(self._channels) >= MAX_CHANNELS - 1:
+                raise RRPiError("No free channels")
+            channel = self._nextChannel
+            while channel == 0 or channel in self._channels:
+                channel = (channel + 1) % MAX_CHANNELS
+            self._nextChannel = (channel + 1) % MAX_CHANNELS
+            self._channels.add(channel)
 
-    def sendInt(self, value):
-        buf = bytearray()
-        buf.append(value)
-        self._socket.send(buf)
+        return Channel(self, channel)
 
-    def recv(self, len):
-        return self._socket.recv(len)
+    def stats(self):
+        # Server's statistics: per command counters and queue/driver/network time
+        # histograms (see Stats in rrpi-server.py) and per session totals
+        return self.request(RRPI_STATS, b"", lambda data: json.loads(bytes(data).decode("utf-8"))).result()
 
-    def recvBool(self):
-        return False if ord(self._socket.recv(1)) == 0 else True
+    def _closeChannel(self, channel):
+        for key in [key for key in self._pushHandlers if key[0] == channel]:
+            del self._pushHandlers[key]
+        try:
+            self.send(RRPI_CLOSE_CHANNEL, channel=channel)
+        except OSError:
+            pass  # connection is gone and channel with it
+        with self._pendingLock:
+            self._channels.discard(channel)
+        with self._sendLock:
+            for key in [key for key in self._config if key[0] == channel]:
+                del self._config[key]
 
-    def recvInt(self):
-        return ord(self._socket.recv(1))
+    def _recordConfig(self, cmd, channel, payload):
+        # Called with _sendLock held
+        slot, keyLength, sets = CONFIG_COMMANDS[cmd]
+        if sets:
+            key = bytes(payload[:keyLength])
+            self._config[(channel, slot, key)] = REQUEST_HEADER.pack(cmd, 0, channel, 0, len(payload)) + bytes(payload)
+            return
 
+        keys = [bytes(payload[:keyLength])] if keyLength is not None else [bytes([b]) for b in payload] or [b""]
+        for recorded in [recorded for recorded in self._config
+                         if recorded[0] == channel and recorded[1].startswith(slot) and any(recorded[2].startswith(key) for key in keys)]:
+            del self._config[recorded]
 
-def intArrayToBuffer(array, buf):
-    for b in  array:
-        buf.append(b)
+    def send(self, cmd, payload=b"", flags=0, tag=0, channel=0):
+        if self._record is not None:
+            self._record(CAPTURE_REQUEST, cmd, flags, channel, tag, payload)
+
+        with self._sendLock:
+            if self._resume and cmd in CONFIG_COMMANDS:
+                self._recordConfig(cmd, channel, payload)
+            buffer = self._outBuffer
+            wasEmpty = len(buffer) == 0
+            buffer += REQUEST_HEADER.pack(cmd, flags, channel, tag, len(payload))
+            buffer += payload
+            if flags & FLAG_REPLY or not self._coalesce or len(buffer) >= COALESCE_LIMIT:
+                self._flush()
+            elif wasEmpty:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flushLater)
+                    self._flusher.daemon = True
+                    self._flusher.start()
+                self._flushCondition.notify()
+
+    def flush(self):
+        # Writes out commands collected so far without waiting for COALESCE_DELAY
+        with self._sendLock:
+            self._flush()
+
+    def _flush(self):
+        if len(self._outBuffer) > 0:
+            try:
+                self._socket.sendall(self._outBuffer)
+            except OSError:
+                if self._resume and not self._closed:
+                    return  # kept for reader thread to send once it has connected again
+                self._outBuffer.clear()
+                raise
+            self._outBuffer.clear()
+
+    def _flushLater(self):
+        with self._sendLock:
+            while not self._closed:
+                if len(self._outBuffer) == 0:
+                    self._flushCondition.wait()
+                    continue
+
+                self._flushCondition.wait(COALESCE_DELAY)
+                try:
+                    self._flush()
+                except OSError:
+                    return
+
+    def openDatagrams(self):
+        # Gets session token from the server and opens UDP socket sendDatagram uses.
+        # Fails with RRPiError if server is not started with --udp-port.
+        with self._datagramLock:
+            if self._datagramSocket is not None:
+                return
+
+        token, port = self.request(RRPI_DATAGRAM_OPEN, b"", DATAGRAM_OPEN_REPLY.unpack).result()
+
+        with self._datagramLock:
+            if self._datagramSocket is None:
+                datagramSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                datagramSocket.connect((self._ip, port))
+                datagramSocket.settimeout(DATAGRAM_ACK_TIMEOUT / 4)
+                self._datagramToken = token
+                self._datagramSocket = datagramSocket
+                self._datagramReader = threading.Thread(target=self._readDatagrams)
+                self._datagramReader.daemon = True
+                self._datagramReader.start()
+
+    def sendDatagram(self, cmd, payload=b"", ack=False, convert=None, channel=0):
+        # Sends command as UDP datagram. It can overtake commands sent before it over TCP
+        # (those are flushed first, but not waited for) and it is dropped by the server if
+        # a later datagram on the same channel got there first. With ack returns Future
+        # completed with the reply or failed if no reply comes in DATAGRAM_ACK_TIMEOUT.
+        if self._datagramSocket is None:
+            self.openDatagrams()
+        self.flush()
+
+        flags = FLAG_REPLY if ack else 0
+        future = Future() if ack else None
+        with self._datagramLock:
+            sequence = (self._sequences.get(channel, 0) + 1) & 0xFFFFFFFF
+            self._sequences[channel] = sequence
+            if ack:
+                self._datagramPending[(channel, sequence)] = (future, convert, time.monotonic() + DATAGRAM_ACK_TIMEOUT)
+
+        datagram = DATAGRAM_HEADER.pack(self._datagramToken, sequence) + REQUEST_HEADER.pack(cmd, flags, channel, sequence & 0xFFFF, len(payload)) + payload
+        if self._resume and cmd in CONFIG_COMMANDS:
+            with self._sendLock:
+                self._recordConfig(cmd, channel, payload)
+        if self._record is not None:
+            self._record(CAPTURE_REQUEST, cmd, flags, channel, sequence & 0xFFFF, payload)
+        try:
+            self._datagramSocket.send(datagram)
+        except OSError as e:
+            if ack:
+                with self._datagramLock:
+                    del self._datagramPending[(channel, sequence)]
+                future.set_exception(e)
+
+        return future
+
+    def _closeDatagrams(self):
+        # Datagram token is only good for the session it was given in; next sendDatagram
+        # opens datagrams again
+        with self._datagramLock:
+            datagramSocket = self._datagramSocket
+            self._datagramSocket = None
+        if datagramSocket is not None:
+            datagramSocket.close()
+
+    def _readDatagrams(self):
+        datagramSocket = self._datagramSocket
+        buffer = bytearray(MAX_DATAGRAM_SIZE)
+        start = DATAGRAM_HEADER.size + REPLY_HEADER.size
+        while not self._closed and self._datagramSocket is datagramSocket:
+            try:
+                size = datagramSocket.recv_into(buffer)
+            except socket.timeout:
+                size = 0
+            except OSError:
+                if self._closed or self._datagramSocket is not datagramSocket:
+                    break
+                size = 0  # ICMP port unreachable reported for earlier datagram
+
+            if size >= start:
+                token, sequence = DATAGRAM_HEADER.unpack_from(buffer)
+                cmd, status, channel, tag, length = REPLY_HEADER.unpack_from(buffer, DATAGRAM_HEADER.size)
+                with self._datagramLock:
+                    pending = self._datagramPending.pop((channel, sequence), None)
+                if pending is not None and token == self._datagramToken:
+                    data = bytearray(buffer[start:start + length])
+                    if self._record is not None:
+                        self._record(CAPTURE_REPLY, cmd, status, channel, tag, data)
+                    self._complete(pending[0], status, data, pending[1])
+
+            now = time.monotonic()
+            with self._datagramLock:
+                expired = [key for key, pending in self._datagramPending.items() if pending[2] <= now]
+                expired = [self._datagramPending.pop(key)[0] for key in expired]
+            for future in expired:
+                future.set_exception(RRPiError("Datagram not acknowledged"))
+
+        with self._datagramLock:
+            pending = self._datagramPending
+            self._datagramPending = {}
+        for future, convert, deadline in pending.values():
+            future.set_exception(RRPiError("Connection closed"))
+
+    def subscribe(self, cmd, handler, channel=0):
+        # Registers handler(payload) for frames server pushes for given command
+        self._pushHandlers[(channel, cmd)] = handler
+        self._startReader()
+
+    def unsubscribe(self, cmd, channel=0):
+        if (channel, cmd) in self._pushHandlers:
+            del self._pushHandlers[(channel, cmd)]
+
+    def request(self, cmd, payload=b"", convert=None, channel=0):
+        # Sends command which expects reply and returns Future with the reply's payload.
+        # In pipelined mode the call does not wait - reader thread completes the future.
+        future = Future()
+        with self._requestLock:
+            if not self._pipelined:
+                self.send(cmd, payload, FLAG_REPLY, channel=channel)
+                replyCmd, status, replyChannel, tag, data = self._readReply()
+                self._complete(future, status, data, convert)
+                return future
+
+        tag = self._addPending(future, convert)
+        try:
+            self.send(cmd, payload, FLAG_REPLY, tag, channel)
+        except Exception as e:
+            with self._pendingLock:
+                del self._pending[tag]
+            future.set_exception(e)
 
+        return future
+
+    def _addPending(self, future, convert):
+        with self._pendingLock:
+            tag = self._nextTag
+            while tag in self._pending:
+                tag = (tag + 1) & 0xFFFF
+            self._nextTag = (tag + 1) & 0xFFFF
+            self._pending[tag] = (future, convert)
+        return tag
+
+    def _complete(self, future, status, data, convert):
+        if status != STATUS_OK:
+            future.set_exception(RRPiError(bytes(data).decode("utf-8", "replace")))
+        else:
+            try:
+                future.set_result(convert(data) if convert is not None else data)
+            except Exception as e:
+                future.set_exception(e)
+
+    def _recvInto(self, view, size, s=None):
+        s = s or self._socket
+        received = 0
+        while received < size:
+            n = s.recv_into(view[received:size], size - received)
+            if n == 0:
+                raise ConnectionResetError("Connection closed")
+            received += n
+
+    def _readReply(self, s=None):
+        self._recvInto(self._replyHeaderView, REPLY_HEADER.size, s)
+        cmd, status, channel, tag, length = REPLY_HEADER.unpack(self._replyHeader)
+        data = bytearray(length)
+        self._recvInto(memoryview(data), length, s)
+        if self._record is not None:
+            self._record(CAPTURE_REPLY, cmd, status, channel, tag, data)
+        return cmd, status, channel, tag, data
+
+    def _push(self, cmd, channel, data):
+        handler = self._pushHandlers.get((channel, cmd))
+        if handler is not None:
+            try:
+                handler(data)
+            except Exception as e:
+                print("Push handler for command " + str(cmd) + " failed; " + str(e))
+
+    def _failPending(self, e):
+        with self._pendingLock:
+            pending = self._pending
+            self._pending = {}
+        for future, convert in pending.values():
+            future.set_exception(e)
+
+    def _readReplies(self):
+        while True:
+            try:
+                while True:
+                    cmd, status, channel, tag, data = self._readReply()
+                    if status == STATUS_PUSH:
+                        self._push(cmd, channel, data)
+                        continue
+
+                    with self._pendingLock:
+                        # Request failed by reconnect could have been run, and answered, once resumed
+                        future, convert = self._pending.pop(tag, (None, None))
+                    if future is not None:
+                        self._complete(future, status, data, convert)
+            except Exception as e:
+                if self._closed or not self._resume or not self._reconnect():
+                    self._closed = True
+                    self._failPending(e)
+                    return
+
+    def _sessionOpened(self, future):
+        # Server without sessions, or with them turned off, fails RRPI_SESSION_OPEN; then
+        # only replay of recorded configuration is left
+        self._sessionToken = SESSION_OPEN_REPLY.unpack(future.result())[0] if future.exception() is None else None
+
+    def _resumeSession(self, s):
+        # Returns True if session was resumed on new socket s. Frames server pushes for the
+        # session's channels can come before the reply.
+        token = self._sessionToken
+        if token is None:
+            return False
+
+        s.sendall(REQUEST_HEADER.pack(RRPI_SESSION_RESUME, FLAG_REPLY, 0, 0, len(token)) + token)
+        while True:
+            cmd, status, channel, tag, data = self._readReply(s)
+            if status == STATUS_PUSH:
+                self._push(cmd, channel, data)
+            elif cmd == RRPI_SESSION_RESUME:
+                return status == STATUS_OK
+
+    def _unsentFrames(self):
+        # Frames of _outBuffer less requests whose futures are no longer pending: those were
+        # failed when connection was lost and must not run on the Pi after the caller was told so
+        frames = bytearray()
+        with self._pendingLock, memoryview(self._outBuffer) as view:
+            offset = 0
+            while offset < len(view):
+                cmd, flags, channel, tag, length = REQUEST_HEADER.unpack_from(view, offset)
+                end = offset + REQUEST_HEADER.size + length
+                if not flags & FLAG_REPLY or tag in self._pending:
+                    frames += view[offset:end]
+                offset = end
+        return frames
+
+    def _reconnect(self):
+        # Called by reader thread when socket breaks. Requests in flight fail as their replies
+        # could be lost, and those not sent yet are dropped; other frames sent meanwhile, and
+        # requests made after the break, are kept until new socket is ready. Returns False
+        # if server could not be reached in RECONNECT_TIMEOUT.
+        self._failPending(RRPiError("Connection lost"))
+        self._socket.close()
+        deadline = time.monotonic() + RECONNECT_TIMEOUT
+        delay = RECONNECT_DELAY
+        while not self._closed:
+            s = None
+            try:
+                s = self._connect()
+                resumed = self._resumeSession(s)
+                with self._sendLock:
+                    if self._closed:
+                        s.close()
+                        break
+                    batch = bytearray()
+                    if not resumed:
+                        # Configuration goes first, in one batch, then new session token is asked for
+                        batch = batch.join(self._config.values())
+                        future = Future()
+                        future.add_done_callback(self._sessionOpened)
+                        batch += REQUEST_HEADER.pack(RRPI_SESSION_OPEN, FLAG_REPLY, 0, self._addPending(future, None), 0)
+                        self._closeDatagrams()
+                    batch += self._unsentFrames()
+                    s.sendall(batch)
+                    self._outBuffer.clear()
+                    self._socket = s
+                    return True
+            except OSError:
+                if s is not None:
+                    s.close()
+            if time.monotonic() + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        return False
+
+
+class Sampler:
+    # Samples of periodic job run on the Pi (see Channel.startSampling). Blocks pushed by
+    # the server are split to (timestamp, data) samples which are kept for next() or, with
+    # callback, passed to it from sampler's own thread - up to capacity, dropping the oldest.
+
+    def __init__(self, channel, job, sampleSize, callback, capacity):
+        self.received = 0
+        self.missed = 0
+        self.localDropped = 0
+        self._channel = channel
+        self._job = job
+        self._sampleSize = sampleSize
+        self._callback = callback
+        self._samples = collections.deque(maxlen=capacity)
+        self._condition = threading.Condition()
+        self._stopped = False
+        if callback is not None:
+            dispatcher = threading.Thread(target=self._dispatchSamples)
+            dispatcher.daemon = True
+            dispatcher.start()
+
+    def _receive(self, data):
+        job, first, count, missed = SAMPLE_BLOCK.unpack_from(data)
+        step = SAMPLE_TIMESTAMP.size + self._sampleSize
+        samples = []
+        for offset in range(SAMPLE_BLOCK.size, SAMPLE_BLOCK.size + count * step, step):
+            samples.append((SAMPLE_TIMESTAMP.unpack_from(data, offset)[0], bytes(data[offset + SAMPLE_TIMESTAMP.size:offset + step])))
+
+        with self._condition:
+            self.received += count
+            self.missed = missed
+            overflow = len(samples) + len(self._samples) - self._samples.maxlen
+            if overflow > 0:
+                self.localDropped += overflow
+            self._samples.extend(samples)
+            self._condition.notify_all()
+
+    def _close(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _dispatchSamples(self):
+        # Runs callback outside of connection's reader thread; exits once stopped and drained
+        while True:
+            with self._condition:
+                while len(self._samples) == 0 and not self._stopped:
+                    self._condition.wait()
+                if len(self._samples) == 0:
+                    return
+                timestamp, sample = self._samples.popleft()
+            try:
+                self._callback(timestamp, sample)
+            except Exception as e:
+                print("Sampler callback failed; " + str(e))
+
+    def next(self, timeout=None):
+        with self._condition:
+            if len(self._samples) == 0:
+                self._condition.wait(timeout)
+            if len(self._samples) == 0:
+                return None
+            return self._samples.popleft()
+
+    def stop(self):
+        # Stops the job and returns its statistics; samples still queued can be read after
+        try:
+            samples, missed, sent, dropped = self._channel._stopSampling(self._job)
+        finally:
+            self._close()
+        with self._condition:
+            return {
+                "samples": samples,
+                "missed": missed,
+                "blocksSent": sent,
+                "blocksDropped": dropped,
+                "received": self.received,
+                "localDropped": self.localDropped
+            }
+
+
+class Channel:
+    # Logical channel of a connection. Has the same send/request/subscribe methods as
+    # RRPi so device libraries do not care if the connection is shared or their own.
+
+    def __init__(self, connection, channel, owned=False):
+        self._connection = connection
+        self._channel = channel
+        self._owned = owned
+        self._samplers = {}
+
+    def send(self, cmd, payload=b"", flags=0, tag=0):
+        self._connection.send(cmd, payload, flags, tag, self._channel)
+
+    def request(self, cmd, payload=b"", convert=None):
+        return self._connection.request(cmd, payload, convert, self._channel)
+
+    def sendDatagram(self, cmd, payload=b"", ack=False, convert=None):
+        return self._connection.sendDatagram(cmd, payload, ack, convert, self._channel)
+
+    def subscribe(self, cmd, handler):
+        self._connection.subscribe(cmd, handler, self._channel)
+
+    def unsubscribe(self, cmd):
+        self._connection.unsubscribe(cmd, self._channel)
+
+    def flush(self):
+        self._connection.flush()
+
+    def stats(self):
+        return self._connection.stats()
+
+    def startSampling(self, kind, bus, device, payload, sampleSize, periodUs, callback=None, capacity=4096,
+                      blockSamples=None, maxLatency=0.01):
+        # Starts job on the Pi which every periodUs microseconds does SPI transfers (payload as
+        # for SPI_XFER_BATCH) or I2C reads (payload as for I2C_READ_MANY) yielding sampleSize
+        # bytes. Samples are sent in blocks, by default as many as are taken in maxLatency.
+        if blockSamples is None:
+            blockSamples = int(maxLatency * 1000000 / periodUs)
+        blockSamples = max(1, min(blockSamples, 0xFFFF))
+
+        if len(self._samplers) == 0:
+            self.subscribe(RRPI_SAMPLES, self._receiveSamples)
+        job = 0
+        while job in self._samplers:
+            job += 1
+        if job >= MAX_SAMPLE_JOBS:
+            raise RRPiError("No free sampling jobs")
+
+        sampler = Sampler(self, job, sampleSize, callback, capacity)
+        self._samplers[job] = sampler
+        try:
+            self.request(RRPI_SAMPLE_START, SAMPLE_ARGS.pack(job, kind, bus, device, periodUs, blockSamples, SAMPLE_QUEUE_BLOCKS, maxLatency) + payload).result()
+        except Exception:
+            sampler._close()
+            del self._samplers[job]
+            if len(self._samplers) == 0:
+                self.unsubscribe(RRPI_SAMPLES)
+            raise
+        return sampler
+
+    def _stopSampling(self, job):
+        try:
+            return self.request(RRPI_SAMPLE_STOP, bytes([job]), SAMPLE_STATS.unpack).result()
+        finally:
+            # Blocks the server pushed before it stopped came before the reply
+            del self._samplers[job]
+            if len(self._samplers) == 0:
+                self.unsubscribe(RRPI_SAMPLES)
+
+    def _receiveSamples(self, data):
+        sampler = self._samplers.get(data[0])
+        if sampler is not None:
+            sampler._receive(data)
+
+    def close(self):
+        if self._connection is None:
+            return
+        connection = self._connection
+        self._connection = None
+        if self._owned:
+            connection.close()
+        else:
+            connection._closeChannel(self._channel)
+
+
+_connections = {}
+_connectionsLock = threading.Lock()
+
+
+def connection(ip=None, port=None):
+    # Returns pipelined connection shared by all device objects of this process talking
+    # to the same Raspberry Pi (RASPBERRY_IP/RASPBERRY_PORT unless given). Connection that
+    # got closed (or broken) is replaced by new one.
+    if ip is None:
+        ip = os.environ["RASPBERRY_IP"]
+    if port is None:
+        port = os.environ.get("RASPBERRY_PORT", "8789")
+    key = (ip, int(port))
+    with _connectionsLock:
+        con = _connections.get(key)
+        if con is None or con._closed:
+            con = RRPi(pipelined=True, ip=ip, port=port)
+            _connections[key] = con
+        return con
+
+
+def openChannel(ip=None, port=None):
+    # Each device object gets its own channel on the shared connection. With
+    # RASPBERRY_SHARED=0 it gets a connection of its own instead.
+    if os.environ.get("RASPBERRY_SHARED", "1") in ("", "0", "false", "False"):
+        return Channel(RRPi(ip=ip, port=port), 0, owned=True)
+
+    return connection(ip, port).openChannel()
+
+
+def toBool(data):
+    return data[0] != 0
+
+
+# Payloads can be given as lists (or other sequences) of ints or as anything with buffer
+# protocol and byte sized items - bytes, bytearray, memoryview, array('B'), NumPy uint8
+# arrays. Neither is converted element by element in Python.
+
+def toBuffer(data):
+    # Returns data itself, as flat view of bytes, when it can be sent as is, otherwise
+    # bytearray with its values. Length of what is returned is always its size in bytes.
+    try:
+        view = memoryview(data)
+    except TypeError:
+        return bytearray(data)
+    if view.itemsize != 1:
+        values = view.tolist()
+        for i in range(1, view.ndim):
+            values = [value for row in values for value in row]
+        return bytearray(values)
+    return view.cast("B") if view.c_contiguous else view.tobytes()
+
+
+def intArrayToBuffer(array, buf):
+    buf += toBuffer(array)
     return buf
 
 
 def bytesToIntArray(bb):
-    res = []
-    for b in bb:
-        res.append(int(b))
+    return list(bb)
+
+
+def toNumpy(data):
+    import numpy
+    return numpy.frombuffer(data, dtype=numpy.uint8)
+
+
+# Forms replies with data can be returned in. Reply payload is a bytearray of its own, so
+# "bytearray" and "memoryview" cost no copy; "numpy" needs NumPy and does not copy either.
+OUTPUTS = {
+    "list": list,
+    "bytes": bytes,
+    "bytearray": None,
+    "memoryview": memoryview,
+    "numpy": toNumpy
+}
+
+
+def outputConverter(output):
+    if output not in OUTPUTS:
+        raise ValueError("Unknown output " + str(output) + "; expected one of " + ", ".join(OUTPUTS))
+    return OUTPUTS[output]
+
 
-    return res
+def convertOutput(data, output):
+    convert = outputConverter(output)
+    return convert(data) if convert is not None else data
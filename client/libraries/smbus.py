@@ -10,32 +10,210 @@
 #
 #################################################################################
 
+import rrpi
+import struct
+
+_WORD = struct.Struct("<H")
 
 
 class SMBus:
+
+    _rrpi = None
+
     def __init__(self, busNo):
-        raise NotImplemented()
+        self._rrpi = rrpi.openChannel()
+        self._busNo = busNo
+        self._cache = {}
+        self._volatile = {}
+
+        b = bytearray()
+        b.append(busNo)
+        self._rrpi.send(rrpi.I2C_OPEN, b)
+
+    def __del__(self):
+        if self._rrpi is not None:
+            self._rrpi.close()
+
+    def close(self):
+        self._rrpi.send(rrpi.I2C_CLOSE)
+
+    # Register cache. Once enabled for a device, registers read from it are remembered and
+    # further reads of them are answered locally. Registers listed as volatile (status,
+    # data, counters...) are always read from the device. Writes through this object update
+    # cached values once the device acknowledged them, so writes to such devices wait for reply.
+
+    def enable_cache(self, i2cAddress, volatile=()):
+        self._volatile[i2cAddress] = set(volatile)
+        self._cache[i2cAddress] = {}
+
+    def disable_cache(self, i2cAddress):
+        if i2cAddress in self._cache:
+            del self._cache[i2cAddress]
+            del self._volatile[i2cAddress]
+
+    def invalidate_cache(self, i2cAddress=None):
+        if i2cAddress is None:
+            for registers in self._cache.values():
+                registers.clear()
+        elif i2cAddress in self._cache:
+            self._cache[i2cAddress].clear()
+
+    def _cached(self, i2cAddress, localAddress, count):
+        registers = self._cache.get(i2cAddress)
+        if registers is None:
+            return None
+
+        volatile = self._volatile[i2cAddress]
+        res = []
+        for register in range(localAddress, localAddress + count):
+            if register in volatile or register not in registers:
+                return None
+            res.append(registers[register])
+        return res
+
+    def _write(self, cmd, b, i2cAddress, localAddress, data):
+        # Writes to devices with cache enabled wait for the write to be acknowledged before
+        # cached registers are updated; if it fails they are forgotten and the error raised
+        if i2cAddress not in self._cache:
+            self._rrpi.send(cmd, b)
+            return
+
+        try:
+            self._rrpi.request(cmd, b).result()
+        except Exception:
+            registers = self._cache.get(i2cAddress)
+            if registers is not None:
+                for register in range(localAddress, localAddress + len(data)):
+                    registers.pop(register, None)
+            raise
+        self._store(i2cAddress, localAddress, data)
+
+    def _store(self, i2cAddress, localAddress, data):
+        registers = self._cache.get(i2cAddress)
+        if registers is not None:
+            volatile = self._volatile[i2cAddress]
+            register = localAddress
+            for value in data:
+                if register not in volatile:
+                    registers[register] = value
+                register += 1
 
     def write_byte(self, i2cAddress, byte):
-        raise NotImplemented()
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(byte)
+        self._rrpi.send(rrpi.I2C_WRITE_BYTE, b)
 
     def write_byte_data(self, i2cAddress, localAddress, data):
-        raise NotImplemented()
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        b.append(data)
+        self._write(rrpi.I2C_WRITE_BYTE_DATA, b, i2cAddress, localAddress, [data])
+
+    def write_word_data(self, i2cAddress, localAddress, data):
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        b.extend(_WORD.pack(data))
+        self._write(rrpi.I2C_WRITE_WORD_DATA, b, i2cAddress, localAddress, [data & 255, data >> 8 & 255])
 
     def write_block_data(self, i2cAddress, localAddress, dataArray):
-        raise NotImplemented()
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        self._rrpi.send(rrpi.I2C_WRITE_BLOCK_DATA, rrpi.intArrayToBuffer(dataArray, b))
+        # SMBus block write semantics are device specific - forget what we know about the device
+        self.invalidate_cache(i2cAddress)
 
     def read_byte(self, i2cAddress):
-        raise NotImplemented()
+        b = bytearray()
+        b.append(i2cAddress)
+        return self._rrpi.request(rrpi.I2C_READ_BYTE, b).result()[0]
 
     def read_byte_data(self, i2cAddress, localAddress):
-        raise NotImplemented()
+        cached = self._cached(i2cAddress, localAddress, 1)
+        if cached is not None:
+            return cached[0]
+
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        value = self._rrpi.request(rrpi.I2C_READ_BYTE_DATA, b).result()[0]
+        self._store(i2cAddress, localAddress, [value])
+        return value
+
+    def read_word_data(self, i2cAddress, localAddress):
+        cached = self._cached(i2cAddress, localAddress, 2)
+        if cached is not None:
+            return cached[0] | cached[1] << 8
+
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        value = self._rrpi.request(rrpi.I2C_READ_WORD_DATA, b).result()
+        self._store(i2cAddress, localAddress, value)
+        return _WORD.unpack(value)[0]
 
-    def read_block_data(self, i2cAddress, localAddress):
-        raise NotImplemented()
+    def read_block_data(self, i2cAddress, localAddress, output="list"):
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        return self._rrpi.request(rrpi.I2C_READ_BLOCK_DATA, b, rrpi.outputConverter(output)).result()
 
     def write_i2c_block_data(self, i2cAddress, localAddress, data):
-        raise NotImplemented()
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        self._write(rrpi.I2C_WRITE_I2C_BLOCK_DATA, rrpi.intArrayToBuffer(data, b), i2cAddress, localAddress, data)
+
+    def read_i2c_block_data(self, i2cAddress, localAddress, count, output="list"):
+        # output is as for rrpi.convertOutput: "list" (default), "bytes", "bytearray", "memoryview", "numpy"
+        cached = self._cached(i2cAddress, localAddress, count)
+        if cached is not None:
+            return rrpi.convertOutput(bytearray(cached), output)
+
+        b = bytearray()
+        b.append(i2cAddress)
+        b.append(localAddress)
+        b.append(count)
+        data = self._rrpi.request(rrpi.I2C_READ_I2C_BLOCK_DATA, b).result()
+        self._store(i2cAddress, localAddress, data)
+        return rrpi.convertOutput(data, output)
+
+    def read_many(self, reads):
+        # Reads list of (i2cAddress, localAddress, count) in one round trip and returns
+        # list of results, one list of bytes for each read. Cached registers are not re-read.
+        res = [self._cached(i2cAddress, localAddress, count) for i2cAddress, localAddress, count in reads]
+
+        b = bytearray()
+        for i in range(len(reads)):
+            if res[i] is None:
+                i2cAddress, localAddress, count = reads[i]
+                b.append(i2cAddress)
+                b.append(localAddress)
+                b.append(count)
+
+        if len(b) > 0:
+            data = self._rrpi.request(rrpi.I2C_READ_MANY, b).result()
+            offset = 0
+            for i in range(len(reads)):
+                if res[i] is None:
+                    i2cAddress, localAddress, count = reads[i]
+                    res[i] = rrpi.bytesToIntArray(data[offset:offset + count])
+                    self._store(i2cAddress, localAddress, res[i])
+                    offset += count
+
+        return res
 
-    def read_i2c_block_data(self, i2cAddress, localAddress, count):
-        raise NotImplemented()
+    def start_sampling(self, reads, period_us, callback=None, capacity=4096, block_samples=None, max_latency=0.01):
+        # Does list of (i2cAddress, localAddress, count) reads on the Pi every period_us
+        # microseconds; returns rrpi.Sampler whose samples are (timestamp, bytes read).
+        # Register cache is not used.
+        b = bytearray()
+        for i2cAddress, localAddress, count in reads:
+            b.append(i2cAddress)
+            b.append(localAddress)
+            b.append(count)
+        return self._rrpi.startSampling(rrpi.SAMPLE_I2C, self._busNo, 0, b, sum(read[2] for read in reads),
+                                        period_us, callback, capacity, block_samples, max_latency)
@@ -11,9 +11,11 @@
 #################################################################################
 
 
-import os
 import rrpi
-import socket
+import struct
+import zlib
+
+from concurrent.futures import Future
 
 _SPI_CPHA = 0x01
 _SPI_CPOL = 0x02
@@ -31,6 +33,67 @@ _SPI_LOOP = 0x20
 _SPI_NO_CS = 0x40
 _SPI_READY = 0x80
 
+_LENGTH = struct.Struct("<H")
+_MAX_BATCH = 0xFFFF  # transfers in batch, and bytes in each of them, as their counts are sent in 16 bits
+
+_DELTA_ARGS = struct.Struct("<BHII")  # flags, region, CRC-32 of base frame, frame size
+_DELTA_SPAN = struct.Struct("<BII")  # kind, offset, length
+_DELTA_FULL = 1
+_SPAN_COPY = 0
+_SPAN_FILL = 1
+
+# Frames are compared in _DELTA_CHUNK byte chunks and, within changed chunks, in
+# _DELTA_BLOCK byte blocks. Spans of one repeated pattern of up to _FILL_PATTERNS bytes
+# (clears, solid rectangles) are sent as the pattern only.
+_DELTA_CHUNK = 1024
+_DELTA_BLOCK = 32
+_FILL_PATTERNS = (1, 2, 3, 4)
+
+
+def _packTransfers(transfers):
+    if len(transfers) > _MAX_BATCH:
+        raise ValueError("Batch of " + str(len(transfers)) + " transfers is longer than " + str(_MAX_BATCH))
+
+    b = bytearray(_LENGTH.pack(len(transfers)))
+    for data in transfers:
+        data = rrpi.toBuffer(data)
+        if len(data) > _MAX_BATCH:
+            raise ValueError("Transfer of " + str(len(data)) + " bytes in batch is longer than " + str(_MAX_BATCH))
+        b += _LENGTH.pack(len(data))
+        b += data
+    return b
+
+
+def _changedSpans(base, frame):
+    spans = []
+    for chunk in range(0, len(frame), _DELTA_CHUNK):
+        chunkEnd = chunk + _DELTA_CHUNK
+        if base[chunk:chunkEnd] == frame[chunk:chunkEnd]:
+            continue
+        for block in range(chunk, min(chunkEnd, len(frame)), _DELTA_BLOCK):
+            end = min(block + _DELTA_BLOCK, len(frame))
+            if base[block:end] != frame[block:end]:
+                # Blocks closer than a span header are sent as one span
+                if len(spans) > 0 and block - spans[-1][1] <= _DELTA_SPAN.size:
+                    spans[-1][1] = end
+                else:
+                    spans.append([block, end])
+    return spans
+
+
+def _encodeSpan(buf, frame, start, end):
+    data = frame[start:end]
+    if len(data) > 2 * _DELTA_SPAN.size:
+        for size in _FILL_PATTERNS:
+            pattern = data[:size]
+            if data == (pattern * (len(data) // size + 1))[:len(data)]:
+                buf.extend(_DELTA_SPAN.pack(_SPAN_FILL, start, len(data)))
+                buf.append(size)
+                buf.extend(pattern)
+                return
+    buf.extend(_DELTA_SPAN.pack(_SPAN_COPY, start, len(data)))
+    buf.extend(data)
+
 
 class SpiDev:
 
@@ -45,7 +108,10 @@ class SpiDev:
     # threewire = False
 
     def __init__(self):
-        self._rrpi = rrpi.RRPi()
+        self._rrpi = rrpi.openChannel()
+        self._frames = {}
+        self._bus = None
+        self._device = None
 
     def __del__(self):
         if self._rrpi is not None:
@@ -53,26 +119,84 @@ class SpiDev:
 
     def open(self, bus, device):
         b = bytearray()
-        b.append(rrpi.SPI_OPEN)
         b.append(bus)
         b.append(device)
-        self._rrpi.send(b)
-
-    def xfer(self, data, speed_hz=0, delay_usec=0, bits_per_word=8):
-        b = bytearray()
-        b.append(rrpi.SPI_XFER)
-        b.append(len(data) & 255)
-        b.append(len(data) >> 8 & 255)
-
-        self._rrpi.send(rrpi.intArrayToBuffer(data, b))
-
-        rec = self._rrpi.recv(len(data))
-
-        resp = []
-        for bb in rec:
-            resp.append(bb)
-
-        return resp
+        self._rrpi.send(rrpi.SPI_OPEN, b)
+        self._frames.clear()
+        self._bus = bus
+        self._device = device
+
+    # data can be list of ints or bytes-like object (see rrpi.toBuffer); output selects form
+    # of the result: "list" (default), "bytes", "bytearray", "memoryview" or "numpy"
+
+    def xfer(self, data, speed_hz=0, delay_usec=0, bits_per_word=8, output="list"):
+        return self.xfer_async(data, speed_hz, delay_usec, bits_per_word, output).result()
+
+    def xfer_async(self, data, speed_hz=0, delay_usec=0, bits_per_word=8, output="list"):
+        return self._rrpi.request(rrpi.SPI_XFER, rrpi.toBuffer(data), rrpi.outputConverter(output))
+
+    def xfer_batch(self, transfers, speed_hz=0, delay_usec=0, bits_per_word=8, output="list"):
+        return self.xfer_batch_async(transfers, speed_hz, delay_usec, bits_per_word, output).result()
+
+    def xfer_batch_async(self, transfers, speed_hz=0, delay_usec=0, bits_per_word=8, output="list"):
+        b = _packTransfers(transfers)
+        convert = rrpi.outputConverter(output) or bytearray
+
+        def split(rec):
+            view = memoryview(rec)
+            resp = []
+            offset = 0
+            for data in transfers:
+                resp.append(convert(view[offset:offset + len(data)]))
+                offset += len(data)
+            return resp
+
+        return self._rrpi.request(rrpi.SPI_XFER_BATCH, b, split)
+
+    def start_sampling(self, transfers, period_us, callback=None, capacity=4096, block_samples=None, max_latency=0.01):
+        # Runs transfers on the Pi every period_us microseconds, on this object's bus and
+        # device; returns rrpi.Sampler whose samples are (timestamp, bytes read by transfers).
+        # For MCP3008 channel 0 at 5 kHz: start_sampling([[1, 0x80, 0]], 200)
+        if self._bus is None:
+            raise IOError("SPI device is not open")
+        return self._rrpi.startSampling(rrpi.SAMPLE_SPI, self._bus, self._device, _packTransfers(transfers),
+                                        sum(len(data) for data in transfers), period_us, callback, capacity,
+                                        block_samples, max_latency)
+
+    # Framebuffer mode for displays: write_frame clocks out the whole frame, but sends
+    # only spans which differ from the previous frame written to the same region. If the
+    # server's frame is not the one this object wrote last (other client, server restart)
+    # the frame is sent in full. Data read back during the transfer is not returned.
+
+    def write_frame(self, data, region=0):
+        self.write_frame_async(data, region).result()
+
+    def write_frame_async(self, data, region=0):
+        frame = bytes(data)
+        base = self._frames.get(region)
+        self._frames[region] = (frame, zlib.crc32(frame))
+        if base is None or len(base[0]) != len(frame):
+            return self._writeFull(region, frame)
+
+        buf = bytearray(_DELTA_ARGS.pack(0, region, base[1], len(frame)))
+        for start, end in _changedSpans(base[0], frame):
+            _encodeSpan(buf, frame, start, end)
+
+        future = Future()
+
+        def done(delta):
+            if delta.exception() is None:
+                future.set_result(None)
+            else:
+                self._writeFull(region, frame).add_done_callback(lambda full: _copyResult(full, future))
+
+        self._rrpi.request(rrpi.SPI_XFER_DELTA, buf).add_done_callback(done)
+        return future
+
+    def _writeFull(self, region, frame):
+        buf = bytearray(_DELTA_ARGS.pack(_DELTA_FULL, region, 0, len(frame)))
+        _encodeSpan(buf, frame, 0, len(frame))
+        return self._rrpi.request(rrpi.SPI_XFER_DELTA, buf, lambda data: None)
 
     def xfer2(self, data, speed_hz=0, delay_usec=0, bits_per_word=8):
         pass
@@ -81,9 +205,7 @@ class SpiDev:
         self._mode = 0
         self._bits_per_word = 0
         self._max_speed_hz = 0
-        b = bytearray()
-        b.append(rrpi.SPI_CLOSE)
-        self._rrpi.send(b)
+        self._rrpi.send(rrpi.SPI_CLOSE)
 
     def readbytes(self, n):
         pass
@@ -162,59 +284,8 @@ class SpiDev:
         self._mode = (self._mode & ~(_SPI_CPHA | _SPI_CPOL)) | mode
 
 
-if __name__ == "__main__":
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(("0.0.0.0", 8789))
-    s.listen(1)
-
-
-    def startListen():
-        import threading
-
-        def session(con):
-            while True:
-                # print("Waiting to command")
-                cmd = ord(con.recv(1))
-                if cmd == ord("c"):
-                    print("Close")
-                elif cmd == ord("o"):
-                    bus = ord(con.recv(1))
-                    device = ord(con.recv(1))
-                    print("Opening " + str(bus) + "." + str(device))
-                elif cmd == ord("x"):
-                    low = ord(con.recv(1))
-                    high = ord(con.recv(1))
-                    size = low + high << 8
-                    print("Receiving " + str(size) + " bytes")
-                    data = con.recv(size)
-                    print("Received " + str(data))
-                    con.send(data)
-                else:
-                    print("Unknown command " + str(cmd))
-
-        def listen():
-            while True:
-                con, addr = s.accept()
-                t = threading.Thread(target=session, args=[con])
-                t.daemon = True
-                t.start()
-
-        thread = threading.Thread(target=listen)
-        thread.daemon = True
-        thread.start()
-
-    try:
-        startListen()
-
-        os.environ["RASPBERRY_IP"] = "127.0.0.1"
-
-        spi = SpiDev()
-        print("opening spi")
-        spi.open(1, 2)
-        print("sending data")
-        spi.xfer(b"Hello")
-        print("closing")
-        spi.close()
-    finally:
-        s.close()
-        s.detach()
+def _copyResult(source, target):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
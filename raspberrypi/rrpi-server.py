@@ -12,12 +12,44 @@
 #
 #################################################################################
 
+import argparse
+import asyncio
+import collections
+import http.server
+import importlib
+import importlib.util
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import nRF2401
+import os
+import signal
 import socket
 import spidev
 import struct
 import threading
+import time
 import traceback
+import zlib
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    import smbus
+except ImportError:
+    smbus = None
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+try:
+    import picamera
+except ImportError:
+    picamera = None
 
 VERBOSE = 2
 
@@ -25,12 +57,40 @@ SPI_COMMAND = 0b00100000
 SPI_CLOSE = SPI_COMMAND | 1
 SPI_OPEN = SPI_COMMAND | 2
 SPI_XFER = SPI_COMMAND | 3
+SPI_XFER_BATCH = SPI_COMMAND | 4
+SPI_XFER_DELTA = SPI_COMMAND | 5
 
 I2C_COMMAND = 0b01000000
+I2C_OPEN = I2C_COMMAND | 1
+I2C_CLOSE = I2C_COMMAND | 2
+I2C_WRITE_BYTE = I2C_COMMAND | 3
+I2C_READ_BYTE = I2C_COMMAND | 4
+I2C_WRITE_BYTE_DATA = I2C_COMMAND | 5
+I2C_READ_BYTE_DATA = I2C_COMMAND | 6
+I2C_WRITE_WORD_DATA = I2C_COMMAND | 7
+I2C_READ_WORD_DATA = I2C_COMMAND | 8
+I2C_WRITE_BLOCK_DATA = I2C_COMMAND | 9
+I2C_READ_BLOCK_DATA = I2C_COMMAND | 10
+I2C_WRITE_I2C_BLOCK_DATA = I2C_COMMAND | 11
+I2C_READ_I2C_BLOCK_DATA = I2C_COMMAND | 12
+I2C_READ_MANY = I2C_COMMAND | 13
 
 SERIAL_COMMAND = 0b01100000
 
 GPIO_COMMAND = 0b10000000
+GPIO_SETMODE = GPIO_COMMAND | 1
+GPIO_SETWARNINGS = GPIO_COMMAND | 2
+GPIO_SETUP = GPIO_COMMAND | 3
+GPIO_OUTPUT = GPIO_COMMAND | 4
+GPIO_INPUT = GPIO_COMMAND | 5
+GPIO_CLEANUP = GPIO_COMMAND | 6
+GPIO_ADD_EVENT_DETECT = GPIO_COMMAND | 7
+GPIO_REMOVE_EVENT_DETECT = GPIO_COMMAND | 8
+GPIO_EVENTS = GPIO_COMMAND | 9
+GPIO_EVENT_BATCHING = GPIO_COMMAND | 10
+GPIO_READ_BANK = GPIO_COMMAND | 11
+GPIO_WRITE_BANK = GPIO_COMMAND | 12
+GPIO_SEQUENCE = GPIO_COMMAND | 13
 
 NRF_COMMAND = 0b10100000
 NRF_INIT = NRF_COMMAND | 1
@@ -52,279 +112,2925 @@ NRF_START_LISTENING = NRF_COMMAND | 16
 NRF_STOP_LISTENING = NRF_COMMAND | 17
 NRF_POOL_DATA = NRF_COMMAND | 18
 NRF_SEND_AND_RECEIVE = NRF_COMMAND | 19
+NRF_SUBSCRIBE = NRF_COMMAND | 20
+NRF_UNSUBSCRIBE = NRF_COMMAND | 21
+NRF_GET_RECEIVE_STATS = NRF_COMMAND | 22
+NRF_POLL_LIST = NRF_COMMAND | 23
 
+CAMERA_COMMAND = 0b11000000
+CAMERA_START_STREAM = CAMERA_COMMAND | 1
+CAMERA_STOP_STREAM = CAMERA_COMMAND | 2
+CAMERA_FRAME = CAMERA_COMMAND | 3
+CAMERA_CAPTURE = CAMERA_COMMAND | 4
+CAMERA_GET_STATS = CAMERA_COMMAND | 5
 
-socketAddress = "0.0.0.0"
-port = 8789
+RRPI_COMMAND = 0b11100000
+RRPI_CLOSE_CHANNEL = RRPI_COMMAND | 1
+RRPI_STATS = RRPI_COMMAND | 2
+RRPI_DATAGRAM_OPEN = RRPI_COMMAND | 3
+RRPI_SAMPLE_START = RRPI_COMMAND | 4
+RRPI_SAMPLE_STOP = RRPI_COMMAND | 5
+RRPI_SAMPLES = RRPI_COMMAND | 6
+RRPI_SESSION_OPEN = RRPI_COMMAND | 7
+RRPI_SESSION_RESUME = RRPI_COMMAND | 8
 
-if VERBOSE > 2:
-    print("Setting up scoket at " + socketAddress + ":" + str(port))
+# Every command is sent as a frame: fixed header followed by 'length' bytes of payload.
+# Replies are sent only for commands with FLAG_REPLY set and carry command's tag back.
+# Each frame belongs to a logical channel; channels of a connection have separate device
+# state and are processed independently of each other.
+REQUEST_HEADER = struct.Struct("<BBHHI")  # command, flags, channel, tag, length
+REPLY_HEADER = struct.Struct("<BBHHI")  # command, status, channel, tag, length
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.bind(("0.0.0.0", 8789))
-s.listen(1)
+FLAG_REPLY = 1
 
-if VERBOSE > 1:
-    print("Listening at " + socketAddress + ":" + str(port))
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_PUSH = 2
 
+COMMAND_MASK = 0b11100000
 
-def intArrayToBuffer(array):
-    buf = bytearray()
-    for b in array:
-        buf.append(b)
+BYTE = struct.Struct("B")
+UINT16 = struct.Struct("<H")
+FLOAT = struct.Struct("<f")
+BUS_DEVICE = struct.Struct("BB")
+SPI_DELTA_ARGS = struct.Struct("<BHII")  # flags, region, CRC-32 of frame the spans apply to, frame size
+SPI_DELTA_SPAN = struct.Struct("<BII")  # kind, offset, length; then length bytes (copy) or pattern size byte and pattern (fill)
+NRF_INIT_ARGS = struct.Struct("BBB5sB")
+NRF_READ_PIPE_ARGS = struct.Struct("B5s")
+NRF_ADDRESS = struct.Struct("5s")
+I2C_ADDRESS = struct.Struct("B")
+I2C_ADDRESS_BYTE = struct.Struct("BB")
+I2C_ADDRESS_REGISTER_BYTE = struct.Struct("BBB")
+I2C_ADDRESS_REGISTER_WORD = struct.Struct("<BBH")
+I2C_WORD = struct.Struct("<H")
+I2C_READ_MANY_ENTRY = struct.Struct("BBB")  # address, register, count
+GPIO_PIN_VALUE = struct.Struct("BB")
+GPIO_SETUP_ARGS = struct.Struct("<BBBb")  # pin, direction, pull up/down, initial (-1 for none)
+GPIO_EVENT_DETECT_ARGS = struct.Struct("<BBH")  # pin, edge, bounce time in ms (0 for none)
+GPIO_EVENT_BATCHING_ARGS = struct.Struct("<Hf")  # max events in batch, max latency
+GPIO_EVENT = struct.Struct("<BBd")  # pin, level, timestamp
+GPIO_BANK = struct.Struct("<I")  # levels of BCM pins 0-27 as bits
+GPIO_BANK_WRITE = struct.Struct("<II")  # pins to set, pins to clear
+GPIO_SEQUENCE_STEP = struct.Struct("<II")  # pin values, microseconds to next step
+GPIO_SEQUENCE_RESULT = struct.Struct("<dd")  # duration, max lateness of a step
+CAMERA_STREAM_ARGS = struct.Struct("<HHBBB")  # width, height, framerate, queue depth, quality
+CAMERA_CAPTURE_ARGS = struct.Struct("<HH")  # width, height
+CAMERA_CHUNK = struct.Struct("<IIId")  # frame number, frame size, offset, timestamp
+CAMERA_STATS = struct.Struct("<IIII")  # captured, sent, dropped, queued
+SAMPLE_ARGS = struct.Struct("<BBBBIHHf")  # job, kind, bus, SPI device, period in us, samples per block, queued blocks, max latency
+SAMPLE_BLOCK = struct.Struct("<BIHI")  # job, number of first sample, sample count, ticks missed so far
+SAMPLE_TIMESTAMP = struct.Struct("<d")  # followed by sample's data
+SAMPLE_STATS = struct.Struct("<IIII")  # samples, ticks missed, blocks sent, blocks dropped
+NRF_SUBSCRIBE_ARGS = struct.Struct("<BHHf")  # packet size, ring capacity, batch size, max latency
+NRF_BATCH_HEADER = struct.Struct("<HI")  # packets in batch, overflows so far
+NRF_PACKET_HEADER = struct.Struct("<dB")  # timestamp, packet size
+NRF_RECEIVE_STATS = struct.Struct("<IIIIIHH")  # received, delivered, batches, overflows, dropped, queued, capacity
+NRF_POLL_ENTRY = struct.Struct("<5sfB")  # node address, reply timeout, payload size; then payload
+NRF_POLL_RESULT = struct.Struct("<BIB")  # status, round trip in microseconds, size; then reply (or error message)
+NRF_REPLIED = 0
+NRF_NO_REPLY = 1
+NRF_FAILED = 2
+
+NRF_POLL_TIMEOUT = 0.001
+NRF_SUBSCRIBER_QUEUE = 64  # batches waiting to be pushed to one subscriber
+
+SAMPLE_SPI = 0
+SAMPLE_I2C = 1
+SAMPLE_SPIN = 0.0002  # sleep is not precise enough for the last stretch before a tick; it is busy-waited
+
+SPI_DELTA_FULL = 1  # spans apply to zeroed frame, not to the last one
+SPI_SPAN_COPY = 0
+SPI_SPAN_FILL = 1
+
+CAMERA_CHUNK_SIZE = 64 * 1024
+CAMERA_FORMATS = ["mjpeg", "yuv", "rgb"]
+
+MAX_PAYLOAD_SIZE = 16 * 1024 * 1024
+
+SEND_TIMEOUT = 60
+
+CHANNEL_THREADS = 8
+
+# Clients on the Pi itself connect through this Unix socket, bypassing TCP/IP stack
+UNIX_SOCKET_PATH = "/tmp/rrpi-{port}.sock"
+UNIX_SOCKET_MODE = 0o666  # anyone on the Pi can connect, as anyone can over TCP
 
-    return buf
+# Capture file starts with CAPTURE_MAGIC followed by records, each CAPTURE_RECORD and frame's payload
+CAPTURE_MAGIC = b"RRPICAP\x01"
+CAPTURE_RECORD = struct.Struct("<dHBBBHHI")  # timestamp, connection, direction, command, flags/status, channel, tag, length
+CAPTURE_REQUEST = 0
+CAPTURE_REPLY = 1
+
+# UDP datagram is DATAGRAM_HEADER followed by one request frame (or, back, reply frame)
+DATAGRAM_HEADER = struct.Struct("<II")  # session token, sequence number within channel
+DATAGRAM_OPEN_REPLY = struct.Struct("<IH")  # session token, UDP port
+MAX_DATAGRAM_SIZE = 65507
+
+# Sessions (see Sessions) are identified by random token
+SESSION_TOKEN_SIZE = 16
+SESSION_OPEN_REPLY = struct.Struct("<16sf")  # token, grace period in seconds
+SESSION_GRACE = 30.0
+SESSION_TAKEOVER_TIMEOUT = 5.0
+
+# Worker processes (see Worker) get frames, and send replies and pushes back, through
+# SharedRing-s; a message is WORKER_REQUEST or WORKER_REPLY followed by the payload
+WORKER_GROUPS = {"spi": SPI_COMMAND, "i2c": I2C_COMMAND, "nrf": NRF_COMMAND, "camera": CAMERA_COMMAND}
+WORKER_REQUEST = struct.Struct("<BIIB")  # kind, request id, channel key, command
+WORKER_REPLY = struct.Struct("<BIIBB")  # kind, request id, channel key, command, status
+WORKER_FRAME = 0
+WORKER_CLOSE = 1
+WORKER_RESULT = 0
+WORKER_PUSH = 1
+WORKER_RING_SIZE = 4 * 1024 * 1024
+WORKER_CHUNK = struct.Struct("<I?xxx")  # length, more chunks of the message follow; chunks are 8 byte aligned
+WORKER_WRAP = 0xFFFFFFFF  # length marking the rest of the ring as unused; next chunk is at its start
+WORKER_WAIT = 0.0005  # writer polls for free space in the ring this often
+WORKER_POLL = 1.0  # readers check the other side is still alive this often
+WORKER_THREADS = 32
+WORKER_PUSH_QUEUE = 64  # pushes from a worker waiting to be sent to one channel's client
+
+# BusLock state, in a list or, shared by worker processes, in shared memory array
+BUS_CLAIMS = 0
+BUS_CONTENDED = 1
+BUS_WAIT_TIME = 2
+BUS_SHARED = 3
+BUS_EXCLUSIVE = 4
+BUS_NEXT_TICKET = 5
+BUS_GRANTED_TICKET = 6
+BUS_LOCK_FIELDS = 7
+SHARED_BUSES = 8  # SPI and I2C buses 0-7 get cross-process locks in worker process mode
+
+# Histogram bucket i counts durations shorter than 2**i microseconds (last one all longer)
+STATS_BUCKETS = 24
+STATS_GROUPS = ("SPI", "I2C", "SERIAL", "GPIO", "NRF", "CAMERA", "RRPI")
+
+
+# Drivers take and return lists of ints; both conversions are done in C, never per byte in Python
+
+def intArrayToBuffer(array):
+    return bytearray(array)
 
 
 def bytesToIntArray(byteBuffer):
-    res = []
-    for b in byteBuffer:
-        res.append(int(b))
+    return list(byteBuffer)
 
-    return res
 
+def booleanToBuffer(boolValue):
+    return b"\x01" if boolValue else b"\x00"
 
-def startListen():
 
-    def session(con):
+def recvInto(con, view, size):
+    received = 0
+    while received < size:
+        n = con.recv_into(view[received:size], size - received)
+        if n == 0:
+            raise ConnectionResetError("Connection closed while reading " + str(size) + " bytes")
+        received += n
 
-        def returnBoolean(boolValue):
-            buf = bytearray()
-            buf.append(1 if boolValue else 0)
-            con.send(buf)
 
+class NrfSubscriber:
+    # Batches waiting to be pushed to one subscribed session, sent by its own thread so
+    # slow client holds up only its own batches. Once NRF_SUBSCRIBER_QUEUE batches wait,
+    # further ones are dropped for this subscriber and counted.
 
-        def processCommand(cmd):
-            if cmd == SPI_CLOSE:
-                if VERBOSE > 2:
-                    print("SPI: Close")
-                try:
-                    spi.close()
-                except Exception as e:
-                    print(str(e))
+    def __init__(self, receiver, push):
+        self.push = push
+        self.delivered = 0
+        self.batches = 0
+        self.dropped = 0
+        self._receiver = receiver
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
 
-            elif cmd == SPI_OPEN:
-                if VERBOSE > 3:
-                    print("SPI: OPEN...")
-                bus = ord(con.recv(1))
-                device = ord(con.recv(1))
-                if VERBOSE > 2:
-                    print("SPI: OPEN(" + str(bus) + "." + str(device))
-                try:
-                    spi.open(bus, device)
-                except Exception as e:
-                    print(str(e))
+    def offer(self, batch, count):
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._queue) < NRF_SUBSCRIBER_QUEUE:
+                self._queue.append((batch, count))
+                self._condition.notify()
+                return
+        self._receiver.count(self, 0, 0, count)
 
-            elif cmd == SPI_XFER:
-                if VERBOSE > 3:
-                    print("SPI: XFER...")
-                low = ord(con.recv(1))
-                high = ord(con.recv(1))
-                size = low + high << 8
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
 
-                if VERBOSE > 3:
-                    print("SPI: XFER(" + str(size) + "), waiting for data...")
-                data = con.recv(size)
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                batch, count = self._queue.popleft()
 
+            try:
+                self.push(NRF_SUBSCRIBE, batch)
+            except Exception as e:
                 if VERBOSE > 2:
-                    print("SPI: XFER(" + str(size) + ")")
-                try:
-                    res = spi.xfer(data)
-                    con.send(res)
-                except Exception as e:
-                    print(str(e))
+                    print("NRF: failed to push packets; " + str(e))
+                self._receiver.count(self, 0, 0, count)
+                self._receiver.unsubscribe(self.push)
+                return
+            self._receiver.count(self, count, 1, 0)
 
-            elif cmd == NRF_INIT:
-                if VERBOSE > 3:
-                    print("NRF: INIT...")
-                spiBus = ord(con.recv(1))
-                spiDevice = ord(con.recv(1))
-                packetSize = ord(con.recv(1))
-                address = bytesToIntArray(con.recv(5))
-                channel = ord(con.recv(1))
 
-                if VERBOSE > 2:
-                    print("NRF: INIT(" + str(spiBus) + "." + str(spiDevice) + ", " + str(packetSize) + ", " + str(address) + ", " + str(channel) + ")")
-                nRF2401.initNRF(spiBus, spiDevice, packetSize, address, channel)
+class NrfReceiver:
+    # While radio is listening and somebody is subscribed, packets are read from the radio
+    # into bounded ring buffer, timestamped, and handed to subscribed sessions' NrfSubscriber
+    # queues in batches. When ring is full oldest packets are overwritten and counted as
+    # overflows.
 
-            elif cmd == NRF_CLOSE:
-                if VERBOSE > 3:
-                    print("NRF: CLOSE...")
-                nRF2401.close()
+    def __init__(self, radio):
+        self._radio = radio
+        self.packetSize = 32
+        self.batchSize = 8
+        self.maxLatency = 0.005
+        self.listening = False
+        self.received = 0
+        self.delivered = 0
+        self.batches = 0
+        self.overflows = 0
+        self.dropped = 0
+        self._ring = collections.deque(maxlen=256)
+        self._condition = threading.Condition()
+        self._subscribers = {}
+        self._thread = None
 
-            elif cmd == NRF_SET_READ_PIPE_ADR:
-                if VERBOSE > 3:
-                    print("NRF: SET_READ_PIPE_ADDR...")
-                pipeNumber = ord(con.recv(1))
-                addr = bytesToIntArray(con.recv(5))
-                if VERBOSE > 2:
-                    print("NRF: SET_READ_PIPE_ADDR(" + str(pipeNumber) + ", " + str(addr) + ")")
-                nRF2401.setReadPipeAddress(pipeNumber, addr)
+    def subscribe(self, push, packetSize, capacity, batchSize, maxLatency):
+        with self._condition:
+            self.packetSize = packetSize
+            self.batchSize = max(1, batchSize)
+            self.maxLatency = maxLatency
+            if capacity != self._ring.maxlen:
+                self._ring = collections.deque(self._ring, maxlen=max(1, capacity))
+            if push not in self._subscribers:
+                self._subscribers[push] = NrfSubscriber(self, push)
 
-            elif cmd == NRF_SET_WRITE_PIPE_ADR:
-                if VERBOSE > 3:
-                    print("NRF: SET_WRITE_PIPE_ADDR...")
-                addr = bytesToIntArray(con.recv(5))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._receive)
+                self._thread.daemon = True
+                self._thread.start()
+                deliverThread = threading.Thread(target=self._deliver)
+                deliverThread.daemon = True
+                deliverThread.start()
+            self._condition.notify_all()
+
+    def unsubscribe(self, push):
+        with self._condition:
+            subscriber = self._subscribers.pop(push, None)
+            self._condition.notify_all()
+        if subscriber is not None:
+            subscriber.close()
+
+    def setListening(self, listening):
+        with self._condition:
+            self.listening = listening
+            self._condition.notify_all()
+
+    def count(self, subscriber, delivered, batches, dropped):
+        # Records what happened to batches of the subscriber, for it and in totals
+        with self._condition:
+            subscriber.delivered += delivered
+            subscriber.batches += batches
+            subscriber.dropped += dropped
+            self.delivered += delivered
+            self.batches += batches
+            self.dropped += dropped
+
+    def stats(self, push=None):
+        # Delivered, batches and dropped are those of the subscriber push is, if subscribed,
+        # otherwise totals of all subscribers
+        with self._condition:
+            counts = self._subscribers.get(push, self)
+            return NRF_RECEIVE_STATS.pack(self.received, counts.delivered, counts.batches, self.overflows, counts.dropped,
+                                          len(self._ring), self._ring.maxlen)
+
+    def _receive(self):
+        while True:
+            with self._condition:
+                while not self.listening or len(self._subscribers) == 0:
+                    self._condition.wait()
+                packetSize = self.packetSize
+
+            try:
+                with self._radio.lock, buses.claim(("SPI", self._radio.spiBus)):
+                    if self._radio.driver.poolData(NRF_POLL_TIMEOUT):
+                        data = self._radio.driver.receiveData(packetSize)
+                    else:
+                        data = None
+            except Exception as e:
+                print("NRF: receive failed; " + str(e))
+                time.sleep(NRF_POLL_TIMEOUT)
+                continue
+
+            if data is not None:
+                timestamp = time.time()
+                with self._condition:
+                    if len(self._ring) == self._ring.maxlen:
+                        self.overflows += 1
+                    self._ring.append((timestamp, data))
+                    self.received += 1
+                    # First packet starts maxLatency countdown of the batch; full batch ends it
+                    if len(self._ring) == 1 or len(self._ring) >= self.batchSize:
+                        self._condition.notify_all()
+
+    def _deliver(self):
+        while True:
+            with self._condition:
+                while len(self._ring) == 0 or len(self._subscribers) == 0:
+                    self._condition.wait()
+                deadline = self._ring[0][0] + self.maxLatency
+                while len(self._ring) < self.batchSize and time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+
+                count = min(len(self._ring), self.batchSize)
+                packets = [self._ring.popleft() for i in range(count)]
+                subscribers = list(self._subscribers.values())
+                overflows = self.overflows
+
+            batch = bytearray(NRF_BATCH_HEADER.pack(len(packets), overflows))
+            for timestamp, data in packets:
+                batch.extend(NRF_PACKET_HEADER.pack(timestamp, len(data)))
+                batch.extend(data)
+
+            for subscriber in subscribers:
+                subscriber.offer(batch, len(packets))
+
+
+class GpioEvents:
+    # Edge events detected on the Pi for one session. Each event is timestamped as soon as
+    # RPi.GPIO's callback is invoked and events are pushed to the client in batches of up
+    # to maxEvents or when the oldest event waited maxLatency seconds. When push fails it is
+    # closed and detection on pins (the channel's set of pins with detection) is removed.
+
+    def __init__(self, push, pins):
+        self.maxEvents = 64
+        self.maxLatency = 0.002
+        self.edges = {}
+        self.closed = False
+        self._push = push
+        self._pins = pins
+        self._events = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def callback(self, pin):
+        timestamp = time.time()
+        edge = self.edges.get(pin)
+        if edge == GPIO.RISING:
+            level = 1
+        elif edge == GPIO.FALLING:
+            level = 0
+        else:
+            level = GPIO.input(pin)
+        with self._condition:
+            if self.closed:
+                return
+            self._events.append((pin, level, timestamp))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._events.clear()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._events) == 0 and not self.closed:
+                    self._condition.wait()
+                if self.closed:
+                    return
+                deadline = self._events[0][2] + self.maxLatency
+                while len(self._events) < self.maxEvents and time.time() < deadline and not self.closed:
+                    self._condition.wait(deadline - time.time())
+
+                events = self._events[:self.maxEvents]
+                del self._events[:self.maxEvents]
+
+            batch = bytearray(UINT16.pack(len(events)))
+            for pin, level, timestamp in events:
+                batch.extend(GPIO_EVENT.pack(pin, level, timestamp))
+            try:
+                self._push(GPIO_EVENTS, batch)
+            except Exception as e:
                 if VERBOSE > 2:
-                    print("NRF: SET_WRITE_PIPE_ADDR(" + str(addr) + ")")
-                nRF2401.setWritePipeAddress(addr)
+                    print("GPIO: failed to push events; " + str(e))
+                self.close()
+                for pin in list(self._pins):
+                    GPIO.remove_event_detect(pin)
+                    self._pins.discard(pin)
+                return
 
-            elif cmd == NRF_GET_READ_PIPE_ADR:
-                if VERBOSE > 3:
-                    print("NRF: GET_READ_PIPE_ADDR...")
+
+class GpioBank:
+    # BCM pins 0-27 read and written as one 32 bit mask. When /dev/gpiomem is available
+    # GPIO registers are mapped in so setting and clearing masks are single register writes
+    # (GPSET0/GPCLR0) and read is one read of GPLEV0. Otherwise it falls back to RPi.GPIO,
+    # pin by pin, which needs BCM numbering mode.
+
+    PINS = 28
+    GPSET0 = 0x1C // 4
+    GPCLR0 = 0x28 // 4
+    GPLEV0 = 0x34 // 4
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._registers = None
+        try:
+            with open("/dev/gpiomem", "r+b") as f:
+                self._registers = memoryview(mmap.mmap(f.fileno(), 4096)).cast("I")
+        except (OSError, ValueError) as e:
+            if VERBOSE > 1:
+                print("GPIO: /dev/gpiomem not available, using RPi.GPIO for bank operations; " + str(e))
+
+    def read(self):
+        if self._registers is not None:
+            return self._registers[GpioBank.GPLEV0] & 0x0FFFFFFF
+
+        mask = 0
+        for pin in range(GpioBank.PINS):
+            try:
+                if GPIO.input(pin):
+                    mask |= 1 << pin
+            except RuntimeError:
                 pass
+        return mask
 
-            elif cmd == NRF_GET_WRITE_PIPE_ADR:
-                if VERBOSE > 3:
-                    print("NRF: GET_WRITE_PIPE_ADDR...")
+    def write(self, setMask, clearMask):
+        if self._registers is not None:
+            if setMask:
+                self._registers[GpioBank.GPSET0] = setMask & 0x0FFFFFFF
+            if clearMask:
+                self._registers[GpioBank.GPCLR0] = clearMask & 0x0FFFFFFF
+            return
+
+        for pin in range(GpioBank.PINS):
+            bit = 1 << pin
+            if setMask & bit:
+                GPIO.output(pin, 1)
+            elif clearMask & bit:
+                GPIO.output(pin, 0)
+
+    def sequence(self, mask, steps):
+        # Steps are applied at absolute times from the start so delays do not accumulate drift;
+        # long waits sleep, the last millisecond is busy waited.
+        start = time.perf_counter()
+        due = start
+        maxLateness = 0.0
+        for value, delayUs in steps:
+            now = time.perf_counter()
+            maxLateness = max(maxLateness, now - due)
+            self.write(value & mask, ~value & mask)
+            due += delayUs / 1000000.0
+            remaining = due - time.perf_counter()
+            if remaining > 0.001:
+                time.sleep(remaining - 0.001)
+            while time.perf_counter() < due:
                 pass
 
-            elif cmd == NRF_FLUSH_TX:
-                if VERBOSE > 2:
-                    print("NRF: WRITE FLUSH TX...")
-                nRF2401.writeFlushTX()
+        return time.perf_counter() - start, maxLateness
 
-            elif cmd == NRF_FLUSH_RX:
-                if VERBOSE > 2:
-                    print("NRF: WRITE FLUSH RX...")
-                nRF2401.writeFlushRX()
 
-            elif cmd == NRF_POWER_UP:
-                if VERBOSE > 2:
-                    print("NRF: POWER UP...")
-                nRF2401.powerUp()
+class CameraStream:
+    # Continuous capture from the camera's video port. Captured frames go to bounded queue,
+    # dropping the oldest when the client falls behind, so the camera is never blocked.
+    # Sender thread pushes frames in chunks of CAMERA_CHUNK_SIZE.
 
-            elif cmd == NRF_POWER_DOWN:
-                if VERBOSE > 2:
-                    print("NRF: POWER DOWN...")
-                nRF2401.powerDown()
+    def __init__(self, camera, push, format, queueDepth, quality):
+        self.captured = 0
+        self.sent = 0
+        self.dropped = 0
+        self._camera = camera
+        self._push = push
+        self._format = format
+        self._quality = quality
+        self._frames = collections.deque(maxlen=max(1, queueDepth))
+        self._condition = threading.Condition()
+        self._running = False
+        self._buffer = bytearray()
 
-            elif cmd == NRF_SWITCH_TX:
-                if VERBOSE > 2:
-                    print("NRF: SWITCH_TX...")
-                nRF2401.swithToTX()
+    def start(self):
+        self._running = True
+        sender = threading.Thread(target=self._send)
+        sender.daemon = True
+        sender.start()
+        if self._format == "mjpeg" and self._quality > 0:
+            self._camera.start_recording(self, format=self._format, quality=self._quality)
+        else:
+            self._camera.start_recording(self, format=self._format)
 
-            elif cmd == NRF_SWITCH_RX:
-                if VERBOSE > 2:
-                    print("NRF: SWITCH_RX...")
-                nRF2401.swithToRX()
+    def stop(self):
+        with self._condition:
+            if not self._running:
+                return
+            self._running = False
+            self._condition.notify()
+        self._camera.stop_recording()
 
-            elif cmd == NRF_RESET:
-                if VERBOSE > 2:
-                    print("NRF: RESET...")
-                nRF2401.reset()
+    def stats(self):
+        with self._condition:
+            return CAMERA_STATS.pack(self.captured, self.sent, self.dropped, len(self._frames))
 
-            elif cmd == NRF_SEND:
-                if VERBOSE > 3:
-                    print("NRF: SEND...")
-                size = ord(con.recv(1))
-                if VERBOSE > 3:
-                    print("NRF: SEND(" + str(size) + ")...")
-                data = bytesToIntArray(con.recv(size))
-                if VERBOSE > 2:
-                    print("NRF: SEND(" + str(data) + ")")
-                res = nRF2401.sendData(data)
-                returnBoolean(res)
+    def write(self, data):
+        # Called by picamera's encoder thread; frame may come in more than one write
+        self._buffer.extend(data)
+        if self._camera.frame.complete:
+            frame = bytes(self._buffer)
+            del self._buffer[:]
+            with self._condition:
+                if len(self._frames) == self._frames.maxlen:
+                    self.dropped += 1
+                self._frames.append((self.captured, time.time(), frame))
+                self.captured += 1
+                self._condition.notify()
+        return len(data)
 
-            elif cmd == NRF_RECEIVE:
-                if VERBOSE > 3:
-                    print("NRF: RECEIVE...")
-                size = ord(con.recv(1))
-                if VERBOSE > 2:
-                    print("NRF: RECEIVE(" + str(size) + ")")
-                data = nRF2401.receiveData(size)
-                if VERBOSE > 3:
-                    print("NRF: RECEIVE(" + str(size) + ")=" + str(data))
-                con.send(intArrayToBuffer(data))
-            elif cmd == NRF_START_LISTENING:
-                if VERBOSE > 2:
-                    print("NRF: START_LISTENING...")
-                nRF2401.startListening()
-            elif cmd == NRF_STOP_LISTENING:
+    def flush(self):
+        pass
+
+    def _send(self):
+        while True:
+            with self._condition:
+                while len(self._frames) == 0 and self._running:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                number, timestamp, frame = self._frames.popleft()
+
+            view = memoryview(frame)
+            try:
+                for offset in range(0, max(1, len(frame)), CAMERA_CHUNK_SIZE):
+                    chunk = view[offset:offset + CAMERA_CHUNK_SIZE]
+                    self._push(CAMERA_FRAME, CAMERA_CHUNK.pack(number, len(frame), offset, timestamp), chunk)
+            except Exception as e:
                 if VERBOSE > 2:
-                    print("NRF: STOP_LISTENING...")
-                nRF2401.stopListening()
-            elif cmd == NRF_POOL_DATA:
-                if VERBOSE > 3:
-                    print("NRF: POOL_DATA...")
-                timeout = struct.unpack("f", con.recv(4))[0]
+                    print("CAMERA: failed to push frame; " + str(e))
+                return
+
+            with self._condition:
+                self.sent += 1
+
+
+camera = None
+cameraOwner = None
+cameraLock = threading.Lock()
+
+
+class Sampler:
+    # Periodic job: read() - the same SPI transfers or I2C reads - is run every period seconds
+    # on a timer thread of its own, against absolute deadlines so lateness does not add up.
+    # Ticks missed by a whole period are skipped and counted. Samples are timestamped and
+    # collected into blocks of blockSamples, or fewer when the next tick would be past
+    # maxLatency; a sender thread pushes the blocks so slow network never holds up sampling.
+    # When the client falls behind by more than queueBlocks blocks the oldest are dropped.
+
+    def __init__(self, job, push, read, close, period, blockSamples, queueBlocks, maxLatency):
+        self.samples = 0
+        self.missed = 0
+        self.sent = 0
+        self.dropped = 0
+        self._job = job
+        self._push = push
+        self._read = read
+        self._close = close
+        self._period = period
+        self._blockSamples = max(1, blockSamples)
+        self._maxLatency = maxLatency
+        self._blocks = collections.deque()
+        self._queueBlocks = max(1, queueBlocks)
+        self._condition = threading.Condition()
+        self._running = True
+        self._sampling = True
+        self._timer = threading.Thread(target=self._sample)
+        self._timer.daemon = True
+        self._sender = threading.Thread(target=self._send)
+        self._sender.daemon = True
+
+    def start(self):
+        self._timer.start()
+        self._sender.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._timer.join()
+        with self._condition:
+            return SAMPLE_STATS.pack(self.samples, self.missed, self.sent, self.dropped)
+
+    def _sample(self):
+        block = bytearray()
+        count = 0
+        first = 0
+        blockStart = 0
+        tick = time.perf_counter()
+        try:
+            while self._running:
+                wait = tick - time.perf_counter()
+                if wait > SAMPLE_SPIN:
+                    time.sleep(wait - SAMPLE_SPIN)
+                    continue
+                while time.perf_counter() < tick:
+                    pass
+
+                timestamp = time.time()
+                data = self._read()
+                if count == 0:
+                    first = self.samples
+                    blockStart = tick
+                block.extend(SAMPLE_TIMESTAMP.pack(timestamp))
+                block.extend(data)
+                count += 1
+                self.samples += 1
+
+                tick += self._period
+                late = time.perf_counter() - tick
+                if late >= self._period:
+                    skipped = int(late / self._period)
+                    tick += skipped * self._period
+                    self.missed += skipped
+
+                if count >= self._blockSamples or tick - blockStart >= self._maxLatency:
+                    self._queue(first, count, block)
+                    block = bytearray()
+                    count = 0
+        except Exception as e:
+            if VERBOSE > 0:
+                print("SAMPLE: job " + str(self._job) + " failed; " + str(e))
+        finally:
+            if count > 0:
+                self._queue(first, count, block)
+            self._close()
+            with self._condition:
+                self._sampling = False
+                self._condition.notify()
+
+    def _queue(self, first, count, block):
+        with self._condition:
+            if len(self._blocks) == self._queueBlocks:
+                self._blocks.popleft()
+                self.dropped += 1
+            self._blocks.append(SAMPLE_BLOCK.pack(self._job, first & 0xFFFFFFFF, count, self.missed & 0xFFFFFFFF) + block)
+            self._condition.notify()
+
+    def _send(self):
+        while True:
+            with self._condition:
+                while len(self._blocks) == 0 and self._sampling:
+                    self._condition.wait()
+                if len(self._blocks) == 0:
+                    return
+                block = self._blocks.popleft()
+
+            try:
+                self._push(RRPI_SAMPLES, block)
+            except Exception as e:
                 if VERBOSE > 2:
-                    print("NRF: POOL_DATA(" + str(timeout) + ")")
-                res = nRF2401.poolData(timeout)
-                if VERBOSE > 3:
-                    print("NRF: POOL_DATA=" + str(res))
-                returnBoolean(res)
+                    print("SAMPLE: failed to push samples; " + str(e))
+                with self._condition:
+                    self._running = False
+                return
 
-            elif cmd == NRF_SEND_AND_RECEIVE:
-                if VERBOSE > 3:
-                    print("NRF: SEND_AND_RECEIVE...")
-                timeout = struct.unpack("f", con.recv(4))[0]
-                if VERBOSE > 3:
-                    print("NRF: SEND_AND_RECEIVE(, " + str(timeout) + ")")
-                size = ord(con.recv(1))
-                if VERBOSE > 3:
-                    print("NRF: SEND_AND_RECEIVE(" + str(size) + ")...")
-                data = bytesToIntArray(con.recv(size))
+            with self._condition:
+                self.sent += 1
+
+
+class Recorder:
+    # Writes every frame received and sent, on all connections, to capture file
+    # which can be replayed later against simulated devices (see benchmark/replay.py)
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        self._connections = 0
+
+    def forConnection(self):
+        with self._lock:
+            self._connections += 1
+            connection = self._connections
+
+        def record(direction, cmd, flags, channel, tag, data, extra=None):
+            size = len(data) + (len(extra) if extra is not None else 0)
+            header = CAPTURE_RECORD.pack(time.time(), connection, direction, cmd, flags, channel, tag, size)
+            with self._lock:
+                if self._file.closed:
+                    return
+                self._file.write(header)
+                self._file.write(data)
+                if extra is not None:
+                    self._file.write(extra)
+                self._file.flush()
+
+        return record
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+recorder = None
+
+
+def commandName(cmd):
+    for name, value in globals().items():
+        if value == cmd and isinstance(value, int) and name.split("_")[0] in STATS_GROUPS and not name.endswith("_COMMAND"):
+            return name
+    return "0x{0:02x}".format(cmd)
+
+
+class Stats:
+    # Counters kept for every processed frame: per command count, errors, bytes in and out
+    # and histograms of time frame waited in channel's queue, spent in driver (processing
+    # command) and spent sending reply (network); and totals for each session.
+    # Fetched with RRPI_STATS command or, with --stats-port, as text over HTTP.
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._sessions = {}
+        self._nextSession = 0
+        self._closed = dict(self._newTotals(), sessions=0)
+        self._staleDatagrams = 0
+        self._droppedPushes = 0
+
+    @staticmethod
+    def _newTotals():
+        return {"frames": 0, "errors": 0, "pushes": 0, "bytesIn": 0, "bytesOut": 0, "queueTime": 0.0, "driverTime": 0.0, "networkTime": 0.0}
+
+    def openSession(self, peer):
+        with self._lock:
+            self._nextSession += 1
+            session = self._newTotals()
+            session["id"] = self._nextSession
+            session["peer"] = str(peer)
+            session["started"] = time.time()
+            self._sessions[session["id"]] = session
+            return session
+
+    def closeSession(self, session):
+        with self._lock:
+            del self._sessions[session["id"]]
+            for key in self._newTotals():
+                self._closed[key] += session[key]
+            self._closed["sessions"] += 1
+
+    def _command(self, cmd):
+        command = self._commands.get(cmd)
+        if command is None:
+            command = self._newTotals()
+            command["queue"] = [0] * STATS_BUCKETS
+            command["driver"] = [0] * STATS_BUCKETS
+            command["network"] = [0] * STATS_BUCKETS
+            self._commands[cmd] = command
+        return command
+
+    def record(self, session, cmd, bytesIn, bytesOut, queueTime, driverTime, networkTime, error):
+        with self._lock:
+            command = self._command(cmd)
+            for totals in (command, session):
+                totals["frames"] += 1
+                totals["errors"] += error
+                totals["bytesIn"] += bytesIn
+                totals["bytesOut"] += bytesOut
+                totals["queueTime"] += queueTime
+                totals["driverTime"] += driverTime
+                totals["networkTime"] += networkTime
+            command["queue"][min(int(queueTime * 1000000).bit_length(), STATS_BUCKETS - 1)] += 1
+            command["driver"][min(int(driverTime * 1000000).bit_length(), STATS_BUCKETS - 1)] += 1
+            command["network"][min(int(networkTime * 1000000).bit_length(), STATS_BUCKETS - 1)] += 1
+
+    def recordPush(self, session, cmd, bytesOut, networkTime):
+        with self._lock:
+            command = self._command(cmd)
+            for totals in (command, session):
+                totals["pushes"] += 1
+                totals["bytesOut"] += bytesOut
+                totals["networkTime"] += networkTime
+            command["network"][min(int(networkTime * 1000000).bit_length(), STATS_BUCKETS - 1)] += 1
+
+    def recordStaleDatagram(self):
+        with self._lock:
+            self._staleDatagrams += 1
+
+    def recordDroppedPush(self):
+        with self._lock:
+            self._droppedPushes += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime": time.time() - self.started,
+                "staleDatagrams": self._staleDatagrams,
+                "droppedPushes": self._droppedPushes,
+                "buckets": STATS_BUCKETS,
+                "commands": {commandName(cmd): dict(command, queue=list(command["queue"]), driver=list(command["driver"]), network=list(command["network"]))
+                             for cmd, command in self._commands.items()},
+                "sessions": [dict(session) for session in self._sessions.values()],
+                "closedSessions": dict(self._closed),
+                "buses": buses.snapshot()
+            }
+
+    def text(self):
+        # Prometheus text exposition format
+        snapshot = self.snapshot()
+        lines = ["rrpi_uptime_seconds " + str(snapshot["uptime"]), "rrpi_sessions " + str(len(snapshot["sessions"])),
+                 "rrpi_stale_datagrams_total " + str(snapshot["staleDatagrams"]),
+                 "rrpi_dropped_pushes_total " + str(snapshot["droppedPushes"])]
+        for name, command in sorted(snapshot["commands"].items()):
+            label = 'command="' + name + '"'
+            for key, metric in (("frames", "frames_total"), ("errors", "errors_total"), ("pushes", "pushes_total"),
+                                ("bytesIn", "bytes_in_total"), ("bytesOut", "bytes_out_total")):
+                lines.append("rrpi_" + metric + "{" + label + "} " + str(command[key]))
+            for key in ("queue", "driver", "network"):
+                cumulative = 0
+                for i, count in enumerate(command[key]):
+                    cumulative += count
+                    le = str((1 << i) / 1000000.0) if i < STATS_BUCKETS - 1 else "+Inf"
+                    lines.append("rrpi_" + key + "_seconds_bucket{" + label + ',le="' + le + '"} ' + str(cumulative))
+                lines.append("rrpi_" + key + "_seconds_sum{" + label + "} " + str(command[key + "Time"]))
+                lines.append("rrpi_" + key + "_seconds_count{" + label + "} " + str(cumulative))
+        for name, bus in sorted(snapshot["buses"].items()):
+            label = 'bus="' + name + '"'
+            lines.append("rrpi_bus_claims_total{" + label + "} " + str(bus["claims"]))
+            lines.append("rrpi_bus_contended_total{" + label + "} " + str(bus["contended"]))
+            lines.append("rrpi_bus_wait_seconds_total{" + label + "} " + str(bus["waitTime"]))
+        for session in snapshot["sessions"]:
+            label = 'session="' + str(session["id"]) + '",peer="' + session["peer"] + '"'
+            for key, metric in (("frames", "frames_total"), ("bytesIn", "bytes_in_total"), ("bytesOut", "bytes_out_total"),
+                                ("driverTime", "driver_seconds_total"), ("networkTime", "network_seconds_total")):
+                lines.append("rrpi_session_" + metric + "{" + label + "} " + str(session[key]))
+        return "\n".join(lines) + "\n"
+
+
+stats = Stats()
+
+
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = stats.text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if VERBOSE > 3:
+            print("Stats: " + (format % args))
+
+
+def startStatsServer(socketAddress, port):
+    server = http.server.ThreadingHTTPServer((socketAddress, port), StatsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    if VERBOSE > 1:
+        print("Stats at http://" + socketAddress + ":" + str(port) + "/")
+
+
+def claimCamera(owner):
+    global camera, cameraOwner
+
+    with cameraLock:
+        if picamera is None:
+            raise IOError("picamera module is not available")
+        if cameraOwner is not None and cameraOwner != owner:
+            raise IOError("Camera is used by another session")
+        if camera is None:
+            camera = picamera.PiCamera()
+        cameraOwner = owner
+        return camera
+
+
+def releaseCamera(owner):
+    global camera, cameraOwner
+
+    with cameraLock:
+        if cameraOwner == owner:
+            camera.close()
+            camera = None
+            cameraOwner = None
+
+
+gpioBank = None
+gpioBankLock = threading.Lock()
+
+
+def getGpioBank():
+    global gpioBank
+
+    with gpioBankLock:
+        if gpioBank is None:
+            gpioBank = GpioBank()
+        return gpioBank
+
+
+class BusLock:
+    # Readers-writer lock of one bus granting claims strictly in arrival order: a shared
+    # claim queued behind an exclusive one waits for it even while the bus is only shared,
+    # so neither kind can starve the other. Claims which have to wait take tickets and the
+    # next ticket is granted as soon as the bus is free for it. Made with multiprocessing
+    # context, its state is in shared memory and it arbitrates worker processes forked
+    # after it was made (see Buses.share) as well.
+
+    def __init__(self, context=None):
+        if context is None:
+            self._condition = threading.Condition()
+            self._state = [0] * BUS_LOCK_FIELDS
+        else:
+            self._condition = context.Condition()
+            self._state = context.RawArray("d", BUS_LOCK_FIELDS)
+
+    @property
+    def claims(self):
+        return int(self._state[BUS_CLAIMS])
+
+    @property
+    def contended(self):
+        return int(self._state[BUS_CONTENDED])
+
+    @property
+    def waitTime(self):
+        return self._state[BUS_WAIT_TIME]
+
+    def _free(self, exclusive):
+        return not self._state[BUS_EXCLUSIVE] and (not exclusive or self._state[BUS_SHARED] == 0)
+
+    def acquire(self, exclusive):
+        state = self._state
+        with self._condition:
+            state[BUS_CLAIMS] += 1
+            if state[BUS_NEXT_TICKET] == state[BUS_GRANTED_TICKET] and self._free(exclusive):
+                self._grant(exclusive)
+                return
+
+            state[BUS_CONTENDED] += 1
+            start = time.perf_counter()
+            ticket = state[BUS_NEXT_TICKET]
+            state[BUS_NEXT_TICKET] += 1
+            while state[BUS_GRANTED_TICKET] != ticket or not self._free(exclusive):
+                self._condition.wait()
+            state[BUS_GRANTED_TICKET] += 1
+            self._grant(exclusive)
+            state[BUS_WAIT_TIME] += time.perf_counter() - start
+            # Shared claim next in line can be granted together with this one
+            self._condition.notify_all()
+
+    def _grant(self, exclusive):
+        if exclusive:
+            self._state[BUS_EXCLUSIVE] = 1
+        else:
+            self._state[BUS_SHARED] += 1
+
+    def release(self, exclusive):
+        state = self._state
+        with self._condition:
+            if exclusive:
+                state[BUS_EXCLUSIVE] = 0
+            else:
+                state[BUS_SHARED] -= 1
+            if state[BUS_NEXT_TICKET] != state[BUS_GRANTED_TICKET]:
+                self._condition.notify_all()
+
+
+class Buses:
+    # Arbitration between channels, of all sessions, using the same bus. Bus is identified
+    # by key such as ("SPI", 0) - one lock for all chip selects on the bus - or ("I2C", 1).
+    # Commands claim bus of the device they use for their duration (see Commands.command):
+    # single transfers, which the kernel keeps whole anyway, share it; sequences which
+    # must not be interleaved with other transfers (batches, frames, radio operations)
+    # have it exclusively. Different buses are used fully in parallel.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buses = {}
+
+    def get(self, key):
+        with self._lock:
+            bus = self._buses.get(key)
+            if bus is None:
+                bus = BusLock()
+                self._buses[key] = bus
+            return bus
+
+    def claim(self, key, exclusive=True):
+        # Context manager for code outside command handlers
+        return BusClaim(self.get(key), exclusive)
+
+    def share(self, context):
+        # Called before worker processes are forked: makes locks of SPI and I2C buses, which
+        # command groups in different processes (and samplers) share, cross-process ones
+        with self._lock:
+            for kind in ("SPI", "I2C"):
+                for number in range(SHARED_BUSES):
+                    self._buses[(kind, number)] = BusLock(context)
+
+    def snapshot(self):
+        with self._lock:
+            buses = list(self._buses.items())
+        return {busName(key): {"claims": bus.claims, "contended": bus.contended, "waitTime": bus.waitTime}
+                for key, bus in buses if bus.claims > 0}
+
+
+class BusClaim:
+    def __init__(self, bus, exclusive):
+        self._bus = bus
+        self._exclusive = exclusive
+
+    def __enter__(self):
+        self._bus.acquire(self._exclusive)
+
+    def __exit__(self, excType, excValue, traceback):
+        self._bus.release(self._exclusive)
+
+
+def busName(key):
+    return "".join(str(part) for part in key)
+
+
+buses = Buses()
+
+
+def spiBusKey(state):
+    return ("SPI", state.spiDevice[0]) if state.spiDevice is not None else None
+
+
+def i2cBusKey(state):
+    return ("I2C", state.i2cBusNo) if state.i2c is not None else None
+
+
+class NrfRadio:
+    # One nRF2401 radio, on SPI bus spiBus with chip select spiDevice. Driver module keeps
+    # radio's state in its globals, so every radio after the first drives its own copy of
+    # the module. Radio's commands run under its lock; radios on different buses can be
+    # used at the same time.
+
+    def __init__(self, driver, spiBus, spiDevice):
+        self.driver = driver
+        self.spiBus = spiBus
+        self.spiDevice = spiDevice
+        self.lock = threading.RLock()
+        self.receiver = NrfReceiver(self)
+
+
+class NrfRadios:
+    # Radios, keyed by (SPI bus, SPI device), are created when first initialised and kept
+    # for the life of the server like the hardware they stand for. Channel drives radio it
+    # initialised or, if it did not, the one initialised last before it first used one, as
+    # when only one radio was supported.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._radios = {}
+        self._last = None
+
+    def get(self, spiBus, spiDevice):
+        with self._lock:
+            radio = self._radios.get((spiBus, spiDevice))
+            if radio is None:
+                driver = nRF2401 if len(self._radios) == 0 else self._loadDriver()
+                radio = NrfRadio(driver, spiBus, spiDevice)
+                self._radios[(spiBus, spiDevice)] = radio
+            self._last = radio
+            return radio
+
+    @staticmethod
+    def _loadDriver():
+        path = getattr(nRF2401, "__file__", None)
+        if path is None:
+            raise IOError("nRF2401 driver can drive only one radio")
+        spec = importlib.util.spec_from_file_location(nRF2401.__name__, path)
+        driver = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(driver)
+        return driver
+
+    def of(self, state):
+        if state.nrf is None:
+            if self._last is None:
+                raise IOError("nRF2401 is not initialised")
+            state.nrf = self._last
+        return state.nrf
+
+    def all(self):
+        with self._lock:
+            return list(self._radios.values())
+
+
+nrfRadios = NrfRadios()
+
+
+def nrfLock(state):
+    return nrfRadios.of(state).lock
+
+
+def nrfBusKey(state):
+    return ("SPI", nrfRadios.of(state).spiBus)
+
+
+class Commands:
+    # Registry of command handlers keyed by command code. Handler is called as
+    # handler(state, *args) with state being ChannelState of the channel command came
+    # on and args decoded from payload by handler's struct.Struct, compiled once at
+    # registration; with data set the rest of payload follows as last argument.
+    # What handler returns is sent as reply. Buses register handlers, and what to release
+    # when channel closes, here: built in buses below, others through plugins (--plugin)
+    # which get the registry passed to their register(commands) function.
+
+    def __init__(self):
+        self._handlers = {}
+        self._closers = []
+        self._delegates = {}
+
+    @staticmethod
+    def _decoder(args, data):
+        if args is None:
+            return (lambda payload: (payload,)) if data else (lambda payload: ())
+        if data:
+            size = args.size
+            unpack = args.unpack_from
+            return lambda payload: unpack(payload) + (payload[size:],)
+        return args.unpack_from
+
+    def command(self, cmd, args=None, data=False, lock=None, bus=None, exclusive=True):
+        # Decorator registering handler for the command; lock, if given, is held while it runs.
+        # Instead of lock it can be function of state returning lock of the device state uses.
+        # bus(state) returns key of the bus handler uses (or None) which is claimed, exclusively
+        # or shared, from buses while it runs - after lock is taken.
+        def register(handler):
+            if cmd in self._handlers:
+                raise ValueError("Command " + commandName(cmd) + " is already registered")
+            self._handlers[cmd] = (handler, self._decoder(args, data), lock, bus, exclusive)
+            return handler
+
+        return register
+
+    def onClose(self, closer):
+        # Decorator registering closer(state) called when channel closes
+        self._closers.append(closer)
+        return closer
+
+    def delegate(self, group, worker):
+        # Commands of the group (cmd & COMMAND_MASK) are run by the worker process from now
+        # on, or, with worker None, here again
+        if worker is None:
+            self._delegates.pop(group, None)
+        else:
+            self._delegates[group] = worker
+
+    def dispatch(self, state, cmd, payload):
+        worker = self._delegates.get(cmd & COMMAND_MASK)
+        if worker is not None:
+            return worker.dispatch(state, cmd, payload)
+
+        entry = self._handlers.get(cmd)
+        if entry is None:
+            raise ValueError("Unknown command " + str(cmd))
+
+        handler, decode, lock, bus, exclusive = entry
+        if callable(lock):
+            lock = lock(state)
+        if lock is None:
+            return self._run(state, handler, decode, bus, exclusive, payload)
+        with lock:
+            return self._run(state, handler, decode, bus, exclusive, payload)
+
+    @staticmethod
+    def _run(state, handler, decode, bus, exclusive, payload):
+        key = bus(state) if bus is not None else None
+        if key is None:
+            return handler(state, *decode(payload))
+
+        busLock = buses.get(key)
+        busLock.acquire(exclusive)
+        try:
+            return handler(state, *decode(payload))
+        finally:
+            busLock.release(exclusive)
+
+    def close(self, state):
+        for worker in set(self._delegates.values()):
+            try:
+                worker.close(state)
+            except Exception as e:
+                print("Closing channel " + str(state.channel) + " in " + worker.name + " worker failed; " + str(e))
+        for closer in self._closers:
+            try:
+                closer(state)
+            except Exception as e:
+                print("Closing channel " + str(state.channel) + " failed; " + str(e))
+
+
+commands = Commands()
+
+
+class SharedRing:
+    # One way queue of messages between two processes in anonymous shared memory, which
+    # both get through fork. Writer copies message in, reader copies it out; nothing is
+    # pickled. Message is written as one or more chunks (WORKER_CHUNK and data), those
+    # longer than quarter of the ring split, so big ones do not need the whole ring free at
+    # once. Reader keeps its position in the ring's header, for writer to see free space;
+    # semaphore counts chunks written.
+
+    def __init__(self, size, context):
+        self._size = size
+        self._maxChunk = size // 4
+        self._memory = mmap.mmap(-1, 8 + size)
+        self._readPosition = memoryview(self._memory)[:4].cast("I")
+        self._ring = memoryview(self._memory)[8:]
+        self._chunks = context.Semaphore(0)
+        self._writeLock = threading.Lock()
+        self._written = 0
+        self._read = 0
+        self.alive = lambda: True  # whether the other side is still there
+
+    def _reserve(self, size):
+        # Offset of size bytes free in one piece, waiting for reader to make space if needed
+        size = (size + 7) & ~7
+        while True:
+            offset = self._written % self._size
+            skip = self._size - offset if offset + size > self._size else 0
+            used = (self._written - self._readPosition[0]) & 0xFFFFFFFF
+            if used + skip + size <= self._size:
+                break
+            if not self.alive():
+                raise IOError("Process at the other end of the ring is gone")
+            time.sleep(WORKER_WAIT)
+
+        if skip > 0:
+            WORKER_CHUNK.pack_into(self._ring, offset, WORKER_WRAP, False)
+            offset = 0
+        self._written = (self._written + skip + size) & 0xFFFFFFFF
+        return offset
+
+    def write(self, *parts):
+        # Writes concatenation of parts (bytes like objects) as one message
+        parts = [memoryview(part).cast("B") for part in parts if len(part) > 0]
+        remaining = sum(len(part) for part in parts)
+        with self._writeLock:
+            while True:
+                length = min(remaining, self._maxChunk)
+                remaining -= length
+                offset = self._reserve(WORKER_CHUNK.size + length)
+                WORKER_CHUNK.pack_into(self._ring, offset, length, remaining > 0)
+                offset += WORKER_CHUNK.size
+                while length > 0:
+                    part = parts[0]
+                    size = min(length, len(part))
+                    self._ring[offset:offset + size] = part[:size]
+                    offset += size
+                    length -= size
+                    if size == len(part):
+                        parts.pop(0)
+                    else:
+                        parts[0] = part[size:]
+                self._chunks.release()
+                if remaining == 0:
+                    return
+
+    def read(self, timeout=None):
+        # Next message as bytearray or None if none came within timeout. Only one thread reads.
+        if not self._chunks.acquire(timeout=timeout):
+            return None
+
+        message = bytearray()
+        while True:
+            offset = self._read % self._size
+            length, more = WORKER_CHUNK.unpack_from(self._ring, offset)
+            if length == WORKER_WRAP:
+                self._read += self._size - offset
+                offset = 0
+                length, more = WORKER_CHUNK.unpack_from(self._ring, offset)
+            start = offset + WORKER_CHUNK.size
+            message += self._ring[start:start + length]
+            self._read += (WORKER_CHUNK.size + length + 7) & ~7
+            self._readPosition[0] = self._read & 0xFFFFFFFF
+            if not more:
+                return message
+
+            while not self._chunks.acquire(timeout=WORKER_POLL):
+                if not self.alive():
+                    raise IOError("Process at the other end of the ring is gone")
+
+
+class WorkerPushes:
+    # Pushes a worker sent for one channel, waiting to be sent to its client by own thread
+    # (started with the first push) so slow client holds up only its own pushes. Once
+    # WORKER_PUSH_QUEUE pushes wait, further ones are dropped and counted in stats.
+
+    def __init__(self, push):
+        self.push = push
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def offer(self, cmd, data):
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._queue) < WORKER_PUSH_QUEUE:
+                self._queue.append((cmd, data))
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                self._condition.notify()
+                return
+        stats.recordDroppedPush()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._queue) == 0 and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                cmd, data = self._queue.popleft()
+
+            try:
+                self.push(cmd, data)
+            except Exception as e:
                 if VERBOSE > 2:
-                    print("NRF: SEND_AND_RECEIVE(" + str(data) + ", " + str(timeout) + ")", flush=True)
+                    print("Failed to push " + commandName(cmd) + " from worker; " + str(e))
+                self.close()
+                return
 
-                res = nRF2401.sendAndReceive(data, timeout)
 
-                if VERBOSE > 3:
-                    print("NRF: SEND_AND_RECEIVE()=" + str(res), flush=True)
+class Worker:
+    # Process running commands of some groups (see Commands.delegate) in its own interpreter,
+    # so drivers of different buses do not take turns on one GIL. It is forked before any
+    # connection is accepted. Frames go to it through request ring; replies, and what its
+    # devices push, come back through reply ring as raw bytes. Channels' device state lives
+    # in the worker, keyed by ChannelState.key. Caller waits for the reply, so frames of a
+    # channel are still processed one at a time, in order.
+
+    def __init__(self, name, context):
+        self.name = name
+        self._requests = SharedRing(WORKER_RING_SIZE, context)
+        self._replies = SharedRing(WORKER_RING_SIZE, context)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._nextRequest = 0
+        self._pushes = {}
+        self._failed = None
+        self._process = context.Process(target=self._serve, name="rrpi-" + name, daemon=True)
+        self._process.start()
+        self._requests.alive = self._replies.alive = self._process.is_alive
+
+    def start(self):
+        # Called once all workers are forked; threads are not started before that
+        threading.Thread(target=self._readReplies, name="rrpi-" + self.name + "-replies", daemon=True).start()
 
-                buf = intArrayToBuffer(res)
+    def dispatch(self, state, cmd, payload):
+        if state.key not in self._pushes:
+            self._pushes[state.key] = WorkerPushes(state.push)
 
-                if VERBOSE > 4:
-                    print("NRF: SEND_AND_RECEIVE()=buf=" + str(buf), flush=True)
-                con.send(buf)
+        future = Future()
+        with self._lock:
+            if self._failed is not None:
+                raise self._failed
+            requestId = self._nextRequest
+            self._nextRequest = (requestId + 1) & 0xFFFFFFFF
+            self._pending[requestId] = future
+        try:
+            self._requests.write(WORKER_REQUEST.pack(WORKER_FRAME, requestId, state.key, cmd), payload)
+        except Exception:
+            with self._lock:
+                self._pending.pop(requestId, None)
+            raise
+        return future.result()
+
+    def close(self, state):
+        pushes = self._pushes.pop(state.key, None)
+        if pushes is not None:
+            pushes.close()
+            self._requests.write(WORKER_REQUEST.pack(WORKER_CLOSE, 0, state.key, 0))
+
+    def _readReplies(self):
+        while True:
+            try:
+                message = self._replies.read(WORKER_POLL)
+            except IOError:
+                message = None
+            if message is None:
+                if not self._process.is_alive():
+                    self._fail()
+                    return
+                continue
+
+            kind, requestId, key, cmd, status = WORKER_REPLY.unpack_from(message)
+            data = memoryview(message)[WORKER_REPLY.size:]
+            if kind == WORKER_PUSH:
+                # Pushes are sent from channel's own thread, so slow client does not hold up
+                # replies, nor pushes to other clients
+                pushes = self._pushes.get(key)
+                if pushes is not None:
+                    pushes.offer(cmd, data)
+                continue
 
+            with self._lock:
+                future = self._pending.pop(requestId, None)
+            if future is None:
+                continue
+            if status == STATUS_OK:
+                future.set_result(data)
             else:
-                print("Unknown command " + str(cmd))
+                future.set_exception(IOError(bytes(data).decode("utf-8", "replace")))
+
+    def _fail(self):
+        print("Worker process " + self.name + " exited with code " + str(self._process.exitcode))
+        with self._lock:
+            self._failed = IOError(self.name + " worker process is gone")
+            pending = self._pending
+            self._pending = {}
+        for future in pending.values():
+            future.set_exception(self._failed)
+
+    # What follows runs in the worker process
+
+    def _serve(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # front end stops it; Ctrl+C goes to whole process group
+        for group in WORKER_GROUPS.values():
+            commands.delegate(group, None)
+        parent = os.getppid()
+        self._requests.alive = self._replies.alive = lambda: os.getppid() == parent
+
+        states = {}
+        executor = ThreadPoolExecutor(WORKER_THREADS)
+        while True:
+            try:
+                message = self._requests.read(WORKER_POLL)
+            except IOError:
+                message = None
+            if message is None:
+                if os.getppid() != parent:
+                    os._exit(0)
+                continue
 
-            # print("", end="", flush=True)
+            kind, requestId, key, cmd = WORKER_REQUEST.unpack_from(message)
+            if kind == WORKER_CLOSE:
+                state = states.pop(key, None)
+                if state is not None:
+                    executor.submit(commands.close, state)
+                continue
 
-        spi = spidev.SpiDev()
+            state = states.get(key)
+            if state is None:
+                state = states[key] = ChannelState(None, key, self._pusher(key))
+            del message[:WORKER_REQUEST.size]  # handlers get bytearray payload, as in the front end
+            executor.submit(self._execute, state, requestId, cmd, message)
 
+    def _pusher(self, key):
+        def push(cmd, data, extra=None):
+            self._replies.write(WORKER_REPLY.pack(WORKER_PUSH, 0, key, cmd, STATUS_PUSH), data, extra if extra is not None else b"")
+        return push
+
+    def _execute(self, state, requestId, cmd, payload):
         try:
-            exit = False
-            while not exit:
-                if VERBOSE > 4:
-                    print("Waiting on command")
+            res = commands.dispatch(state, cmd, payload)
+            status = STATUS_OK
+        except Exception as e:
+            res = str(e).encode("utf-8")
+            status = STATUS_ERROR
+
+        self._replies.write(WORKER_REPLY.pack(WORKER_RESULT, requestId, state.key, cmd, status), res if res is not None else b"")
+
+
+def startWorkers(spec):
+    # spec is comma separated list of worker processes, each given as "+" joined names of
+    # WORKER_GROUPS it runs commands of, or "all" for one process for each group
+    names = list(WORKER_GROUPS) if spec == "all" else spec.split(",")
+    seen = set()
+    for name in names:
+        for group in name.split("+"):
+            if group not in WORKER_GROUPS:
+                raise ValueError("Unknown command group " + group + "; expected one of " + ", ".join(WORKER_GROUPS))
+            if group in seen:
+                raise ValueError("Command group " + group + " is given to more than one process")
+            seen.add(group)
+
+    context = multiprocessing.get_context("fork")
+    buses.share(context)
+    workers = []
+    for name in names:
+        worker = Worker(name, context)
+        for group in name.split("+"):
+            commands.delegate(WORKER_GROUPS[group], worker)
+        workers.append(worker)
+    for worker in workers:
+        worker.start()
+    if VERBOSE > 1:
+        print("Started worker processes " + ", ".join(worker.name for worker in workers))
+
+
+class Connection:
+    # What all channels of one client connection share. Connection which got a session
+    # token (RRPI_SESSION_OPEN) outlives its socket: see Sessions.
+
+    def __init__(self, con):
+        self.con = con
+        self.sendLock = threading.Lock()
+        self.record = recorder.forConnection() if recorder is not None else None
+        self.session = stats.openSession(con.getpeername() or "unix")
+        self.submitFrame = None
+        self.datagramToken = None
+        self.channels = {}
+        self.token = None
 
+    def send(self, channel, cmd, status, tag, data, extra=None, replyTo=None):
+        # Payload is data, followed by extra if given. Big extra is sent as is, without copying.
+        # Replies to frames which came as datagrams go back through replyTo(frame)
+        size = len(data) + (len(extra) if extra is not None else 0)
+        frame = bytearray(REPLY_HEADER.size + len(data))
+        REPLY_HEADER.pack_into(frame, 0, cmd, status, channel, tag, size)
+        frame[REPLY_HEADER.size:] = data
+        if self.record is not None:
+            self.record(CAPTURE_REPLY, cmd, status, channel, tag, data, extra)
+        if replyTo is not None:
+            replyTo(frame)
+            return
+        with self.sendLock:
+            con = self.con
+            if con is None:
+                return  # suspended; frames are dropped until it is resumed
+            try:
+                if extra is None:
+                    con.sendall(frame)
+                elif len(extra) < 1024:
+                    frame.extend(extra)
+                    con.sendall(frame)
+                else:
+                    con.sendall(frame)
+                    con.sendall(extra)
+            except OSError:
+                if self.token is None:
+                    raise
+                # Session is kept; break the socket so the session gets suspended
                 try:
-                    cmd = ord(con.recv(1))
-                    processCommand(cmd)
-                except TypeError as ignore:
-                    if VERBOSE > 3:
-                        print("Got type error, leaving")
-                    exit = True
+                    con.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
-        except ConnectionResetError as ignore:
-            if VERBOSE > 4:
-                print("Got connection reset error")
-            pass
 
-    def listen():
-        try:
-            while True:
+class Sessions:
+    # Connection with session token, when its socket breaks, is suspended: its channels
+    # with their device state are kept, and frames they would send dropped, for grace
+    # seconds. Client reconnecting in that time attaches new socket to them with
+    # RRPI_SESSION_RESUME instead of setting all devices up again. Resuming session whose
+    # socket still looks alive (the client noticed the break first) shuts it down first.
+
+    def __init__(self):
+        self.grace = SESSION_GRACE
+        self._condition = threading.Condition()
+        self._connections = {}
+        self._timers = {}
+
+    def open(self, connection):
+        with self._condition:
+            if connection.token is None:
+                connection.token = os.urandom(SESSION_TOKEN_SIZE)
+                self._connections[connection.token] = connection
+            return connection.token
+
+    def suspend(self, connection):
+        with self._condition:
+            if self._connections.get(connection.token) is not connection:
+                return False
+            connection.con = None
+            timer = threading.Timer(self.grace, self._expire, [connection])
+            timer.daemon = True
+            self._timers[connection.token] = timer
+            timer.start()
+            self._condition.notify_all()
+            return True
+
+    def take(self, token):
+        # Returns suspended connection, which is no longer going to expire
+        deadline = time.time() + SESSION_TAKEOVER_TIMEOUT
+        with self._condition:
+            connection = self._connections.get(token)
+            if connection is None:
+                raise IOError("Unknown session")
+            if connection.con is not None:
                 try:
-                    con, addr = s.accept()
-                    t = threading.Thread(target=session, args=[con])
-                    t.daemon = True
-                    t.start()
-                except Exception as e:
-                    print(str(e) + "\n" + ''.join(traceback.format_tb(e.__traceback__)))
-        except KeyboardInterrupt as ki:
-            print(" - Stopping")
+                    connection.con.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            while token not in self._timers:
+                if self._connections.get(token) is not connection or time.time() >= deadline:
+                    raise IOError("Session could not be taken over")
+                self._condition.wait(deadline - time.time())
+            self._timers.pop(token).cancel()
+            return connection
 
-    # thread = threading.Thread(target=listen)
-    # thread.daemon = True
-    # thread.start()
+    def forget(self, connection):
+        with self._condition:
+            if self._connections.get(connection.token) is connection:
+                del self._connections[connection.token]
+            timer = self._timers.pop(connection.token, None)
+            if timer is not None:
+                timer.cancel()
 
-    listen()
+    def _expire(self, connection):
+        with self._condition:
+            if self._timers.get(connection.token) is not threading.current_thread():
+                return
+        if VERBOSE > 1:
+            print("Session " + str(connection.session["id"]) + " expired")
+        closeConnection(connection)
 
-try:
-    startListen()
-finally:
-    s.close()
+
+sessions = Sessions()
+
+
+channelKeys = itertools.count(1)
+
+
+class ChannelState:
+    # Devices used through one channel and push(cmd, data, extra=None) sending frames
+    # to its client. Plugins keep their state as further attributes.
+
+    def __init__(self, connection, channel, push):
+        self.connection = connection
+        self.channel = channel
+        self.push = push
+        self.spi = spidev.SpiDev()
+        self.spiDevice = None
+        self.i2c = None
+        self.i2cBusNo = None
+        self.gpioEvents = None
+        self.gpioEventPins = set()
+        self.cameraStream = None
+        self.samplers = {}
+        self.nrf = None
+        self.key = next(channelKeys) & 0xFFFFFFFF  # identifies the channel to worker processes
+
+
+def loadPlugin(name):
+    # Plugin is module name or path to .py file with register(commands) function
+    if name.endswith(".py"):
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(name))[0], name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(name)
+
+    module.register(commands)
+    if VERBOSE > 1:
+        print("Loaded plugin " + name)
+
+
+# SPI
+
+@commands.command(SPI_CLOSE)
+def spiClose(state):
+    if VERBOSE > 2:
+        print("SPI: Close")
+    state.spi.close()
+    state.spiDevice = None
+
+
+@commands.command(SPI_OPEN, BUS_DEVICE)
+def spiOpen(state, bus, device):
+    if VERBOSE > 2:
+        print("SPI: OPEN(" + str(bus) + "." + str(device))
+    state.spi.open(bus, device)
+    state.spiDevice = (bus, device)
+
+
+@commands.command(SPI_XFER, data=True, bus=spiBusKey, exclusive=False)
+def spiXfer(state, data):
+    if VERBOSE > 2:
+        print("SPI: XFER(" + str(len(data)) + ")")
+    return intArrayToBuffer(state.spi.xfer(data))
+
+
+def splitTransfers(count, data):
+    # Transfers are each UINT16 length followed by the bytes
+    transfers = []
+    offset = 0
+    for i in range(count):
+        size = UINT16.unpack_from(data, offset)[0]
+        offset += UINT16.size
+        transfers.append(data[offset:offset + size])
+        offset += size
+    return transfers
+
+
+@commands.command(SPI_XFER_BATCH, UINT16, data=True, bus=spiBusKey)
+def spiXferBatch(state, count, data):
+    if VERBOSE > 2:
+        print("SPI: XFER_BATCH(" + str(count) + ")")
+
+    res = bytearray()
+    for transfer in splitTransfers(count, data):
+        res.extend(state.spi.xfer(transfer))
+    return res
+
+
+# Framebuffers for SPI displays: last frame written to each (bus, device, region), with
+# its CRC-32. SPI_XFER_DELTA carries only spans which changed since the frame the client
+# last wrote; the whole reconstructed frame is clocked out. Client's idea of the last frame
+# is checked against CRC so frames written by other clients are never patched blindly.
+framebuffers = {}
+framebuffersLock = threading.Lock()
+
+
+def applySpans(frame, data):
+    # Spans are checked to be whole and within frame; malformed ones fail the command
+    offset = 0
+    while offset < len(data):
+        if offset + SPI_DELTA_SPAN.size > len(data):
+            raise IOError("Truncated span header at " + str(offset))
+        kind, start, length = SPI_DELTA_SPAN.unpack_from(data, offset)
+        offset += SPI_DELTA_SPAN.size
+        if start + length > len(frame):
+            raise IOError("Span " + str(start) + "+" + str(length) + " is outside of frame")
+        if kind == SPI_SPAN_COPY:
+            if offset + length > len(data):
+                raise IOError("Span " + str(start) + "+" + str(length) + " is missing data")
+            frame[start:start + length] = data[offset:offset + length]
+            offset += length
+        elif kind == SPI_SPAN_FILL:
+            size = data[offset] if offset < len(data) else 0
+            if size == 0 or offset + 1 + size > len(data):
+                raise IOError("Span " + str(start) + "+" + str(length) + " has no fill pattern")
+            pattern = data[offset + 1:offset + 1 + size]
+            offset += 1 + size
+            frame[start:start + length] = (pattern * (length // size + 1))[:length]
+        else:
+            raise IOError("Unknown span kind " + str(kind))
+
+
+def writeFrame(spi, frame):
+    # writebytes2 takes any buffer and splits it to transfers the driver can take
+    if hasattr(spi, "writebytes2"):
+        spi.writebytes2(frame)
+    else:
+        spi.xfer(list(frame))
+
+
+@commands.command(SPI_XFER_DELTA, SPI_DELTA_ARGS, data=True, bus=spiBusKey)
+def spiXferDelta(state, flags, region, baseCrc, size, data):
+    if state.spiDevice is None:
+        raise IOError("SPI device is not open")
+    if VERBOSE > 2:
+        print("SPI: XFER_DELTA(" + str(region) + ", " + str(len(data)) + "/" + str(size) + ")")
+
+    key = state.spiDevice + (region,)
+    with framebuffersLock:
+        if flags & SPI_DELTA_FULL:
+            frame = bytearray(size)
+        else:
+            base = framebuffers.get(key)
+            if base is None or len(base[0]) != size or base[1] != baseCrc:
+                raise IOError("Framebuffer base mismatch")
+            frame = bytearray(base[0])
+
+        applySpans(frame, data)
+        framebuffers[key] = (frame, zlib.crc32(frame))
+        writeFrame(state.spi, frame)
+
+
+# I2C
+
+def i2cBus(state):
+    if state.i2c is None:
+        raise IOError("I2C bus is not open")
+    return state.i2c
+
+
+@commands.command(I2C_OPEN, BYTE)
+def i2cOpen(state, busNo):
+    if VERBOSE > 2:
+        print("I2C: OPEN(" + str(busNo) + ")")
+    if smbus is None:
+        raise IOError("smbus module is not available")
+    if state.i2c is not None:
+        state.i2c.close()
+    state.i2c = smbus.SMBus(busNo)
+    state.i2cBusNo = busNo
+
+
+@commands.command(I2C_CLOSE)
+@commands.onClose
+def i2cClose(state):
+    if VERBOSE > 2:
+        print("I2C: CLOSE")
+    if state.i2c is not None:
+        state.i2c.close()
+        state.i2c = None
+
+
+@commands.command(I2C_WRITE_BYTE, I2C_ADDRESS_BYTE, bus=i2cBusKey, exclusive=False)
+def i2cWriteByte(state, address, value):
+    if VERBOSE > 2:
+        print("I2C: WRITE_BYTE(" + hex(address) + ", " + str(value) + ")")
+    i2cBus(state).write_byte(address, value)
+
+
+@commands.command(I2C_READ_BYTE, I2C_ADDRESS, bus=i2cBusKey, exclusive=False)
+def i2cReadByte(state, address):
+    if VERBOSE > 2:
+        print("I2C: READ_BYTE(" + hex(address) + ")")
+    return bytes([i2cBus(state).read_byte(address)])
+
+
+@commands.command(I2C_WRITE_BYTE_DATA, I2C_ADDRESS_REGISTER_BYTE, bus=i2cBusKey, exclusive=False)
+def i2cWriteByteData(state, address, register, value):
+    if VERBOSE > 2:
+        print("I2C: WRITE_BYTE_DATA(" + hex(address) + ", " + hex(register) + ", " + str(value) + ")")
+    i2cBus(state).write_byte_data(address, register, value)
+
+
+@commands.command(I2C_READ_BYTE_DATA, I2C_ADDRESS_BYTE, bus=i2cBusKey, exclusive=False)
+def i2cReadByteData(state, address, register):
+    if VERBOSE > 2:
+        print("I2C: READ_BYTE_DATA(" + hex(address) + ", " + hex(register) + ")")
+    return bytes([i2cBus(state).read_byte_data(address, register)])
+
+
+@commands.command(I2C_WRITE_WORD_DATA, I2C_ADDRESS_REGISTER_WORD, bus=i2cBusKey, exclusive=False)
+def i2cWriteWordData(state, address, register, value):
+    if VERBOSE > 2:
+        print("I2C: WRITE_WORD_DATA(" + hex(address) + ", " + hex(register) + ", " + str(value) + ")")
+    i2cBus(state).write_word_data(address, register, value)
+
+
+@commands.command(I2C_READ_WORD_DATA, I2C_ADDRESS_BYTE, bus=i2cBusKey, exclusive=False)
+def i2cReadWordData(state, address, register):
+    if VERBOSE > 2:
+        print("I2C: READ_WORD_DATA(" + hex(address) + ", " + hex(register) + ")")
+    return I2C_WORD.pack(i2cBus(state).read_word_data(address, register))
+
+
+@commands.command(I2C_WRITE_BLOCK_DATA, I2C_ADDRESS_BYTE, data=True, bus=i2cBusKey, exclusive=False)
+def i2cWriteBlockData(state, address, register, data):
+    data = bytesToIntArray(data)
+    if VERBOSE > 2:
+        print("I2C: WRITE_BLOCK_DATA(" + hex(address) + ", " + hex(register) + ", " + str(data) + ")")
+    i2cBus(state).write_block_data(address, register, data)
+
+
+@commands.command(I2C_WRITE_I2C_BLOCK_DATA, I2C_ADDRESS_BYTE, data=True, bus=i2cBusKey, exclusive=False)
+def i2cWriteI2cBlockData(state, address, register, data):
+    data = bytesToIntArray(data)
+    if VERBOSE > 2:
+        print("I2C: WRITE_I2C_BLOCK_DATA(" + hex(address) + ", " + hex(register) + ", " + str(data) + ")")
+    i2cBus(state).write_i2c_block_data(address, register, data)
+
+
+@commands.command(I2C_READ_BLOCK_DATA, I2C_ADDRESS_BYTE, bus=i2cBusKey, exclusive=False)
+def i2cReadBlockData(state, address, register):
+    if VERBOSE > 2:
+        print("I2C: READ_BLOCK_DATA(" + hex(address) + ", " + hex(register) + ")")
+    return intArrayToBuffer(i2cBus(state).read_block_data(address, register))
+
+
+@commands.command(I2C_READ_I2C_BLOCK_DATA, I2C_ADDRESS_REGISTER_BYTE, bus=i2cBusKey, exclusive=False)
+def i2cReadI2cBlockData(state, address, register, count):
+    if VERBOSE > 2:
+        print("I2C: READ_I2C_BLOCK_DATA(" + hex(address) + ", " + hex(register) + ", " + str(count) + ")")
+    return intArrayToBuffer(i2cBus(state).read_i2c_block_data(address, register, count))
+
+
+@commands.command(I2C_READ_MANY, data=True, bus=i2cBusKey)
+def i2cReadMany(state, data):
+    if VERBOSE > 2:
+        print("I2C: READ_MANY(" + str(len(data) // I2C_READ_MANY_ENTRY.size) + ")")
+    bus = i2cBus(state)
+    res = bytearray()
+    for address, register, count in I2C_READ_MANY_ENTRY.iter_unpack(data):
+        if count == 1:
+            res.append(bus.read_byte_data(address, register))
+        else:
+            res.extend(bus.read_i2c_block_data(address, register, count))
+    return res
+
+
+# GPIO
+
+def gpio():
+    if GPIO is None:
+        raise IOError("RPi.GPIO module is not available")
+    return GPIO
+
+
+def gpioEvents(state):
+    if state.gpioEvents is None or state.gpioEvents.closed:
+        state.gpioEvents = GpioEvents(state.push, state.gpioEventPins)
+    return state.gpioEvents
+
+
+@commands.command(GPIO_SETMODE, BYTE)
+def gpioSetMode(state, mode):
+    if VERBOSE > 2:
+        print("GPIO: SETMODE(" + str(mode) + ")")
+    gpio().setmode(mode)
+
+
+@commands.command(GPIO_SETWARNINGS, BYTE)
+def gpioSetWarnings(state, warnings):
+    gpio().setwarnings(warnings != 0)
+
+
+@commands.command(GPIO_SETUP, GPIO_SETUP_ARGS)
+def gpioSetup(state, pin, direction, pullUpDown, initial):
+    if VERBOSE > 2:
+        print("GPIO: SETUP(" + str(pin) + ", " + str(direction) + ", " + str(pullUpDown) + ", " + str(initial) + ")")
+    if direction == gpio().OUT:
+        gpio().setup(pin, direction, initial=initial)
+    else:
+        gpio().setup(pin, direction, pull_up_down=pullUpDown)
+
+
+@commands.command(GPIO_OUTPUT, GPIO_PIN_VALUE)
+def gpioOutput(state, pin, value):
+    if VERBOSE > 2:
+        print("GPIO: OUTPUT(" + str(pin) + ", " + str(value) + ")")
+    gpio().output(pin, value)
+
+
+@commands.command(GPIO_INPUT, BYTE)
+def gpioInput(state, pin):
+    if VERBOSE > 2:
+        print("GPIO: INPUT(" + str(pin) + ")")
+    return bytes([gpio().input(pin)])
+
+
+@commands.command(GPIO_CLEANUP, data=True)
+def gpioCleanup(state, pins):
+    if VERBOSE > 2:
+        print("GPIO: CLEANUP(" + str(list(pins)) + ")")
+    for pin in list(state.gpioEventPins):
+        if len(pins) == 0 or pin in pins:
+            gpio().remove_event_detect(pin)
+            state.gpioEventPins.discard(pin)
+    if len(pins) == 0:
+        gpio().cleanup()
+    else:
+        gpio().cleanup(list(pins))
+
+
+@commands.command(GPIO_ADD_EVENT_DETECT, GPIO_EVENT_DETECT_ARGS)
+def gpioAddEventDetect(state, pin, edge, bounceTime):
+    if VERBOSE > 2:
+        print("GPIO: ADD_EVENT_DETECT(" + str(pin) + ", " + str(edge) + ", " + str(bounceTime) + ")")
+    events = gpioEvents(state)
+    events.edges[pin] = edge
+    if bounceTime > 0:
+        gpio().add_event_detect(pin, edge, callback=events.callback, bouncetime=bounceTime)
+    else:
+        gpio().add_event_detect(pin, edge, callback=events.callback)
+    state.gpioEventPins.add(pin)
+
+
+@commands.command(GPIO_REMOVE_EVENT_DETECT, BYTE)
+def gpioRemoveEventDetect(state, pin):
+    if VERBOSE > 2:
+        print("GPIO: REMOVE_EVENT_DETECT(" + str(pin) + ")")
+    gpio().remove_event_detect(pin)
+    state.gpioEventPins.discard(pin)
+
+
+@commands.command(GPIO_EVENT_BATCHING, GPIO_EVENT_BATCHING_ARGS)
+def gpioEventBatching(state, maxEvents, maxLatency):
+    events = gpioEvents(state)
+    events.maxEvents = max(1, maxEvents)
+    events.maxLatency = maxLatency
+
+
+@commands.command(GPIO_READ_BANK)
+def gpioReadBank(state):
+    gpio()
+    return GPIO_BANK.pack(getGpioBank().read())
+
+
+@commands.command(GPIO_WRITE_BANK, GPIO_BANK_WRITE)
+def gpioWriteBank(state, setMask, clearMask):
+    if VERBOSE > 2:
+        print("GPIO: WRITE_BANK(" + hex(setMask) + ", " + hex(clearMask) + ")")
+    gpio()
+    bank = getGpioBank()
+    with bank.lock:
+        bank.write(setMask, clearMask)
+
+
+@commands.command(GPIO_SEQUENCE, GPIO_BANK, data=True)
+def gpioSequence(state, mask, data):
+    steps = list(GPIO_SEQUENCE_STEP.iter_unpack(data))
+    if VERBOSE > 2:
+        print("GPIO: SEQUENCE(" + hex(mask) + ", " + str(len(steps)) + " steps)")
+    gpio()
+    bank = getGpioBank()
+    with bank.lock:
+        duration, maxLateness = bank.sequence(mask, steps)
+    return GPIO_SEQUENCE_RESULT.pack(duration, maxLateness)
+
+
+@commands.onClose
+def gpioClose(state):
+    for pin in list(state.gpioEventPins):
+        GPIO.remove_event_detect(pin)
+    if state.gpioEvents is not None:
+        state.gpioEvents.close()
+
+
+# Camera
+
+def stopCamera(state):
+    if state.cameraStream is not None:
+        state.cameraStream.stop()
+        state.cameraStream = None
+
+
+@commands.command(CAMERA_START_STREAM, CAMERA_STREAM_ARGS, data=True)
+def cameraStartStream(state, width, height, framerate, queueDepth, quality, format):
+    format = bytes(format).decode("ascii")
+    if VERBOSE > 2:
+        print("CAMERA: START_STREAM(" + str(width) + "x" + str(height) + "@" + str(framerate) + ", " + format + ", " + str(queueDepth) + ")")
+    if format not in CAMERA_FORMATS:
+        raise ValueError("Unsupported format " + format)
+    stopCamera(state)
+    cam = claimCamera(state.push)
+    cam.resolution = (width, height)
+    cam.framerate = framerate
+    state.cameraStream = CameraStream(cam, state.push, format, queueDepth, quality)
+    state.cameraStream.start()
+
+
+@commands.command(CAMERA_STOP_STREAM)
+def cameraStopStream(state):
+    if VERBOSE > 2:
+        print("CAMERA: STOP_STREAM")
+    stopCamera(state)
+
+
+@commands.command(CAMERA_CAPTURE, CAMERA_CAPTURE_ARGS, data=True)
+def cameraCapture(state, width, height, format):
+    format = bytes(format).decode("ascii")
+    if VERBOSE > 2:
+        print("CAMERA: CAPTURE(" + str(width) + "x" + str(height) + ", " + format + ")")
+    cam = claimCamera(state.push)
+    if state.cameraStream is None:
+        cam.resolution = (width, height)
+    output = io.BytesIO()
+    cam.capture(output, format=format, use_video_port=state.cameraStream is not None)
+    return output.getvalue()
+
+
+@commands.command(CAMERA_GET_STATS)
+def cameraGetStats(state):
+    if state.cameraStream is None:
+        return CAMERA_STATS.pack(0, 0, 0, 0)
+    return state.cameraStream.stats()
+
+
+@commands.onClose
+def cameraClose(state):
+    stopCamera(state)
+    releaseCamera(state.push)
+
+
+# nRF2401; commands are run under lock of the channel's radio (see NrfRadios), and
+# those talking to it with SPI bus it is on claimed
+
+@commands.command(NRF_INIT, NRF_INIT_ARGS)
+def nrfInit(state, spiBus, spiDevice, packetSize, address, radioChannel):
+    address = bytesToIntArray(address)
+    if VERBOSE > 2:
+        print("NRF: INIT(" + str(spiBus) + "." + str(spiDevice) + ", " + str(packetSize) + ", " + str(address) + ", " + str(radioChannel) + ")")
+    radio = nrfRadios.get(spiBus, spiDevice)
+    with radio.lock, buses.claim(("SPI", spiBus)):
+        radio.driver.initNRF(spiBus, spiDevice, packetSize, address, radioChannel)
+    state.nrf = radio
+
+
+@commands.command(NRF_CLOSE, lock=nrfLock, bus=nrfBusKey)
+def nrfClose(state):
+    if VERBOSE > 2:
+        print("NRF: CLOSE...")
+    nrfRadios.of(state).driver.close()
+
+
+@commands.command(NRF_SET_READ_PIPE_ADR, NRF_READ_PIPE_ARGS, lock=nrfLock, bus=nrfBusKey)
+def nrfSetReadPipeAddress(state, pipeNumber, addr):
+    addr = bytesToIntArray(addr)
+    if VERBOSE > 2:
+        print("NRF: SET_READ_PIPE_ADDR(" + str(pipeNumber) + ", " + str(addr) + ")")
+    nrfRadios.of(state).driver.setReadPipeAddress(pipeNumber, addr)
+
+
+@commands.command(NRF_SET_WRITE_PIPE_ADR, NRF_ADDRESS, lock=nrfLock, bus=nrfBusKey)
+def nrfSetWritePipeAddress(state, addr):
+    addr = bytesToIntArray(addr)
+    if VERBOSE > 2:
+        print("NRF: SET_WRITE_PIPE_ADDR(" + str(addr) + ")")
+    nrfRadios.of(state).driver.setWritePipeAddress(addr)
+
+
+@commands.command(NRF_GET_READ_PIPE_ADR, lock=nrfLock, bus=nrfBusKey)
+def nrfGetReadPipeAddress(state):
+    if VERBOSE > 3:
+        print("NRF: GET_READ_PIPE_ADDR...")
+
+
+@commands.command(NRF_GET_WRITE_PIPE_ADR, lock=nrfLock, bus=nrfBusKey)
+def nrfGetWritePipeAddress(state):
+    if VERBOSE > 3:
+        print("NRF: GET_WRITE_PIPE_ADDR...")
+
+
+@commands.command(NRF_FLUSH_TX, lock=nrfLock, bus=nrfBusKey)
+def nrfFlushTX(state):
+    if VERBOSE > 2:
+        print("NRF: WRITE FLUSH TX...")
+    nrfRadios.of(state).driver.writeFlushTX()
+
+
+@commands.command(NRF_FLUSH_RX, lock=nrfLock, bus=nrfBusKey)
+def nrfFlushRX(state):
+    if VERBOSE > 2:
+        print("NRF: WRITE FLUSH RX...")
+    nrfRadios.of(state).driver.writeFlushRX()
+
+
+@commands.command(NRF_POWER_UP, lock=nrfLock, bus=nrfBusKey)
+def nrfPowerUp(state):
+    if VERBOSE > 2:
+        print("NRF: POWER UP...")
+    nrfRadios.of(state).driver.powerUp()
+
+
+@commands.command(NRF_POWER_DOWN, lock=nrfLock, bus=nrfBusKey)
+def nrfPowerDown(state):
+    if VERBOSE > 2:
+        print("NRF: POWER DOWN...")
+    nrfRadios.of(state).driver.powerDown()
+
+
+@commands.command(NRF_SWITCH_TX, lock=nrfLock, bus=nrfBusKey)
+def nrfSwitchTX(state):
+    if VERBOSE > 2:
+        print("NRF: SWITCH_TX...")
+    nrfRadios.of(state).driver.swithToTX()
+
+
+@commands.command(NRF_SWITCH_RX, lock=nrfLock, bus=nrfBusKey)
+def nrfSwitchRX(state):
+    if VERBOSE > 2:
+        print("NRF: SWITCH_RX...")
+    nrfRadios.of(state).driver.swithToRX()
+
+
+@commands.command(NRF_RESET, lock=nrfLock, bus=nrfBusKey)
+def nrfReset(state):
+    if VERBOSE > 2:
+        print("NRF: RESET...")
+    nrfRadios.of(state).driver.reset()
+
+
+@commands.command(NRF_SEND, data=True, lock=nrfLock, bus=nrfBusKey)
+def nrfSend(state, data):
+    data = bytesToIntArray(data)
+    if VERBOSE > 2:
+        print("NRF: SEND(" + str(data) + ")")
+    return booleanToBuffer(nrfRadios.of(state).driver.sendData(data))
+
+
+@commands.command(NRF_RECEIVE, BYTE, lock=nrfLock, bus=nrfBusKey)
+def nrfReceive(state, size):
+    if VERBOSE > 2:
+        print("NRF: RECEIVE(" + str(size) + ")")
+    data = nrfRadios.of(state).driver.receiveData(size)
+    if VERBOSE > 3:
+        print("NRF: RECEIVE(" + str(size) + ")=" + str(data))
+    return intArrayToBuffer(data)
+
+
+@commands.command(NRF_START_LISTENING, lock=nrfLock, bus=nrfBusKey)
+def nrfStartListening(state):
+    if VERBOSE > 2:
+        print("NRF: START_LISTENING...")
+    nrfRadios.of(state).driver.startListening()
+    nrfRadios.of(state).receiver.setListening(True)
+
+
+@commands.command(NRF_STOP_LISTENING, lock=nrfLock, bus=nrfBusKey)
+def nrfStopListening(state):
+    if VERBOSE > 2:
+        print("NRF: STOP_LISTENING...")
+    nrfRadios.of(state).receiver.setListening(False)
+    nrfRadios.of(state).driver.stopListening()
+
+
+@commands.command(NRF_POOL_DATA, FLOAT, lock=nrfLock, bus=nrfBusKey)
+def nrfPoolData(state, timeout):
+    if VERBOSE > 2:
+        print("NRF: POOL_DATA(" + str(timeout) + ")")
+    res = nrfRadios.of(state).driver.poolData(timeout)
+    if VERBOSE > 3:
+        print("NRF: POOL_DATA=" + str(res))
+    return booleanToBuffer(res)
+
+
+@commands.command(NRF_SEND_AND_RECEIVE, FLOAT, data=True, lock=nrfLock, bus=nrfBusKey)
+def nrfSendAndReceive(state, timeout, data):
+    data = bytesToIntArray(data)
+    if VERBOSE > 2:
+        print("NRF: SEND_AND_RECEIVE(" + str(data) + ", " + str(timeout) + ")", flush=True)
+
+    res = nrfRadios.of(state).driver.sendAndReceive(data, timeout)
+
+    if VERBOSE > 3:
+        print("NRF: SEND_AND_RECEIVE()=" + str(res), flush=True)
+
+    return intArrayToBuffer(res)
+
+
+@commands.command(NRF_SUBSCRIBE, NRF_SUBSCRIBE_ARGS)
+def nrfSubscribe(state, packetSize, capacity, batchSize, maxLatency):
+    if VERBOSE > 2:
+        print("NRF: SUBSCRIBE(" + str(packetSize) + ", " + str(capacity) + ", " + str(batchSize) + ", " + str(maxLatency) + ")")
+    nrfRadios.of(state).receiver.subscribe(state.push, packetSize, capacity, batchSize, maxLatency)
+
+
+@commands.command(NRF_UNSUBSCRIBE)
+@commands.onClose
+def nrfUnsubscribe(state):
+    if VERBOSE > 2:
+        print("NRF: UNSUBSCRIBE")
+    for radio in nrfRadios.all():
+        radio.receiver.unsubscribe(state.push)
+
+
+@commands.command(NRF_POLL_LIST, data=True, lock=nrfLock)
+def nrfPollList(state, entries):
+    # Sends each node its payload, in order, and waits up to node's timeout for its reply.
+    # Bus is claimed for one node at a time so other devices on it are not held up for the
+    # whole sweep. Write pipe address is left at the last node's.
+    radio = nrfRadios.of(state)
+    if VERBOSE > 2:
+        print("NRF: POLL_LIST(" + str(len(entries)) + " bytes)")
+
+    res = bytearray()
+    offset = 0
+    while offset < len(entries):
+        address, timeout, size = NRF_POLL_ENTRY.unpack_from(entries, offset)
+        offset += NRF_POLL_ENTRY.size
+        data = bytesToIntArray(entries[offset:offset + size])
+        offset += size
+
+        started = time.perf_counter()
+        try:
+            with buses.claim(("SPI", radio.spiBus)):
+                radio.driver.setWritePipeAddress(bytesToIntArray(address))
+                reply = radio.driver.sendAndReceive(data, timeout)
+            status = NRF_REPLIED if reply else NRF_NO_REPLY
+            reply = intArrayToBuffer(reply) if reply else b""
+        except Exception as e:
+            status, reply = NRF_FAILED, str(e).encode("utf-8")[:255]
+        roundTrip = int((time.perf_counter() - started) * 1000000)
+
+        res.extend(NRF_POLL_RESULT.pack(status, min(roundTrip, 0xFFFFFFFF), len(reply)))
+        res.extend(reply)
+
+    if VERBOSE > 3:
+        print("NRF: POLL_LIST()=" + str(res))
+    return res
+
+
+@commands.command(NRF_GET_RECEIVE_STATS)
+def nrfGetReceiveStats(state):
+    return nrfRadios.of(state).receiver.stats(state.push)
+
+
+# Sampling; each job gets its own SpiDev/SMBus so channel's commands can run meanwhile
+
+def spiSampleRead(bus, device, data):
+    spi = spidev.SpiDev()
+    spi.open(bus, device)
+    transfers = splitTransfers(UINT16.unpack_from(data)[0], data[UINT16.size:])
+    busLock = buses.get(("SPI", bus))
+
+    def read():
+        res = bytearray()
+        busLock.acquire(True)
+        try:
+            for transfer in transfers:
+                res.extend(spi.xfer(list(transfer)))
+        finally:
+            busLock.release(True)
+        return res
+
+    return read, spi.close
+
+
+def i2cSampleRead(busNo, data):
+    if smbus is None:
+        raise IOError("smbus module is not available")
+    bus = smbus.SMBus(busNo)
+    reads = list(I2C_READ_MANY_ENTRY.iter_unpack(data))
+    busLock = buses.get(("I2C", busNo))
+
+    def read():
+        res = bytearray()
+        busLock.acquire(True)
+        try:
+            for address, register, count in reads:
+                if count == 1:
+                    res.append(bus.read_byte_data(address, register))
+                else:
+                    res.extend(bus.read_i2c_block_data(address, register, count))
+        finally:
+            busLock.release(True)
+        return res
+
+    return read, bus.close
+
+
+def stopSampler(state, job):
+    sampler = state.samplers.pop(job, None)
+    if sampler is None:
+        return SAMPLE_STATS.pack(0, 0, 0, 0)
+    return sampler.stop()
+
+
+@commands.command(RRPI_SAMPLE_START, SAMPLE_ARGS, data=True)
+def rrpiSampleStart(state, job, kind, bus, device, periodUs, blockSamples, queueBlocks, maxLatency, data):
+    if VERBOSE > 2:
+        print("SAMPLE: START(" + str(job) + ", " + str(kind) + ", " + str(bus) + "." + str(device) + ", every " + str(periodUs) + "us)")
+    if periodUs == 0:
+        raise ValueError("Sampling period must not be 0")
+    stopSampler(state, job)
+    if kind == SAMPLE_SPI:
+        read, close = spiSampleRead(bus, device, data)
+    elif kind == SAMPLE_I2C:
+        read, close = i2cSampleRead(bus, data)
+    else:
+        raise ValueError("Unknown sampling kind " + str(kind))
+    state.samplers[job] = Sampler(job, state.push, read, close, periodUs / 1000000.0, blockSamples, queueBlocks, maxLatency)
+    state.samplers[job].start()
+
+
+@commands.command(RRPI_SAMPLE_STOP, BYTE)
+def rrpiSampleStop(state, job):
+    if VERBOSE > 2:
+        print("SAMPLE: STOP(" + str(job) + ")")
+    return stopSampler(state, job)
+
+
+@commands.onClose
+def samplersClose(state):
+    for job in list(state.samplers):
+        stopSampler(state, job)
+
+
+# Protocol
+
+@commands.command(RRPI_STATS)
+def rrpiStats(state):
+    return json.dumps(stats.snapshot()).encode("utf-8")
+
+
+@commands.command(RRPI_DATAGRAM_OPEN)
+def rrpiDatagramOpen(state):
+    if datagrams is None:
+        raise IOError("UDP transport is not enabled")
+    return DATAGRAM_OPEN_REPLY.pack(datagrams.open(state.connection), datagrams.port)
+
+
+class DatagramTransport:
+    # UDP transport for commands where the latest value matters more than getting every
+    # one through - actuator updates, telemetry. Each datagram carries one frame, session
+    # token, handed out over TCP with RRPI_DATAGRAM_OPEN, and sequence number counted per
+    # channel. Frames go to the same channel queues as ones received over TCP. Datagram not
+    # newer than the last one taken on its channel is stale and dropped rather than run late.
+    # Frames with FLAG_REPLY get reply, which is also the acknowledgement, as datagram.
+
+    def __init__(self, socketAddress, port):
+        self.port = port
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((socketAddress, port))
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._sequences = {}
+        self._thread = threading.Thread(target=self._receive)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def open(self, connection):
+        with self._lock:
+            if connection.datagramToken is None:
+                token = 0
+                while token == 0 or token in self._connections:
+                    token = struct.unpack("<I", os.urandom(4))[0]
+                connection.datagramToken = token
+                self._connections[token] = connection
+            return connection.datagramToken
+
+    def close(self, connection):
+        with self._lock:
+            token = connection.datagramToken
+            if token in self._connections:
+                del self._connections[token]
+                for key in [key for key in self._sequences if key[0] == token]:
+                    del self._sequences[key]
+
+    def _receive(self):
+        buffer = bytearray(MAX_DATAGRAM_SIZE)
+        view = memoryview(buffer)
+        start = DATAGRAM_HEADER.size + REQUEST_HEADER.size
+        while True:
+            size, address = self._socket.recvfrom_into(buffer)
+            if size < start:
+                continue
+            token, sequence = DATAGRAM_HEADER.unpack_from(buffer)
+            cmd, flags, channel, tag, length = REQUEST_HEADER.unpack_from(buffer, DATAGRAM_HEADER.size)
+            if start + length > size:
+                continue
+
+            with self._lock:
+                connection = self._connections.get(token)
+                if connection is None:
+                    continue
+                last = self._sequences.get((token, channel))
+                if last is not None and not 0 < (sequence - last) & 0xFFFFFFFF < 0x80000000:
+                    stats.recordStaleDatagram()
+                    if VERBOSE > 3:
+                        print("Dropped stale datagram " + str(sequence) + " on channel " + str(channel))
+                    continue
+                self._sequences[(token, channel)] = sequence
+
+            replyTo = None
+            if flags & FLAG_REPLY:
+                replyTo = self._replier(DATAGRAM_HEADER.pack(token, sequence), address)
+            connection.submitFrame(channel, cmd, flags, tag, bytes(view[start:start + length]), replyTo)
+
+    def _replier(self, header, address):
+        def reply(frame):
+            self._socket.sendto(header + frame, address)
+
+        return reply
+
+
+datagrams = None
+
+
+def createChannel(connection, channel):
+    def push(cmd, data, extra=None):
+        started = time.perf_counter()
+        connection.send(channel, cmd, STATUS_PUSH, 0, data, extra)
+        size = REPLY_HEADER.size + len(data) + (len(extra) if extra is not None else 0)
+        stats.recordPush(connection.session, cmd, size, time.perf_counter() - started)
+
+    state = ChannelState(connection, channel, push)
+
+    def processFrame(cmd, flags, tag, payload, received, replyTo):
+        started = time.perf_counter()
+        try:
+            res = commands.dispatch(state, cmd, payload)
+            status = STATUS_OK
+        except Exception as e:
+            if VERBOSE > 0:
+                print(str(e))
+            res = str(e).encode("utf-8")
+            status = STATUS_ERROR
+
+        processed = time.perf_counter()
+        bytesOut = 0
+        if flags & FLAG_REPLY:
+            res = res if res is not None else b""
+            connection.send(channel, cmd, status, tag, res, replyTo=replyTo)
+            bytesOut = REPLY_HEADER.size + len(res)
+
+        stats.record(connection.session, cmd, REQUEST_HEADER.size + len(payload), bytesOut,
+                     started - received, processed - started, time.perf_counter() - processed, status != STATUS_OK)
+
+    def closeChannel():
+        commands.close(state)
+
+    return processFrame, closeChannel
+
+
+def closeConnection(connection):
+    # Releases everything channels of the connection hold; session is over
+    sessions.forget(connection)
+    if datagrams is not None:
+        datagrams.close(connection)
+    states = list(connection.channels.values())
+    connection.channels.clear()
+    for processFrame, closeChannel in states:
+        closeChannel()
+    stats.closeSession(connection.session)
+
+
+def createSession(con, execute, inline=False):
+    # Frames of one channel are processed in order, one at a time, while different channels
+    # are processed concurrently, through execute(function, channel), so slow device does not
+    # hold up the others sharing the connection. With inline set, connection with only one
+    # channel has its frames processed in the calling thread, saving the hand over.
+    connection = Connection(con)
+    record = connection.record
+    lock = threading.Lock()
+    idle = threading.Condition(lock)
+    queues = {}
+    active = set()
+    closed = False
+
+    def run(channel):
+        while True:
+            with lock:
+                queue = queues[channel]
+                if len(queue) == 0 or closed:
+                    active.discard(channel)
+                    idle.notify_all()
+                    if len(queue) == 0 and channel not in connection.channels:
+                        del queues[channel]
+                    return
+
+                cmd, flags, tag, payload, received, replyTo = queue.popleft()
+                if cmd == RRPI_SESSION_OPEN or cmd == RRPI_SESSION_RESUME:
+                    processFrame = None  # session level; does not set channel up
+                else:
+                    if channel not in connection.channels:
+                        connection.channels[channel] = createChannel(connection, channel)
+                    processFrame, closeChannel = connection.channels[channel]
+                    if cmd == RRPI_CLOSE_CHANNEL:
+                        del connection.channels[channel]
+
+            try:
+                if processFrame is None:
+                    sessionFrame(channel, cmd, tag, bytes(payload))
+                elif cmd == RRPI_CLOSE_CHANNEL:
+                    if VERBOSE > 2:
+                        print("RRPI: CLOSE_CHANNEL(" + str(channel) + ")")
+                    closeChannel()
+                else:
+                    processFrame(cmd, flags, tag, payload, received, replyTo)
+            except OSError as ignore:
+                if VERBOSE > 3:
+                    print("Connection closed, leaving")
+                with lock:
+                    active.discard(channel)
+                    idle.notify_all()
+                con.shutdown(socket.SHUT_RDWR)
+                return
+
+    def sessionFrame(channel, cmd, tag, payload):
+        try:
+            if cmd == RRPI_SESSION_OPEN:
+                if VERBOSE > 2:
+                    print("RRPI: SESSION_OPEN")
+                if sessions.grace <= 0:
+                    raise IOError("Sessions are not kept after disconnect")
+                status, res = STATUS_OK, SESSION_OPEN_REPLY.pack(sessions.open(connection), sessions.grace)
+            else:
+                if VERBOSE > 2:
+                    print("RRPI: SESSION_RESUME")
+                resume(payload)
+                status, res = STATUS_OK, b""
+        except IOError as e:
+            status, res = STATUS_ERROR, str(e).encode("utf-8")
+        connection.send(channel, cmd, status, tag, res)
+
+    def resume(token):
+        # Attaches this socket to suspended connection, in place of the one it started with
+        nonlocal connection
+
+        current = connection
+        with lock:
+            if len(current.channels) > 0:
+                raise IOError("Session can be resumed only before any channel is used")
+        suspended = sessions.take(token)
+        with lock:
+            if len(current.channels) > 0:
+                sessions.suspend(suspended)
+                raise IOError("Session can be resumed only before any channel is used")
+            suspended.con = con
+            suspended.record = current.record
+            suspended.submitFrame = submitFrame
+            connection = suspended
+        stats.closeSession(current.session)
+
+    def submitFrame(channel, cmd, flags, tag, payload, replyTo=None):
+        # Frames which came as datagrams (with replyTo) are never processed inline
+        # so UDP receiving thread is not held up by one session
+        if record is not None:
+            record(CAPTURE_REQUEST, cmd, flags, channel, tag, payload)
+
+        with lock:
+            if channel not in queues:
+                queues[channel] = collections.deque()
+            queues[channel].append((cmd, flags, tag, payload, time.perf_counter(), replyTo))
+            if channel in active:
+                return
+            active.add(channel)
+            single = inline and len(queues) == 1 and replyTo is None
+
+        if single:
+            run(channel)
+        else:
+            execute(run, channel)
+
+    def closeSession():
+        nonlocal closed
+
+        with lock:
+            closed = True
+            if connection.token is not None:
+                # Frames being processed finish before channels can be taken over
+                deadline = time.time() + SESSION_TAKEOVER_TIMEOUT
+                while len(active) > 0 and time.time() < deadline:
+                    idle.wait(deadline - time.time())
+
+        if connection.token is None or sessions.grace <= 0 or not sessions.suspend(connection):
+            closeConnection(connection)
+        elif VERBOSE > 1:
+            print("Session " + str(connection.session["id"]) + " suspended")
+
+    connection.submitFrame = submitFrame
+    return submitFrame, closeSession
+
+
+def runSession(con):
+    executor = ThreadPoolExecutor(max_workers=CHANNEL_THREADS)
+    submitFrame, closeSession = createSession(con, executor.submit, inline=True)
+
+    header = bytearray(REQUEST_HEADER.size)
+    headerView = memoryview(header)
+
+    try:
+        while True:
+            if VERBOSE > 4:
+                print("Waiting on command")
+
+            recvInto(con, headerView, REQUEST_HEADER.size)
+            cmd, flags, channel, tag, length = REQUEST_HEADER.unpack(header)
+            if length > MAX_PAYLOAD_SIZE:
+                print("Frame of " + str(length) + " bytes is too big, closing connection")
+                break
+            payload = bytearray(length)
+            recvInto(con, memoryview(payload), length)
+
+            submitFrame(channel, cmd, flags, tag, payload)
+
+    except ConnectionResetError as ignore:
+        if VERBOSE > 4:
+            print("Got connection reset error")
+        pass
+    finally:
+        closeSession()
+        executor.shutdown(wait=False)
+        con.close()
+
+
+def acceptConnections(s):
+    while True:
+        try:
+            con, addr = s.accept()
+            if con.family != socket.AF_UNIX:
+                con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            t = threading.Thread(target=runSession, args=[con])
+            t.daemon = True
+            t.start()
+        except Exception as e:
+            print(str(e) + "\n" + ''.join(traceback.format_tb(e.__traceback__)))
+
+
+def removeStaleUnixSocket(path):
+    # Socket file is left behind by server which did not stop cleanly
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def startThreadedServer(socketAddress, port, backlog, unixPath=None):
+    if VERBOSE > 2:
+        print("Setting up scoket at " + socketAddress + ":" + str(port))
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((socketAddress, port))
+    s.listen(backlog)
+
+    u = None
+    if unixPath is not None:
+        removeStaleUnixSocket(unixPath)
+        u = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        u.bind(unixPath)
+        os.chmod(unixPath, UNIX_SOCKET_MODE)
+        u.listen(backlog)
+        t = threading.Thread(target=acceptConnections, args=[u])
+        t.daemon = True
+        t.start()
+
+    if VERBOSE > 1:
+        print("Listening at " + socketAddress + ":" + str(port) + (" and " + unixPath if u is not None else "") + " (threaded)")
+
+    try:
+        acceptConnections(s)
+    except KeyboardInterrupt as ki:
+        print(" - Stopping")
+    finally:
+        s.close()
+        if u is not None:
+            u.close()
+            removeStaleUnixSocket(unixPath)
+
+
+class AsyncSession(asyncio.BufferedProtocol):
+    # Connection served by asyncio event loop. Loop reads straight into session's buffer
+    # and splits it to frames; complete frames are processed in executor's threads which
+    # send replies straight to the socket. No thread is held by an idle connection.
+
+    def __init__(self, loop, executor):
+        self._loop = loop
+        self._executor = executor
+        self._transport = None
+        self._out = None
+        self._submitFrame = None
+        self._closeSession = None
+        self._buffer = bytearray(64 * 1024)
+        self._bufferView = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def connection_made(self, transport):
+        self._transport = transport
+        # Replies are written by executor threads directly to a duplicate of the socket;
+        # timeout keeps it non-blocking for the loop while sendall() waits for buffer space.
+        self._out = socket.socket(fileno=os.dup(transport.get_extra_info("socket").fileno()))
+        self._out.settimeout(SEND_TIMEOUT)
+        self._submitFrame, self._closeSession = createSession(self, self._executor.submit)
+
+    def get_buffer(self, sizehint):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._end < REQUEST_HEADER.size and self._start > 0:
+            self._compact()
+        return self._bufferView[self._end:]
+
+    def _compact(self):
+        size = self._end - self._start
+        self._bufferView[0:size] = self._bufferView[self._start:self._end]
+        self._start = 0
+        self._end = size
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+        while self._end - self._start >= REQUEST_HEADER.size:
+            cmd, flags, channel, tag, length = REQUEST_HEADER.unpack_from(self._buffer, self._start)
+            if length > MAX_PAYLOAD_SIZE:
+                print("Frame of " + str(length) + " bytes is too big, closing connection")
+                self._transport.close()
+                return
+
+            frameEnd = self._start + REQUEST_HEADER.size + length
+            if frameEnd > self._end:
+                if frameEnd - self._start > len(self._buffer):
+                    self._grow(frameEnd - self._start)
+                elif frameEnd > len(self._buffer):
+                    self._compact()
+                break
+
+            self._submitFrame(channel, cmd, flags, tag, bytes(self._bufferView[self._start + REQUEST_HEADER.size:frameEnd]))
+            self._start = frameEnd
+
+    def _grow(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        view[0:self._end - self._start] = self._bufferView[self._start:self._end]
+        self._buffer = buffer
+        self._bufferView = view
+        self._end -= self._start
+        self._start = 0
+
+    def connection_lost(self, exc):
+        # Suspending session waits for frames being processed, so it is not done in the loop
+        self._loop.run_in_executor(None, self._closed)
+
+    def _closed(self):
+        self._closeSession()
+        self._out.close()
+
+    def sendall(self, data):
+        self._out.sendall(data)
+
+    def shutdown(self, how):
+        self.close()
+
+    def getpeername(self):
+        return self._transport.get_extra_info("peername")
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._transport.close)
+
+
+def startAsyncServer(socketAddress, port, backlog, workers, unixPath=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    if VERBOSE > 2:
+        print("Setting up scoket at " + socketAddress + ":" + str(port))
+
+    servers = [loop.run_until_complete(loop.create_server(lambda: AsyncSession(loop, executor), socketAddress, port, backlog=backlog))]
+    if unixPath is not None:
+        removeStaleUnixSocket(unixPath)
+        servers.append(loop.run_until_complete(loop.create_unix_server(lambda: AsyncSession(loop, executor), unixPath, backlog=backlog)))
+        os.chmod(unixPath, UNIX_SOCKET_MODE)
+
+    if VERBOSE > 1:
+        print("Listening at " + socketAddress + ":" + str(port) + (" and " + unixPath if unixPath is not None else "")
+              + " (asyncio, " + str(workers) + " workers)")
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt as ki:
+        print(" - Stopping")
+    finally:
+        for server in servers:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        if unixPath is not None:
+            removeStaleUnixSocket(unixPath)
+        executor.shutdown(wait=False)
+        loop.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remote Raspberry Pi server")
+    parser.add_argument("-a", "--address", default="0.0.0.0", help="address to listen at. Default 0.0.0.0")
+    parser.add_argument("-p", "--port", type=int, default=8789, help="port to listen at. Default 8789")
+    parser.add_argument("-b", "--backlog", type=int, default=16, help="listen backlog. Default 16")
+    parser.add_argument("-e", "--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="one thread per connection or asyncio event loop with bounded executor. Default threaded")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="number of executor threads for driver calls in asyncio engine. Default 4")
+    parser.add_argument("-c", "--capture", help="file to record all received and sent frames to")
+    parser.add_argument("--plugin", action="append", default=[],
+                        help="module, or .py file, registering further command handlers; can be repeated")
+    parser.add_argument("--unix", help="Unix socket path for clients on the Pi itself; empty string turns it off. Default "
+                                          + UNIX_SOCKET_PATH.format(port="<port>"))
+    parser.add_argument("-u", "--udp-port", type=int,
+                        help="port to receive commands as UDP datagrams at (see DatagramTransport). Default off")
+    parser.add_argument("-g", "--grace", type=float, default=SESSION_GRACE,
+                        help="seconds session with token is kept after its connection breaks; 0 turns it off. Default "
+                             + str(SESSION_GRACE))
+    parser.add_argument("-m", "--processes",
+                        help="run commands of bus groups in worker processes: comma separated processes, each one or more of "
+                             + ", ".join(WORKER_GROUPS) + " joined with +, or all for a process per group. Default off")
+    parser.add_argument("-s", "--stats-port", type=int, help="port to serve statistics at, as text over HTTP")
+    parser.add_argument("-v", "--verbose", type=int, default=VERBOSE, help="verbosity level. Default " + str(VERBOSE))
+    args = parser.parse_args()
+
+    VERBOSE = args.verbose
+    sessions.grace = args.grace
+    for plugin in args.plugin:
+        loadPlugin(plugin)
+    if args.processes is not None:
+        try:
+            startWorkers(args.processes)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.capture is not None:
+        recorder = Recorder(args.capture)
+    if args.stats_port is not None:
+        startStatsServer(args.address, args.stats_port)
+    if args.udp_port is not None:
+        datagrams = DatagramTransport(args.address, args.udp_port)
+
+    unixPath = args.unix if args.unix is not None else UNIX_SOCKET_PATH.format(port=args.port)
+    if unixPath == "" or not hasattr(socket, "AF_UNIX"):
+        unixPath = None
+
+    try:
+        if args.engine == "threaded":
+            startThreadedServer(args.address, args.port, args.backlog, unixPath)
+        else:
+            startAsyncServer(args.address, args.port, args.backlog, args.workers, unixPath)
+    finally:
+        if recorder is not None:
+            recorder.close()
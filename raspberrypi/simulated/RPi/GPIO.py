@@ -0,0 +1,124 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Simulated RPi.GPIO module. Pins remember levels written to them, inputs read back
+# those levels (or pull up/down value if never written) and changing a level fires
+# edge detection callbacks from a separate thread just like RPi.GPIO does.
+
+import queue
+import threading
+
+BOARD = 10
+BCM = 11
+
+OUT = 0
+IN = 1
+
+LOW = 0
+HIGH = 1
+
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+_mode = None
+_levels = {}
+_directions = {}
+_detect = {}
+_events = queue.Queue()
+_thread = None
+
+
+def setwarnings(flag):
+    pass
+
+
+def setmode(mode):
+    global _mode
+    _mode = mode
+
+
+def getmode():
+    return _mode
+
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=-1):
+    _directions[channel] = direction
+    if direction == OUT:
+        if initial != -1:
+            _setLevel(channel, initial)
+    elif channel not in _levels:
+        _levels[channel] = HIGH if pull_up_down == PUD_UP else LOW
+
+
+def output(channel, value):
+    if _directions.get(channel) != OUT:
+        raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+    _setLevel(channel, HIGH if value else LOW)
+
+
+def input(channel):
+    if channel not in _directions:
+        raise RuntimeError("You must setup() the GPIO channel first")
+    return _levels.get(channel, LOW)
+
+
+def simulateInput(channel, value):
+    _setLevel(channel, HIGH if value else LOW)
+
+
+def _setLevel(channel, level):
+    old = _levels.get(channel, LOW)
+    _levels[channel] = level
+    if channel in _detect and old != level:
+        edge, callback = _detect[channel]
+        if edge == BOTH or (edge == RISING and level == HIGH) or (edge == FALLING and level == LOW):
+            _events.put((callback, channel))
+
+
+def _dispatch():
+    while True:
+        callback, channel = _events.get()
+        callback(channel)
+
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    global _thread
+    if channel in _detect:
+        raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+    _detect[channel] = (edge, callback)
+    if _thread is None:
+        _thread = threading.Thread(target=_dispatch)
+        _thread.daemon = True
+        _thread.start()
+
+
+def remove_event_detect(channel):
+    if channel in _detect:
+        del _detect[channel]
+
+
+def cleanup(channel=None):
+    if channel is None:
+        channels = list(_directions.keys())
+    elif isinstance(channel, int):
+        channels = [channel]
+    else:
+        channels = channel
+    for c in channels:
+        _directions.pop(c, None)
+        _levels.pop(c, None)
+        _detect.pop(c, None)
@@ -0,0 +1,149 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Simulated nRF2401 module with the same functions as the Pi side driver.
+# Every sent packet is "answered" with the same payload: sendAndReceive returns
+# data it was given and sendData puts packet into receive queue so it can be
+# picked up with poolData/receiveData. SIMULATED_NRF_AIRTIME environment variable
+# sets seconds each packet spends on air. SIMULATED_NRF_RX_RATE makes radio, while
+# listening, receive that many packets per second (with sequence number in first
+# four bytes) into its three packets deep RX FIFO. Nodes whose address starts with
+# 0xFF do not answer: sendAndReceive to them waits its timeout and returns empty list.
+
+import collections
+import os
+import time
+
+_AIRTIME = float(os.environ.get("SIMULATED_NRF_AIRTIME", "0"))
+_RX_RATE = float(os.environ.get("SIMULATED_NRF_RX_RATE", "0"))
+
+packetSize = 32
+channel = 0
+readPipeAddresses = {}
+writePipeAddress = None
+powered = False
+listening = False
+
+_received = collections.deque(maxlen=3)
+_nextRx = 0
+_rxSequence = 0
+
+
+def initNRF(spiBus, spiDevice, size, address, ch):
+    global packetSize, channel
+    packetSize = size
+    channel = ch
+    readPipeAddresses[0] = address
+    _received.clear()
+
+
+def close():
+    _received.clear()
+
+
+def setReadPipeAddress(pipeNumber, address):
+    readPipeAddresses[pipeNumber] = address
+
+
+def setWritePipeAddress(address):
+    global writePipeAddress
+    writePipeAddress = address
+
+
+def writeFlushTX():
+    pass
+
+
+def writeFlushRX():
+    _received.clear()
+
+
+def powerUp():
+    global powered
+    powered = True
+
+
+def powerDown():
+    global powered
+    powered = False
+
+
+def swithToTX():
+    pass
+
+
+def swithToRX():
+    pass
+
+
+def reset():
+    _received.clear()
+
+
+def startListening():
+    global listening, _nextRx
+    listening = True
+    _nextRx = time.time()
+
+
+def stopListening():
+    global listening
+    listening = False
+
+
+def _generate():
+    global _nextRx, _rxSequence
+    if listening and _RX_RATE > 0:
+        now = time.time()
+        while _nextRx <= now:
+            _received.append([_rxSequence & 255, _rxSequence >> 8 & 255, _rxSequence >> 16 & 255, _rxSequence >> 24 & 255])
+            _rxSequence += 1
+            _nextRx += 1 / _RX_RATE
+
+
+def _air():
+    if _AIRTIME > 0:
+        time.sleep(_AIRTIME)
+
+
+def sendData(data):
+    _air()
+    _received.append(list(data))
+    return True
+
+
+def receiveData(n):
+    _generate()
+    if len(_received) > 0:
+        packet = _received.popleft()
+    else:
+        packet = []
+    return (packet + [0] * n)[:n]
+
+
+def poolData(timeout):
+    _generate()
+    if len(_received) > 0:
+        return True
+    if timeout > 0:
+        time.sleep(min(timeout, 0.001))
+    _generate()
+    return len(_received) > 0
+
+
+def sendAndReceive(data, timeout):
+    _air()
+    if writePipeAddress is not None and len(writePipeAddress) > 0 and writePipeAddress[0] == 0xFF:
+        time.sleep(timeout)
+        return []
+    _air()
+    return list(data)
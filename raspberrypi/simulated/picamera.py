@@ -0,0 +1,67 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Simulated picamera module. Recording produces frames of pseudo JPEG data (size of
+# about width * height / 10 bytes) at set framerate from a background thread.
+
+import struct
+import threading
+import time
+
+
+class _Frame:
+    complete = True
+
+
+class PiCamera:
+
+    def __init__(self):
+        self.resolution = (1280, 720)
+        self.framerate = 30
+        self.frame = _Frame()
+        self._recording = False
+        self._thread = None
+
+    def _image(self, number):
+        width, height = self.resolution
+        size = max(16, width * height // 10)
+        header = b"\xff\xd8" + struct.pack("<I", number)
+        return header + bytes(size - len(header) - 2) + b"\xff\xd9"
+
+    def _record(self, output):
+        number = 0
+        due = time.perf_counter()
+        while self._recording:
+            output.write(self._image(number))
+            number += 1
+            due += 1.0 / self.framerate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def start_recording(self, output, format="h264", **options):
+        self._recording = True
+        self._thread = threading.Thread(target=self._record, args=[output])
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop_recording(self):
+        self._recording = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def capture(self, output, format="jpeg", use_video_port=False, **options):
+        output.write(self._image(0))
+
+    def close(self):
+        self.stop_recording()
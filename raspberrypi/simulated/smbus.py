@@ -0,0 +1,77 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Simulated smbus module. Every device on the bus is 256 byte register file which
+# reads back what was written to it. Registers auto increment on block transfers.
+# Addresses from 0x78 up, reserved on I2C, have no device: transfers to them fail with
+# Remote I/O error, as not acknowledged ones do with the real driver.
+
+import errno
+import os
+
+NO_DEVICE = 0x78
+
+
+class SMBus:
+
+    _devices = {}
+
+    def __init__(self, busNo):
+        self.busNo = busNo
+
+    def close(self):
+        pass
+
+    def _registers(self, i2cAddress):
+        if i2cAddress >= NO_DEVICE:
+            raise OSError(errno.EREMOTEIO, os.strerror(errno.EREMOTEIO))
+        key = (self.busNo, i2cAddress)
+        if key not in SMBus._devices:
+            SMBus._devices[key] = [0] * 256
+        return SMBus._devices[key]
+
+    def write_byte(self, i2cAddress, value):
+        self._registers(i2cAddress)[0] = value
+
+    def read_byte(self, i2cAddress):
+        return self._registers(i2cAddress)[0]
+
+    def write_byte_data(self, i2cAddress, register, value):
+        self._registers(i2cAddress)[register] = value
+
+    def read_byte_data(self, i2cAddress, register):
+        return self._registers(i2cAddress)[register]
+
+    def write_word_data(self, i2cAddress, register, value):
+        self.write_i2c_block_data(i2cAddress, register, [value & 255, value >> 8 & 255])
+
+    def read_word_data(self, i2cAddress, register):
+        data = self.read_i2c_block_data(i2cAddress, register, 2)
+        return data[0] | data[1] << 8
+
+    def write_block_data(self, i2cAddress, register, data):
+        self.write_i2c_block_data(i2cAddress, register, [len(data)] + list(data))
+
+    def read_block_data(self, i2cAddress, register):
+        registers = self._registers(i2cAddress)
+        count = registers[register]
+        return self.read_i2c_block_data(i2cAddress, (register + 1) & 255, count)
+
+    def write_i2c_block_data(self, i2cAddress, register, data):
+        registers = self._registers(i2cAddress)
+        for value in data:
+            registers[register] = value
+            register = (register + 1) & 255
+
+    def read_i2c_block_data(self, i2cAddress, register, count):
+        registers = self._registers(i2cAddress)
+        return [registers[(register + i) & 255] for i in range(count)]
@@ -0,0 +1,73 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Simulated spidev module. Put 'simulated' directory on PYTHONPATH to run
+# rrpi-server.py off the Raspberry Pi. MISO is looped back to MOSI.
+# SIMULATED_SPI_HZ environment variable, when set, makes transfers take
+# as long as they would on the real bus at that clock speed. Like the kernel driver,
+# transfers on one bus (any chip select) are done one at a time.
+
+import os
+import threading
+import time
+
+_SPI_HZ = int(os.environ.get("SIMULATED_SPI_HZ", "0"))
+
+_busLocks = {}
+_busLocksLock = threading.Lock()
+
+
+def _busLock(bus):
+    with _busLocksLock:
+        if bus not in _busLocks:
+            _busLocks[bus] = threading.Lock()
+        return _busLocks[bus]
+
+
+class SpiDev:
+
+    def __init__(self):
+        self.bus = None
+        self.device = None
+        self.mode = 0
+        self.bits_per_word = 8
+        self.max_speed_hz = _SPI_HZ
+
+    def open(self, bus, device):
+        self.bus = bus
+        self.device = device
+
+    def close(self):
+        self.bus = None
+        self.device = None
+
+    def _clock(self, size):
+        if self.max_speed_hz > 0:
+            with _busLock(self.bus):
+                time.sleep(size * 8 / self.max_speed_hz)
+
+    def xfer(self, data, speed_hz=0, delay_usec=0, bits_per_word=8):
+        self._clock(len(data))
+        return list(data)
+
+    def xfer2(self, data, speed_hz=0, delay_usec=0, bits_per_word=8):
+        return self.xfer(data, speed_hz, delay_usec, bits_per_word)
+
+    def readbytes(self, n):
+        self._clock(n)
+        return [0] * n
+
+    def writebytes(self, data):
+        self._clock(len(data))
+
+    def writebytes2(self, data):
+        self._clock(len(data))
@@ -0,0 +1,51 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+# Tests run client libraries against rrpi-server.py started on loopback with simulated
+# device modules, as benchmarks do (see benchmark/loopback.py).
+
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmark"))
+
+from loopback import CLIENT_LIBRARIES, startServer, stopServer
+
+sys.path.insert(0, CLIENT_LIBRARIES)
+
+
+def freePort():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # server(*serverArgs, env=None, engine="threaded") starts a server and points client libraries at it;
+    # returns its port. Servers are stopped at the end of the test.
+    started = []
+
+    def start(*serverArgs, env=None, engine="threaded"):
+        port = freePort()
+        started.append(startServer(engine, port, env, list(serverArgs)))
+        monkeypatch.setenv("RASPBERRY_IP", "127.0.0.1")
+        monkeypatch.setenv("RASPBERRY_PORT", str(port))
+        monkeypatch.setenv("RASPBERRY_RESUME", "0")
+        return port
+
+    yield start
+    for process in started:
+        stopServer(process)
@@ -0,0 +1,46 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+import array
+
+import rrpi
+
+
+def frame():
+    # 3 rows of 4 bytes
+    return memoryview(bytearray(range(12))).cast("B", (3, 4))
+
+
+def test_to_buffer_flattens_multi_dimensional_buffer():
+    buf = rrpi.toBuffer(frame())
+    assert len(buf) == 12
+    assert bytes(buf) == bytes(range(12))
+
+
+def test_to_buffer_flattens_multi_dimensional_values():
+    values = memoryview(array.array("H", range(12))).cast("B").cast("H", (3, 4))
+    assert rrpi.toBuffer(values) == bytearray(range(12))
+
+
+def test_to_buffer_copies_non_contiguous_buffer():
+    buf = rrpi.toBuffer(memoryview(bytes(range(12)))[::2])
+    assert bytes(buf) == bytes(range(0, 12, 2))
+
+
+def test_spi_xfer_of_multi_dimensional_buffer(server):
+    server()
+    import spidev
+
+    spi = spidev.SpiDev()
+    spi.open(0, 0)
+    assert spi.xfer(frame()) == list(range(12))
+    assert spi.xfer([1, 2, 3]) == [1, 2, 3]
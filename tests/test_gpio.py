@@ -0,0 +1,52 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+import os
+import subprocess
+import sys
+
+from loopback import SERVER, SIMULATED
+
+# Run in a process of its own, with server's module loaded next to simulated devices
+EVENTS_AFTER_FAILED_PUSH = """
+import importlib.util, time
+import RPi.GPIO as GPIO
+
+spec = importlib.util.spec_from_file_location("server", {server!r})
+server = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(server)
+
+def push(cmd, data, extra=None):
+    raise OSError("Broken pipe")
+
+pins = {{17}}
+events = server.GpioEvents(push, pins)
+GPIO.setmode(GPIO.BCM)
+GPIO.setup(17, GPIO.OUT, initial=0)
+GPIO.add_event_detect(17, GPIO.BOTH, callback=events.callback)
+GPIO.output(17, 1)
+time.sleep(0.1)
+for i in range(100):
+    GPIO.output(17, i & 1)
+time.sleep(0.1)
+assert events.closed
+assert len(events._events) == 0, len(events._events)
+assert 17 not in GPIO._detect
+assert len(pins) == 0
+"""
+
+
+def test_failed_push_stops_event_detection():
+    env = dict(os.environ, PYTHONPATH=SIMULATED)
+    result = subprocess.run([sys.executable, "-c", EVENTS_AFTER_FAILED_PUSH.format(server=SERVER)],
+                            env=env, capture_output=True, text=True, timeout=30)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,98 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import rrpi
+
+ADDRESS = [1, 2, 3, 4, 5]
+
+
+def test_partial_batch_is_delivered_within_max_latency(server):
+    server(env={"SIMULATED_NRF_RX_RATE": "4"})
+    import nRF2401
+
+    latencies = []
+    done = threading.Event()
+
+    def received(timestamp, packet):
+        latencies.append(time.time() - timestamp)
+        if len(latencies) == 3:
+            done.set()
+
+    radio = nRF2401.Radio(0, 1, 32, ADDRESS, 1)
+    radio.startReceiving(32, received, batchSize=8, maxLatency=0.005)
+    radio.startListening()
+    assert done.wait(5)
+    radio.stopListening()
+    radio.stopReceiving()
+
+    assert max(latencies) < 0.1
+
+
+@pytest.mark.parametrize("serverArgs", [(), ("-m", "all")], ids=["in-process", "workers"])
+def test_stalled_subscriber_does_not_hold_up_others(server, serverArgs):
+    port = server(*serverArgs, env={"SIMULATED_NRF_RX_RATE": "5000"})
+    import nRF2401
+
+    received = []
+    radio = nRF2401.Radio(0, 1, 32, ADDRESS, 1)
+    radio.startReceiving(32, lambda timestamp, packet: received.append(timestamp), batchSize=1)
+    radio.startListening()
+
+    # Subscribes to the same radio and never reads what is pushed to it
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    stalled.connect(rrpi.UNIX_SOCKET_PATH.format(port=port))
+    for cmd, args in ((rrpi.NRF_INIT, struct.pack("BBB5sB", 0, 1, 32, bytes(ADDRESS), 1)),
+                      (rrpi.NRF_SUBSCRIBE, struct.pack("<BHHf", 32, 256, 1, 0.005))):
+        stalled.sendall(rrpi.REQUEST_HEADER.pack(cmd, 0, 0, 0, len(args)) + args)
+
+    time.sleep(2)
+    before = len(received)
+    time.sleep(1)
+    stats = radio.getReceiveStats()
+    serverStats = radio._rrpi._connection.stats()
+    radio.stopListening()
+    radio.stopReceiving()
+    stalled.close()
+
+    assert len(received) - before > 500
+    assert stats["dropped"] == 0
+    if serverArgs:
+        assert serverStats["droppedPushes"] > 0
+
+
+def test_receive_callback_can_use_radio(server):
+    server(env={"SIMULATED_NRF_RX_RATE": "50"})
+    import nRF2401
+
+    sent = []
+    done = threading.Event()
+    radio = nRF2401.Radio(0, 1, 32, ADDRESS, 1)
+
+    def received(timestamp, packet):
+        sent.append(radio.sendData(packet))
+        if len(sent) == 3:
+            done.set()
+
+    radio.startReceiving(32, received, batchSize=1)
+    radio.startListening()
+    assert done.wait(5)
+    radio.stopListening()
+    radio.stopReceiving()
+
@@ -0,0 +1,67 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+import socket
+import struct
+import time
+
+from concurrent.futures import Future
+
+import pytest
+
+import rrpi
+
+DEVICE = 0x20
+REGISTER = 5
+
+
+def test_request_failed_by_reconnect_is_not_sent_again(server):
+    port = server()
+    connection = rrpi.RRPi(pipelined=True, resume=True, port=port)
+    channel = connection.openChannel()
+    channel.request(rrpi.I2C_OPEN, bytes([1])).result()
+    assert channel.request(rrpi.I2C_READ_BYTE_DATA, bytes([DEVICE, REGISTER])).result() == bytearray([0])
+
+    # Request is still in the send buffer when the socket breaks, as when sending it failed
+    # before the reader noticed the break
+    write = Future()
+    payload = bytes([DEVICE, REGISTER, 9])
+    with connection._sendLock:
+        tag = connection._addPending(write, None)
+        connection._outBuffer += rrpi.REQUEST_HEADER.pack(rrpi.I2C_WRITE_BYTE_DATA, rrpi.FLAG_REPLY, channel._channel, tag, len(payload))
+        connection._outBuffer += payload
+        connection._socket.shutdown(socket.SHUT_RDWR)
+    with pytest.raises(rrpi.RRPiError):
+        write.result(10)
+
+    assert channel.request(rrpi.I2C_READ_BYTE_DATA, bytes([DEVICE, REGISTER])).result(10) == bytearray([0])
+    connection.close()
+
+
+def test_suspending_session_does_not_hold_up_asyncio_loop(server):
+    port = server(engine="asyncio", env={"SIMULATED_NRF_AIRTIME": "3"})
+
+    # Session with token breaks while its frame (packet slowly going out) is being
+    # processed; suspending it waits for the frame
+    con = socket.create_connection(("127.0.0.1", port))
+    init = struct.pack("BBB5sB", 0, 1, 32, bytes([1, 2, 3, 4, 5]), 1)
+    for cmd, channel, payload in ((rrpi.RRPI_SESSION_OPEN, 0, b""), (rrpi.NRF_INIT, 1, init), (rrpi.NRF_SEND, 1, bytes(32))):
+        con.sendall(rrpi.REQUEST_HEADER.pack(cmd, rrpi.FLAG_REPLY, channel, 0, len(payload)) + payload)
+    time.sleep(0.5)
+    con.close()
+    time.sleep(0.2)
+
+    started = time.time()
+    other = rrpi.RRPi(port=port)
+    other.stats()
+    other.close()
+    assert time.time() - started < 1
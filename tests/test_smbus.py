@@ -0,0 +1,78 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+import threading
+
+import pytest
+
+import rrpi
+
+DEVICE = 0x20
+NO_DEVICE = 0x78  # simulated bus has nothing there
+
+
+def test_cached_write_updates_cache(server):
+    server()
+    import smbus
+
+    bus = smbus.SMBus(1)
+    bus.enable_cache(DEVICE)
+    bus.write_byte_data(DEVICE, 3, 7)
+    bus.write_word_data(DEVICE, 4, 0x0201)
+    assert bus._cached(DEVICE, 3, 3) == [7, 1, 2]
+    assert bus.read_i2c_block_data(DEVICE, 3, 3) == [7, 1, 2]
+
+
+def test_failed_write_is_reported_and_not_cached(server):
+    server()
+    import smbus
+
+    bus = smbus.SMBus(1)
+    bus.enable_cache(NO_DEVICE)
+    for write in (lambda: bus.write_byte_data(NO_DEVICE, 1, 5),
+                  lambda: bus.write_word_data(NO_DEVICE, 1, 5),
+                  lambda: bus.write_i2c_block_data(NO_DEVICE, 1, [5, 6])):
+        with pytest.raises(rrpi.RRPiError):
+            write()
+    assert bus._cache[NO_DEVICE] == {}
+    with pytest.raises(rrpi.RRPiError):
+        bus.read_byte_data(NO_DEVICE, 1)
+
+
+def test_failed_sampling_start_is_reported(server):
+    server()
+    import smbus
+
+    bus = smbus.SMBus(1)
+    with pytest.raises(rrpi.RRPiError):
+        bus.start_sampling([(DEVICE, 0, 2)], 0, block_samples=1)
+    assert bus._rrpi._samplers == {}
+    sampler = bus.start_sampling([(DEVICE, 0, 2)], 1000)
+    sampler.stop()
+
+
+def test_sampler_callback_can_use_connection(server):
+    server()
+    import smbus
+
+    bus = smbus.SMBus(1)
+    read = []
+    done = threading.Event()
+
+    def sampled(timestamp, sample):
+        read.append(bus.read_byte_data(DEVICE, 0))
+        if len(read) == 3:
+            done.set()
+
+    sampler = bus.start_sampling([(DEVICE, 0, 2)], 1000, sampled)
+    assert done.wait(5)
+    sampler.stop()
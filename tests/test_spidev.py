@@ -0,0 +1,50 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+import struct
+
+import pytest
+
+import rrpi
+
+
+def test_batch_limits(server):
+    server()
+    import spidev
+
+    spi = spidev.SpiDev()
+    spi.open(0, 0)
+    with pytest.raises(ValueError):
+        spi.xfer_batch([[1]] * 65536)
+    with pytest.raises(ValueError):
+        spi.xfer_batch([[1], bytes(65536)])
+
+    transfers = [[1, 2], bytes(range(256)) * 255 + bytes(255)]
+    assert spi.xfer_batch(transfers, output="bytes") == [bytes([1, 2]), bytes(transfers[1])]
+    assert spi.xfer([3]) == [3]
+
+
+def test_malformed_frame_spans_are_rejected(server):
+    server()
+    import spidev
+
+    spi = spidev.SpiDev()
+    spi.open(0, 0)
+    args = struct.pack("<BHII", 1, 0, 0, 16)  # full frame of 16 bytes
+    for spans in (struct.pack("<BII", 1, 0, 8) + bytes([0]),  # fill without pattern
+                  struct.pack("<BII", 1, 0, 8) + bytes([4, 1]),  # fill with cut pattern
+                  struct.pack("<BII", 0, 0, 8) + bytes(4),  # copy without all its data
+                  struct.pack("<BII", 0, 0, 4)[:5],  # cut span header
+                  struct.pack("<BII", 0, 12, 8) + bytes(8)):  # span outside of frame
+        with pytest.raises(rrpi.RRPiError):
+            spi._rrpi.request(rrpi.SPI_XFER_DELTA, args + spans).result()
+    assert spi.xfer([3]) == [3]
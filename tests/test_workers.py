@@ -0,0 +1,53 @@
+#################################################################################
+# Copyright (c) 2018 Creative Sphere Limited.
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Apache License v2.0
+# which accompanies this distribution, and is available at
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+#  Contributors:
+#    Creative Sphere - initial API and implementation
+#
+#################################################################################
+
+import threading
+import time
+
+import rrpi
+
+OPERATIONS = 20
+OPERATION_TIME = 0.01
+
+
+def test_groups_in_different_processes_share_bus_arbitration(server):
+    # Batch of 2 x 64 bytes at 102400 Hz takes OPERATION_TIME, as does nRF packet on air;
+    # both claim SPI bus 0 exclusively, from spi and nrf worker processes
+    server("-m", "all", env={"SIMULATED_SPI_HZ": "102400", "SIMULATED_NRF_AIRTIME": str(OPERATION_TIME)})
+    import nRF2401
+    import spidev
+
+    spi = spidev.SpiDev()
+    spi.open(0, 0)
+    radio = nRF2401.Radio(0, 1, 32, [1, 2, 3, 4, 5], 1)
+    spi.xfer([0])
+    radio.sendData([0] * 32)
+
+    def transfers():
+        for i in range(OPERATIONS):
+            spi.xfer_batch([[0x55] * 64, [0xAA] * 64])
+
+    def sends():
+        for i in range(OPERATIONS):
+            radio.sendData([1] * 32)
+
+    threads = [threading.Thread(target=transfers), threading.Thread(target=sends)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    assert elapsed >= 2 * OPERATIONS * OPERATION_TIME * 0.9
+    bus = rrpi.connection().stats()["buses"]["SPI0"]
+    assert bus["contended"] > 0